@@ -0,0 +1,913 @@
+"""
+bench_decorators.py - Benchmarks for the decorators in decorators.py.
+
+Usage:
+    python bench_decorators.py            # run every benchmark
+    python bench_decorators.py cache      # run benchmarks whose name matches
+
+    # Per-call overhead suite with JSON baselines and regression gating:
+    python bench_decorators.py --suite --save baseline.json
+    python bench_decorators.py --suite --compare baseline.json --threshold 0.25
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import itertools
+import json
+import logging
+import os
+import pickle
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+
+import decorators
+
+
+def zipf_keys(n, universe, s=1.0, seed=0):
+    """Draw n keys from range(universe) with a Zipf(s) popularity skew."""
+    rng = random.Random(seed)
+    weights = itertools.accumulate(1.0 / (k ** s) for k in range(1, universe + 1))
+    return rng.choices(range(universe), cum_weights=list(weights), k=n)
+
+
+# ---------------------------------------------------------
+# Caching
+# ---------------------------------------------------------
+
+def bench_cache_hit_ratio(n=200_000, universe=100_000, maxsize=1_000,
+                          skews=(0.8, 1.0, 1.2)):
+    """Hit ratio, time and memory of cache policies vs functools.lru_cache."""
+    variants = {
+        "functools.lru_cache": lambda f: functools.lru_cache(maxsize=maxsize)(f),
+        "cache(policy=lru)": lambda f: decorators.cache(maxsize=maxsize, policy="lru")(f),
+        "cache(policy=lfu)": lambda f: decorators.cache(maxsize=maxsize, policy="lfu")(f),
+        "cache(policy=tinylfu)": lambda f: decorators.cache(maxsize=maxsize, policy="tinylfu")(f),
+    }
+    print(f"cache hit ratio: n={n} universe={universe} maxsize={maxsize}")
+    print(f"{'skew':>5} {'variant':<24} {'hit%':>7} {'us/call':>8} {'KiB':>8}")
+    for s in skews:
+        keys = zipf_keys(n, universe, s)
+        for name, wrap in variants.items():
+            fn = wrap(lambda k: k)
+            start = time.perf_counter()
+            for k in keys:
+                fn(k)
+            elapsed = time.perf_counter() - start
+            info = fn.cache_info()
+            # Memory is measured on a second, traced run so tracing does
+            # not distort the timing above.
+            tracemalloc.start()
+            traced = wrap(lambda k: k)
+            for k in keys:
+                traced(k)
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            ratio = info.hits / (info.hits + info.misses)
+            print(f"{s:>5} {name:<24} {ratio:>7.2%} "
+                  f"{elapsed / n * 1e6:>8.2f} {current / 1024:>8.0f}")
+
+
+def run_threads(n_threads, target):
+    """Run target() on n_threads threads released together; return wall time."""
+    barrier = threading.Barrier(n_threads + 1)
+
+    def worker():
+        barrier.wait()
+        target()
+
+    threads = [threading.Thread(target=worker) for _ in range(n_threads)]
+    for t in threads:
+        t.start()
+    start = time.perf_counter()
+    barrier.wait()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+
+def bench_ttl_thread_scaling(ops=20_000, universe=2_000, thread_counts=(1, 2, 4, 8, 16, 32)):
+    """memoize_with_ttl throughput (90% hits) as the thread count grows."""
+    print(f"memoize_with_ttl scaling: {ops} ops/thread, universe={universe}")
+    print(f"{'threads':>7} {'Mops/s':>8} {'expired':>8}")
+    for n_threads in thread_counts:
+        @decorators.memoize_with_ttl(ttl=0.05, maxsize=universe)
+        def fn(k):
+            return k
+
+        keys = zipf_keys(ops, universe, 1.0)
+        elapsed = run_threads(n_threads, lambda: [fn(k) for k in keys])
+        info = fn.cache_info()
+        print(f"{n_threads:>7} {n_threads * ops / elapsed / 1e6:>8.2f} "
+              f"{info.expirations:>8}")
+
+
+def bench_rate_limit_10k_tasks(tasks=10_000, rate=20_000, burst=100):
+    """Achieved rate under asyncio.gather and per-acquire overhead."""
+    async def run():
+        @decorators.async_rate_limit(rate, burst=burst)
+        async def call():
+            return time.perf_counter()
+
+        start = time.perf_counter()
+        stamps = await asyncio.gather(*(call() for _ in range(tasks)))
+        elapsed = max(stamps) - start
+        # The first `burst` calls are free; the rest are paced at `rate`.
+        expected = (tasks - burst) / rate
+        print(f"rate limit: {tasks} tasks at {rate}/s burst={burst}: "
+              f"{elapsed:.3f}s (ideal {expected:.3f}s, "
+              f"error {(elapsed - expected) / expected:+.1%})")
+
+    asyncio.run(run())
+    limiter = decorators.RateLimiter(rate=1e12, burst=1)
+    start = time.perf_counter()
+    for _ in range(tasks):
+        limiter.reserve()
+    per_call = (time.perf_counter() - start) / tasks
+    print(f"rate limit: reserve() overhead {per_call * 1e6:.2f} us")
+
+
+def bench_metrics_overhead(n=500_000):
+    """Per-call overhead of the metric-recording decorators (logging off)."""
+    def plain():
+        return 1
+
+    async def aplain():
+        return 1
+
+    base = min(timeit.repeat(plain, number=n, repeat=5)) / n
+    for name, wrapped in (("timed", decorators.timed(plain)),
+                          ("log_calls", decorators.log_calls(plain)),
+                          ("timeit", decorators.timeit()(plain))):
+        per_call = min(timeit.repeat(wrapped, number=n, repeat=5)) / n
+        print(f"metrics overhead: {name:<18} {(per_call - base) * 1e9:>7.0f} ns/call")
+
+    async def drive(fn, count):
+        for _ in range(count):
+            await fn()
+
+    for name, wrapped in (("async_timed", decorators.async_timed()(aplain)),
+                          ("timeit", decorators.timeit()(aplain))):
+        start = time.perf_counter()
+        asyncio.run(drive(aplain, n // 5))
+        base = time.perf_counter() - start
+        start = time.perf_counter()
+        asyncio.run(drive(wrapped, n // 5))
+        per_call = (time.perf_counter() - start - base) / (n // 5)
+        print(f"metrics overhead: {name + ' (async)':<18} {per_call * 1e9:>7.0f} ns/call")
+
+
+def bench_idempotency_lookup(sizes=(10_000, 100_000, 1_000_000), lookups=20_000):
+    """Hit latency of the idempotency stores as the number of stored keys grows."""
+    print(f"idempotency lookup latency ({lookups} random hits)")
+    print(f"{'store':<8} {'keys':>9} {'us/lookup':>10}")
+    for size in sizes:
+        stores = {"memory": decorators.MemoryIdempotencyStore(maxsize=size)}
+        tmp = tempfile.mkdtemp()
+        stores["sqlite"] = decorators.SQLiteIdempotencyStore(
+            os.path.join(tmp, "bench.db"), purge_every=10 ** 9)
+        for name, store in stores.items():
+            if name == "sqlite":
+                # Bulk load in one transaction; per-put commits would
+                # dominate the run time at a million keys.
+                with store._connection() as conn:
+                    expires = time.time() + store.ttl
+                    conn.executemany(
+                        "INSERT INTO idempotency VALUES (?, ?, ?)",
+                        ((pickle.dumps(f"key-{i}"),
+                          pickle.dumps(i), expires) for i in range(size)))
+            else:
+                for i in range(size):
+                    store.put(f"key-{i}", i)
+            probe = [f"key-{random.randrange(size)}" for _ in range(lookups)]
+            start = time.perf_counter()
+            for key in probe:
+                store.get(key)
+            per_lookup = (time.perf_counter() - start) / lookups
+            print(f"{name:<8} {size:>9} {per_lookup * 1e6:>10.2f}")
+
+
+def locked_singleton(cls):
+    """The previous singleton: takes the lock on every call."""
+    instances = {}
+    lock = threading.Lock()
+
+    def get_instance(*args, **kwargs):
+        with lock:
+            if cls not in instances:
+                instances[cls] = cls(*args, **kwargs)
+        return instances[cls]
+    return get_instance
+
+
+def bench_singleton_contention(calls=50_000, thread_counts=(1, 2, 4, 8, 16, 32, 64)):
+    """Fetch throughput of singleton/multiton vs a lock-per-call singleton."""
+    class Client:
+        def __init__(self, name="default"):
+            self.name = name
+
+    variants = {
+        "locked singleton": locked_singleton(Client),
+        "singleton": decorators.singleton(Client),
+        "multiton": decorators.multiton(Client),
+    }
+    print(f"singleton contention: {calls} fetches/thread")
+    print(f"{'threads':>7} " + " ".join(f"{name:>18}" for name in variants))
+    for n_threads in thread_counts:
+        row = []
+        for get in variants.values():
+            get()
+            elapsed = run_threads(n_threads, lambda: [get() for _ in range(calls)])
+            row.append(f"{n_threads * calls / elapsed / 1e6:>12.2f} Mops/s")
+        print(f"{n_threads:>7} " + " ".join(row))
+
+
+def bench_batched_throughput(items=2_000, round_trip=0.002, batch_sizes=(1, 10, 50, 200)):
+    """
+    Items per second through a backend with a fixed per-request cost, one
+    request per item vs coalesced by @batched, with 32 calling threads.
+    """
+    print(f"batched throughput ({items} items, {round_trip * 1e3:.0f}ms per request)")
+    print(f"{'max_size':>8} {'items/s':>10} {'requests':>9} {'p99 queue ms':>13}")
+    for max_size in batch_sizes:
+        @decorators.batched(max_size=max_size, max_wait=0.001)
+        def backend(keys):
+            time.sleep(round_trip)
+            return [k * 2 for k in keys]
+
+        per_thread = items // 32
+
+        def worker():
+            for i in range(per_thread):
+                backend(i)
+
+        queue_delay = decorators.metrics.metric(
+            decorators._metric_name(backend.bulk), "batched_queue")
+        queue_delay.snapshot(reset=True)  # same name on every pass
+        wall = run_threads(32, worker)
+        delay = queue_delay.snapshot()
+        print(f"{max_size:>8} {per_thread * 32 / wall:>10.0f} "
+              f"{backend.batch_info().batches:>9} {delay['p99'] * 1e3:>13.2f}")
+
+
+def bench_stale_while_revalidate(calls=2_000, ttl=0.05, cost=0.01):
+    """Hot-key latency with a short TTL, recompute-on-expiry vs max_stale."""
+    print(f"hot key latency ({calls} calls, ttl={ttl}s, {cost * 1e3:.0f}ms recompute)")
+    print(f"{'mode':<18} {'p50 us':>8} {'p99.9 us':>10} {'max us':>10}")
+    for label, options in (("expire", {}), ("max_stale=1", {"max_stale": 1})):
+        @decorators.memoize_with_ttl(ttl=ttl, **options)
+        def load(key):
+            time.sleep(cost)
+            return key
+
+        load("hot")  # the cold miss is paid in both modes
+        samples = []
+        for _ in range(calls):
+            start = time.perf_counter_ns()
+            load("hot")
+            samples.append(time.perf_counter_ns() - start)
+            time.sleep(0.0002)
+        samples.sort()
+        print(f"{label:<18} {samples[len(samples) // 2] / 1e3:>8.1f} "
+              f"{samples[int(len(samples) * 0.999)] / 1e3:>10.1f} {samples[-1] / 1e3:>10.1f}")
+
+
+def _expensive(n):
+    time.sleep(0.001)
+    return {"n": n, "payload": list(range(n % 500))}
+
+
+def _tiered_worker(path, keys):
+    """Run in a fresh process: replay keys against the shared disk tier."""
+    fn = decorators.tiered_cache(path, maxsize=128)(_expensive)
+    start = time.perf_counter()
+    for k in keys:
+        fn(k)
+    return fn.disk.hits, fn.disk.misses, time.perf_counter() - start
+
+
+def bench_tiered_cold_start(n=5_000, universe=2_000, workers=4):
+    """
+    Cold-start hit rate and latency of tiered_cache across processes.
+
+    Disk hit rates are over memory-tier misses.
+    """
+    keys = zipf_keys(n, universe, 1.0)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "tier2.db")
+        with concurrent.futures.ProcessPoolExecutor(1) as pool:
+            hits, misses, cold = pool.submit(_tiered_worker, path, keys).result()
+        print(f"tiered cache: first process   disk hits {hits / (hits + misses):>6.1%} "
+              f"{cold / n * 1e6:>8.1f} us/call")
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            runs = list(pool.map(_tiered_worker, [path] * workers, [keys] * workers))
+        for i, (hits, misses, elapsed) in enumerate(runs):
+            print(f"tiered cache: new worker {i}    disk hits {hits / (hits + misses):>6.1%} "
+                  f"{elapsed / n * 1e6:>8.1f} us/call")
+
+        fn = decorators.tiered_cache(path, maxsize=universe)(_expensive)
+        for tier, sample in (("disk", keys[:2000]), ("memory", keys[:2000])):
+            start = time.perf_counter()
+            for k in sample:
+                fn(k)
+            per_call = (time.perf_counter() - start) / len(sample)
+            print(f"tiered cache: {tier:<6} tier read {per_call * 1e6:>8.1f} us/call")
+
+
+def _shm_worker(name, keys, write_every):
+    """Run in a worker process: replay keys against the shared table."""
+    cache = decorators.SharedMemoryCache(name, buckets=8192, ways=8, slot_size=256)
+    start = time.perf_counter()
+    for i, k in enumerate(keys):
+        if write_every and i % write_every == 0:
+            cache.put(k, i)
+        else:
+            cache.get(k)
+    elapsed = time.perf_counter() - start
+    cache.close()
+    return elapsed
+
+
+def bench_shared_memory_cache(lookups=50_000, universe=10_000, process_counts=(1, 2, 4, 8)):
+    """Hit latency and aggregate throughput of SharedMemoryCache across processes."""
+    name = f"bench-shm-{os.getpid()}"
+    cache = decorators.SharedMemoryCache(name, buckets=8192, ways=8, slot_size=256)
+    digests = [decorators._stable_hash(i) for i in range(universe)]
+    for i, k in enumerate(digests):
+        cache.put(k, i)
+    keys = [digests[i] for i in zipf_keys(lookups, universe, 1.0)]
+    print(f"shared memory cache ({lookups} lookups per process, {universe} keys)")
+    print(f"{'procs':>5} {'mix':>9} {'us/op':>8} {'total ops/s':>12}")
+    try:
+        for mix, write_every in (("all hits", 0), ("10% puts", 10)):
+            for procs in process_counts:
+                with concurrent.futures.ProcessPoolExecutor(procs) as pool:
+                    times = list(pool.map(_shm_worker, [name] * procs, [keys] * procs,
+                                          [write_every] * procs))
+                print(f"{procs:>5} {mix:>9} {sum(times) / procs / lookups * 1e6:>8.2f} "
+                      f"{procs * lookups / max(times):>12.0f}")
+    finally:
+        cache.unlink()
+        cache.close()
+
+
+def bench_log_pipeline(calls=20_000):
+    """log_calls latency: logging to a file in the caller vs a LogPipeline."""
+    payloads = {"small": 42, "10KB": {"items": list(range(1_000)), "name": "x" * 2_000}}
+
+    def handle(request):
+        return request
+
+    print(f"log_calls latency ({calls} calls per row)")
+    print(f"{'mode':<24} {'argument':>8} {'us/call':>8} {'p99 us':>8}")
+    root = logging.getLogger()
+    saved_level = root.level
+    with tempfile.TemporaryDirectory() as tmp:
+        file_handler = logging.FileHandler(os.path.join(tmp, "direct.log"))
+        pipeline = decorators.LogPipeline(os.path.join(tmp, "pipeline.log"))
+        modes = {
+            "logging, INFO off": (logging.WARNING, decorators.log_calls(handle)),
+            "logging -> file": (logging.INFO, decorators.log_calls(handle)),
+            "pipeline -> file": (logging.INFO,
+                                 decorators.log_calls(pipeline=pipeline)(handle)),
+        }
+        root.addHandler(file_handler)
+        try:
+            for label, (level, fn) in modes.items():
+                root.setLevel(level)
+                for size, payload in payloads.items():
+                    samples = []
+                    for _ in range(calls):
+                        start = time.perf_counter_ns()
+                        fn(payload)
+                        samples.append(time.perf_counter_ns() - start)
+                    samples.sort()
+                    print(f"{label:<24} {size:>8} {sum(samples) / calls / 1e3:>8.2f} "
+                          f"{samples[int(calls * 0.99)] / 1e3:>8.2f}")
+        finally:
+            root.removeHandler(file_handler)
+            root.setLevel(saved_level)
+            file_handler.close()
+            pipeline.close()
+        print(f"pipeline: {pipeline.written} lines in {pipeline.batches} writes, "
+              f"{pipeline.dropped} dropped")
+
+
+def bench_audit_log(seconds=1.0, thread_counts=(1, 8, 32), directory="."):
+    """
+    AuditLog records per second at each durability setting, plus scan speed.
+
+    Segments are written under ``directory``; fsync cost depends on its disk.
+    """
+    settings = [("none", 0), ("group", 0), ("group", 0.001), ("group", 0.005), ("always", 0)]
+    print(f"audit log appends ({seconds:.0f}s per row)")
+    print(f"{'durability':<16} {'threads':>7} {'records/s':>10} {'per fsync':>10}")
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        for n, (durability, window) in enumerate(settings):
+            for threads in thread_counts:
+                log = decorators.AuditLog(os.path.join(tmp, f"{n}-{threads}"),
+                                          durability=durability, commit_window=window)
+                stop = time.perf_counter() + seconds
+
+                def worker():
+                    while time.perf_counter() < stop:
+                        log.append(42, "READ", function="handler")
+
+                wall = run_threads(threads, worker)
+                label = durability if not window else f"group {window * 1e3:.0f}ms"
+                per_fsync = log.appended / log.fsyncs if log.fsyncs else float("inf")
+                print(f"{label:<16} {threads:>7} {log.appended / wall:>10.0f} "
+                      f"{per_fsync:>10.1f}")
+                log.close()
+
+        log = decorators.AuditLog(os.path.join(tmp, "scan"), durability="none")
+        for i in range(200_000):
+            log.append(i % 1000, "READ" if i % 10 else "DELETE")
+        for label, query in (("all records", {}), ("one user", {"user": 7}),
+                             ("user+action", {"user": 10, "action": "DELETE"})):
+            start = time.perf_counter()
+            found = sum(1 for _ in log.scan(**query))
+            elapsed = time.perf_counter() - start
+            print(f"scan {label:<12} {found:>7} hits  {200_000 / elapsed:>10.0f} records/s")
+        log.close()
+
+
+def list_require_role(role):
+    """The previous require_role: a linear scan of the user's roles list."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(user, *args, **kwargs):
+            if role not in user.get("roles", []):
+                raise PermissionError("Access denied")
+            return func(user, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bench_role_check(calls=200_000, role_counts=(1, 10, 100, 1_000)):
+    """require_role cost vs the number of roles a user holds (required one last)."""
+    print(f"require_role ({calls} calls)")
+    print(f"{'roles':>6} {'list ns':>9} {'mask ns':>9} {'granted ns':>11} {'speedup':>8}")
+    for n in role_counts:
+        names = [f"role-{i}" for i in range(n)]
+        registry = decorators.RoleRegistry()
+        old = list_require_role(names[-1])(_identity)
+        new = decorators.require_role(names[-1], registry=registry)(_identity)
+        times = []
+        for fn, user in ((old, {"id": 1, "roles": names}),
+                         (new, {"id": 1, "roles": names}),
+                         (new, {"id": 1, "roles": registry.grant(names)})):
+            fn(user)
+            start = time.perf_counter()
+            for _ in range(calls):
+                fn(user)
+            times.append((time.perf_counter() - start) / calls * 1e9)
+        print(f"{n:>6} {times[0]:>9.0f} {times[1]:>9.0f} {times[2]:>11.0f} "
+              f"{times[0] / times[2]:>7.1f}x")
+
+
+class SimulatedBackend:
+    """A server with ``capacity`` workers; excess requests queue inside it."""
+
+    def __init__(self, capacity, service_time):
+        self.capacity = capacity
+        self.service_time = service_time
+        self._busy = 0
+        self._waiting = collections.deque()
+
+    def degrade(self, capacity, service_time):
+        self.capacity = capacity
+        self.service_time = service_time
+
+    async def handle(self):
+        if self._busy >= self.capacity:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiting.append(waiter)
+            await waiter
+        else:
+            self._busy += 1
+        try:
+            await asyncio.sleep(self.service_time * random.uniform(0.8, 1.2))
+        finally:
+            if self._waiting and self._busy <= self.capacity:
+                self._waiting.popleft().set_result(None)  # hand the worker over
+            else:
+                self._busy -= 1
+
+
+def bench_adaptive_limit(clients=64, phase_seconds=3.0):
+    """
+    Latency under a backend that loses capacity halfway, fixed vs adaptive limit.
+
+    Closed-loop clients call as fast as they can; rejected calls back off
+    for 5ms. Latency is of accepted calls, measured at the client.
+    """
+    print(f"adaptive limit ({clients} clients; backend 32 workers x 5ms, "
+          f"then 8 workers x 10ms)")
+    print(f"{'limiter':<14} {'phase':<9} {'ok/s':>7} {'rejected':>9} "
+          f"{'p50 ms':>7} {'p99 ms':>8} {'limit':>6}")
+
+    async def run(label, make):
+        backend = SimulatedBackend(32, 0.005)
+        call = make(backend.handle)
+        samples = {"healthy": [], "degraded": []}
+        rejected = dict.fromkeys(samples, 0)
+        phase = "healthy"
+        loop = asyncio.get_running_loop()
+        stop = loop.time() + 2 * phase_seconds
+
+        async def client():
+            while loop.time() < stop:
+                start = loop.time()
+                try:
+                    await call()
+                except decorators.BulkheadFullError:
+                    rejected[phase] += 1
+                    await asyncio.sleep(0.005)
+                    continue
+                samples[phase].append(loop.time() - start)
+
+        tasks = [asyncio.ensure_future(client()) for _ in range(clients)]
+        await asyncio.sleep(phase_seconds)
+        phase = "degraded"
+        backend.degrade(8, 0.010)
+        await asyncio.gather(*tasks)
+        limit = getattr(call, "limiter", None) or call.bulkhead
+        for name, values in samples.items():
+            values.sort()
+            print(f"{label:<14} {name:<9} {len(values) / phase_seconds:>7.0f} "
+                  f"{rejected[name]:>9} {values[len(values) // 2] * 1e3:>7.1f} "
+                  f"{values[int(len(values) * 0.99)] * 1e3:>8.1f} "
+                  f"{limit.max_concurrent:>6}")
+
+    asyncio.run(run("fixed 64", lambda f: decorators.bulkhead(64)(f)))
+    asyncio.run(run("adaptive", lambda f: decorators.adaptive_limit(16)(f)))
+
+
+def bench_hedged(calls=4000, clients=32, slow_fraction=0.03):
+    """
+    Client-side latency against a backend with a heavy tail, with and
+    without hedging. Each attempt independently takes 2ms, or 60ms with
+    probability ``slow_fraction`` (a GC pause or a slow replica), so a
+    backup attempt almost always lands on the fast path.
+    """
+    print(f"hedged ({calls} calls, {clients} clients; attempts take 2ms, "
+          f"{slow_fraction:.0%} take 60ms)")
+    print(f"{'hedging':<18} {'p50 ms':>7} {'p99 ms':>7} {'p99.9 ms':>9} "
+          f"{'attempts/call':>14} {'hedge wins':>11}")
+
+    async def run(label, wrap):
+        attempts = 0
+
+        async def backend():
+            nonlocal attempts
+            attempts += 1
+            slow = random.random() < slow_fraction
+            await asyncio.sleep(0.060 if slow else 0.002 * random.uniform(0.8, 1.2))
+            return slow
+
+        call = wrap(backend)
+        loop = asyncio.get_running_loop()
+        remaining = calls
+        latencies = []
+
+        async def client():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                start = loop.time()
+                await call()
+                latencies.append(loop.time() - start)
+
+        await asyncio.gather(*(client() for _ in range(clients)))
+        latencies.sort()
+        info = getattr(call, "hedge_info", None)
+        wins = f"{info().hedge_wins:>11}" if info else f"{'-':>11}"
+        print(f"{label:<18} {latencies[len(latencies) // 2] * 1e3:>7.1f} "
+              f"{latencies[int(len(latencies) * 0.99)] * 1e3:>7.1f} "
+              f"{latencies[int(len(latencies) * 0.999)] * 1e3:>9.1f} "
+              f"{attempts / calls:>14.3f} {wins}")
+
+    asyncio.run(run("none", lambda f: f))
+    asyncio.run(run("fixed 5ms", decorators.hedged(delay=0.005)))
+    asyncio.run(run("p95", decorators.hedged()))
+    asyncio.run(run("p95, no budget", decorators.hedged(budget=None)))
+
+
+def bench_key_building(repeat=200):
+    """Cost of KeyBuilder on large arguments vs the old tuple keys."""
+    def target(data, scale=1):
+        return data
+
+    build = decorators.KeyBuilder(target)
+    cases = {
+        "2 scalars": ((1.5,), {"scale": 3}),
+        "tuple of 10k ints": ((tuple(range(10_000)),), {}),
+        "list of 10k ints": (([*range(10_000)],), {}),
+        "dict of 1k str->int": (({str(i): i for i in range(1000)},), {}),
+        "bytearray 1 MiB": ((bytearray(1 << 20),), {}),
+    }
+    try:
+        import numpy
+        cases["ndarray 1M float64"] = ((numpy.zeros(1 << 20),), {})
+    except ImportError:
+        pass
+    digest = "xxhash" if decorators.xxhash is not None else "blake2b"
+    print(f"key building ({digest} buffer digests), us per key")
+    print(f"{'argument':<22} {'KeyBuilder':>11} {'old key':>9}")
+    for name, (args, kwargs) in cases.items():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            build(args, kwargs)
+        new = (time.perf_counter() - start) / repeat
+        try:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                hash((args, tuple(sorted(kwargs.items()))))
+            old = f"{(time.perf_counter() - start) / repeat * 1e6:>9.1f}"
+        except TypeError:
+            old = f"{'TypeError':>9}"
+        print(f"{name:<22} {new * 1e6:>11.1f} {old}")
+
+
+# ---------------------------------------------------------
+# Overhead suite
+# ---------------------------------------------------------
+
+def _identity(x):
+    return x
+
+
+async def _aidentity(x):
+    return x
+
+
+class _Client:
+    def __init__(self, name="default"):
+        self.name = name
+
+
+def sync_cases():
+    """name -> (decorated callable, args): each decorator alone and stacked."""
+    user = {"id": 1, "roles": ["admin"]}
+    return {
+        "baseline": (_identity, (1,)),
+        "log_calls": (decorators.log_calls(_identity), (1,)),
+        "timed": (decorators.timed(_identity), (1,)),
+        "timeit": (decorators.timeit()(_identity), (1,)),
+        "profiled(unsampled)": (decorators.profiled(sample_rate=0.0)(_identity), (1,)),
+        "retry": (decorators.retry(times=3, delay=0)(_identity), (1,)),
+        "retry_backoff": (decorators.retry_backoff(times=3, base_delay=0)(_identity), (1,)),
+        "cache(hit)": (decorators.cache(_identity), (1,)),
+        "cache(tinylfu,hit)": (decorators.cache(policy="tinylfu")(_identity), (1,)),
+        "memoize_with_ttl(hit)": (decorators.memoize_with_ttl(ttl=3600)(_identity), (1,)),
+        "single_flight": (decorators.single_flight(_identity), (1,)),
+        "circuit_breaker": (decorators.circuit_breaker()(_identity), (1,)),
+        "rate_limit": (decorators.rate_limit(1e12)(_identity), (1,)),
+        "bulkhead": (decorators.bulkhead(64)(_identity), (1,)),
+        "with_timeout": (decorators.with_timeout(10)(_identity), (1,)),
+        "require_role": (decorators.require_role("admin")(_identity), (user,)),
+        "audit": (decorators.audit("READ")(_identity), (user,)),
+        "idempotent(hit)": (decorators.idempotent(_identity), ("key",)),
+        "singleton": (decorators.singleton(_Client), ()),
+        "multiton": (decorators.multiton(_Client), ("a",)),
+        "stack:timed+log_calls+retry+cache": (
+            decorators.timed(decorators.log_calls(decorators.retry(times=3, delay=0)(
+                decorators.cache(_identity)))), (1,)),
+        "compose:timed+log_calls+retry+cache": (
+            decorators.compose(decorators.timed, decorators.log_calls,
+                               decorators.retry(times=3, delay=0),
+                               decorators.cache)(_identity), (1,)),
+        "stack:timed+log_calls+retry": (
+            decorators.timed(decorators.log_calls(
+                decorators.retry(times=3, delay=0)(_identity))), (1,)),
+        "compose:timed+log_calls+retry": (
+            decorators.compose(decorators.timed, decorators.log_calls,
+                               decorators.retry(times=3, delay=0))(_identity), (1,)),
+    }
+
+
+def async_cases():
+    """name -> (decorated coroutine function, args)."""
+    return {
+        "baseline": (_aidentity, (1,)),
+        "async_timed": (decorators.async_timed()(_aidentity), (1,)),
+        "timeit": (decorators.timeit()(_aidentity), (1,)),
+        "async_retry": (decorators.async_retry(times=3, base_delay=0)(_aidentity), (1,)),
+        "with_timeout": (decorators.with_timeout(10)(_aidentity), (1,)),
+        "async_rate_limit": (decorators.async_rate_limit(1e12)(_aidentity), (1,)),
+        "async_cache(hit)": (decorators.async_cache(_aidentity), (1,)),
+        "single_flight": (decorators.single_flight(_aidentity), (1,)),
+        "circuit_breaker": (decorators.circuit_breaker()(_aidentity), (1,)),
+        "bulkhead": (decorators.bulkhead(64)(_aidentity), (1,)),
+        "stack:async_timed+async_retry+async_cache": (
+            decorators.async_timed()(decorators.async_retry(times=3, base_delay=0)(
+                decorators.async_cache(_aidentity))), (1,)),
+    }
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    return {"p50_ns": samples[len(samples) // 2],
+            "p99_ns": samples[int(len(samples) * 0.99)],
+            "max_ns": samples[-1]}
+
+
+def _allocations(call, calls=200):
+    """Peak transient and retained bytes per call, via tracemalloc."""
+    tracemalloc.start()
+    try:
+        call()
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+        for _ in range(calls):
+            call()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"peak_alloc_bytes": peak - base,
+            "retained_bytes_per_call": max(0, current - base) / calls}
+
+
+def measure_sync(fn, args, number=20_000, batches=20, singles=2_000):
+    """
+    ns_per_call is the median batch mean (stable enough to gate on); the
+    percentiles come from individually timed calls, minus timer overhead.
+    """
+    clock = time.perf_counter_ns
+    fn(*args)
+    per_batch = number // batches
+    means = []
+    for _ in range(batches):
+        start = clock()
+        for _ in range(per_batch):
+            fn(*args)
+        means.append((clock() - start) / per_batch)
+    timer_cost = min(-clock() + clock() for _ in range(1000))
+    singles_ns = []
+    for _ in range(singles):
+        start = clock()
+        fn(*args)
+        singles_ns.append(max(0, clock() - start - timer_cost))
+    result = {"ns_per_call": sorted(means)[batches // 2]}
+    result.update(_percentiles(singles_ns))
+    result.update(_allocations(lambda: fn(*args)))
+    return result
+
+
+def measure_async(fn, args, number=10_000, batches=20, singles=2_000):
+    """measure_sync for coroutine functions, awaited on one event loop."""
+    clock = time.perf_counter_ns
+
+    async def run():
+        await fn(*args)
+        per_batch = number // batches
+        means = []
+        for _ in range(batches):
+            start = clock()
+            for _ in range(per_batch):
+                await fn(*args)
+            means.append((clock() - start) / per_batch)
+        singles_ns = []
+        for _ in range(singles):
+            start = clock()
+            await fn(*args)
+            singles_ns.append(clock() - start)
+        tracemalloc.start()
+        await fn(*args)
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        await fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result = {"ns_per_call": sorted(means)[batches // 2]}
+        result.update(_percentiles(singles_ns))
+        result["peak_alloc_bytes"] = peak - base
+        return result
+
+    return asyncio.run(run())
+
+
+def measure_contended(fn, args, n_threads=8, calls=5_000):
+    """Wall time per call with n_threads threads calling at once."""
+    elapsed = run_threads(n_threads, lambda: [fn(*args) for _ in range(calls)])
+    return {"ns_per_call": elapsed * 1e9 / (n_threads * calls)}
+
+
+def run_suite(quick=False):
+    """Measure every case; returns {"sync/<case>": {...}, ...}."""
+    scale = 0.2 if quick else 1.0
+    results = {}
+    for name, (fn, args) in sync_cases().items():
+        results[f"sync/{name}"] = measure_sync(fn, args, number=int(20_000 * scale))
+        results[f"threads8/{name}"] = measure_contended(fn, args, calls=int(5_000 * scale))
+    for name, (fn, args) in async_cases().items():
+        results[f"async/{name}"] = measure_async(fn, args, number=int(10_000 * scale))
+    for group in ("sync", "threads8", "async"):
+        base = results[f"{group}/baseline"]["ns_per_call"]
+        for name, result in results.items():
+            if name.startswith(group + "/"):
+                result["overhead_ns"] = result["ns_per_call"] - base
+    return results
+
+
+def compare(results, baseline, threshold=0.25, min_delta_ns=100):
+    """
+    Cases whose ns_per_call grew by more than threshold (a fraction) and by
+    at least min_delta_ns, so noise on very cheap cases does not fail a run.
+    """
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        before, after = old["ns_per_call"], result["ns_per_call"]
+        if after > before * (1 + threshold) and after - before >= min_delta_ns:
+            regressions.append((name, before, after))
+    return regressions
+
+
+def print_suite(results):
+    print(f"{'case':<48} {'ns/call':>8} {'overhead':>9} {'p50':>7} "
+          f"{'p99':>8} {'peak B':>7}")
+    for name, r in results.items():
+        extra = (f"{r['p50_ns']:>7.0f} {r['p99_ns']:>8.0f} {r['peak_alloc_bytes']:>7}"
+                 if "p50_ns" in r else f"{'-':>7} {'-':>8} {'-':>7}")
+        print(f"{name:<48} {r['ns_per_call']:>8.0f} {r['overhead_ns']:>9.0f} {extra}")
+
+
+BENCHMARKS = {
+    "cache_hit_ratio": bench_cache_hit_ratio,
+    "ttl_thread_scaling": bench_ttl_thread_scaling,
+    "rate_limit_10k_tasks": bench_rate_limit_10k_tasks,
+    "metrics_overhead": bench_metrics_overhead,
+    "idempotency_lookup": bench_idempotency_lookup,
+    "singleton_contention": bench_singleton_contention,
+    "tiered_cold_start": bench_tiered_cold_start,
+    "key_building": bench_key_building,
+    "batched_throughput": bench_batched_throughput,
+    "stale_while_revalidate": bench_stale_while_revalidate,
+    "shared_memory_cache": bench_shared_memory_cache,
+    "log_pipeline": bench_log_pipeline,
+    "audit_log": bench_audit_log,
+    "role_check": bench_role_check,
+    "adaptive_limit": bench_adaptive_limit,
+    "hedged": bench_hedged,
+}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("names", nargs="*", help="run benchmarks matching these")
+    parser.add_argument("--suite", action="store_true",
+                        help="run the per-call overhead suite")
+    parser.add_argument("--quick", action="store_true", help="shorter suite run")
+    parser.add_argument("--save", metavar="JSON", help="write suite results")
+    parser.add_argument("--compare", metavar="JSON",
+                        help="fail if a case regressed against this baseline")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed slowdown as a fraction (default: 0.25)")
+    args = parser.parse_args(argv)
+
+    if not (args.suite or args.save or args.compare):
+        selected = [name for name in BENCHMARKS
+                    if not args.names or any(p in name for p in args.names)]
+        for name in selected:
+            BENCHMARKS[name]()
+            print()
+        return 0
+
+    results = run_suite(quick=args.quick)
+    print_suite(results)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "machine": platform.machine(),
+                       "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "results": results}, f, indent=2)
+        print(f"\nsaved {len(results)} cases to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, after in regressions:
+            print(f"REGRESSION {name}: {before:.0f} -> {after:.0f} ns/call "
+                  f"({after / before - 1:+.0%})")
+        if regressions:
+            return 1
+        print(f"\nno regressions beyond {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
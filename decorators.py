@@ -3,219 +3,4040 @@ decorators.py - A collection of production-ready Python decorators.
 """
 
 import functools
+import hashlib
+import inspect
+import json
+import math
+import os
+import pickle
+import pickletools
+import random
+import reprlib
+import sqlite3
+import struct
+import sys
+import tempfile
 import time
 import threading
 import logging
 import asyncio
+import atexit
+import concurrent.futures
+import contextlib
+import contextvars
+import cProfile
+import pstats
+import queue
+import weakref
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from multiprocessing import resource_tracker, shared_memory
+
+try:
+    import xxhash
+except ImportError:  # optional: faster digests of large buffer arguments
+    xxhash = None
+
+try:
+    import fcntl
+except ImportError:  # not POSIX: SharedMemoryCache is unavailable
+    fcntl = None
+
+
+# ---------------------------------------------------------
+# Metrics
+# ---------------------------------------------------------
+
+_SUB_BITS = 4
+_LINEAR_MAX = 1 << (_SUB_BITS + 1)
+_HISTOGRAM_BUCKETS = 1024
+
+
+def _bucket_index(ns):
+    """
+    Log-linear (HDR-style) bucket for a duration in nanoseconds.
+
+    Values under 32ns get exact buckets; above that each power of two is
+    split into 16 linear sub-buckets, so reported values are within ~6%.
+    Any duration below 2**63ns maps under _HISTOGRAM_BUCKETS.
+    """
+    e = ns.bit_length() - _SUB_BITS - 1
+    return (e << _SUB_BITS) + (ns >> e) if e > 0 else ns
+
+
+def _bucket_value(index):
+    """Midpoint in nanoseconds of the values that land in a bucket."""
+    if index < _LINEAR_MAX:
+        return index
+    e = (index >> _SUB_BITS) - 1
+    top = index - (e << _SUB_BITS)
+    return ((top << e) + ((top + 1) << e) - 1) / 2
+
+
+def _new_shard():
+    return [0, 0, 0, 0, [0] * _HISTOGRAM_BUCKETS]  # count, errors, sum, max, buckets
+
+
+class _ShardOwner:
+    """Lives in one thread's _Shard; collected when that thread exits."""
+
+
+class _Shard(threading.local):
+    """
+    One thread's slice of a FunctionMetrics; registered on first use.
+
+    When the thread exits its locals are dropped, and the finalizer on
+    ``owner`` folds the slice into the retired totals, so short-lived
+    threads do not leave a shard behind each.
+    """
+
+    def __init__(self, shards, retired, lock):
+        data = self.data = _new_shard()
+        self.owner = _ShardOwner()
+        with lock:
+            shards[id(data)] = data
+        weakref.finalize(self.owner, _retire_shard, shards, retired, lock, data)
+
+
+def _retire_shard(shards, retired, lock, data):
+    with lock:
+        del shards[id(data)]
+        retired[1] += data[1]
+        retired[2] += data[2]
+        retired[3] = max(retired[3], data[3])
+        buckets = retired[4]
+        for i, n in enumerate(data[4]):
+            if n:
+                buckets[i] += n
+
+
+class FunctionMetrics:
+    """
+    Call count, error count, total/max time and a latency histogram.
+
+    Every thread records into its own shard, so the hot path takes no lock
+    and never loses an update; shards are merged when a snapshot is taken,
+    and an exited thread's shard is folded into a retired total.
+    """
+
+    def __init__(self, name, decorator):
+        self.name = name
+        self.decorator = decorator
+        self._shards = {}  # id -> live thread's shard
+        self._retired = _new_shard()  # sum of the exited threads' shards
+        self._lock = threading.Lock()
+        self._local = _Shard(self._shards, self._retired, self._lock)
+
+    def record(self, ns, failed=False):
+        """Record one call that took ns nanoseconds."""
+        shard = self._local.data
+        shard[2] += ns
+        if failed:
+            shard[1] += 1
+        if ns > shard[3]:
+            shard[3] = ns
+        # _bucket_index inlined, as this is the per-call hot path. The call
+        # count is the histogram total, summed at snapshot time.
+        e = ns.bit_length() - _SUB_BITS - 1
+        if e > 0:
+            shard[4][(e << _SUB_BITS) + (ns >> e)] += 1
+        else:
+            shard[4][ns] += 1
+
+    def snapshot(self, reset=False):
+        count = errors = total = peak = 0
+        buckets = [0] * _HISTOGRAM_BUCKETS
+        # Merged under the lock, so a shard retired mid-snapshot is not
+        # counted both on its own and in the retired totals.
+        with self._lock:
+            for shard in (self._retired, *self._shards.values()):
+                errors += shard[1]
+                total += shard[2]
+                peak = max(peak, shard[3])
+                for i, n in enumerate(shard[4]):
+                    if n:
+                        count += n
+                        buckets[i] += n
+                if reset:
+                    # Zeroed in place: a record racing with the reset may survive it.
+                    shard[:4] = [0, 0, 0, 0]
+                    shard[4][:] = [0] * _HISTOGRAM_BUCKETS
+        snap = {"function": self.name, "decorator": self.decorator,
+                "count": count, "errors": errors,
+                "sum": total / 1e9, "max": peak / 1e9}
+        for label, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            snap[label] = self._quantile(buckets, count, q, peak) / 1e9
+        return snap
+
+    @staticmethod
+    def _quantile(buckets, count, q, peak):
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for i, n in enumerate(buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(_bucket_value(i), peak)
+        return peak
+
+
+class MetricsRegistry:
+    """Per-function metrics recorded by timed, timeit, async_timed and log_calls."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def metric(self, name, decorator):
+        key = (name, decorator)
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, FunctionMetrics(name, decorator))
+        return metric
+
+    def snapshot(self, reset=False):
+        """List of per-function dicts: count, errors, sum, max, p50, p95, p99."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return [m.snapshot(reset) for m in metrics]
+
+    def reset(self):
+        self.snapshot(reset=True)
+
+    def to_json(self, reset=False):
+        return json.dumps(self.snapshot(reset))
+
+    def to_prometheus(self, prefix="decorated", reset=False):
+        """Prometheus text exposition format, one summary per function."""
+        lines = [f"# TYPE {prefix}_call_seconds summary",
+                 f"# TYPE {prefix}_call_errors_total counter"]
+        for snap in self.snapshot(reset):
+            labels = (f'function="{_prometheus_escape(snap["function"])}",'
+                      f'decorator="{snap["decorator"]}"')
+            for label, q in (("p50", "0.5"), ("p95", "0.95"), ("p99", "0.99")):
+                lines.append(f'{prefix}_call_seconds{{{labels},quantile="{q}"}} {snap[label]!r}')
+            lines.append(f"{prefix}_call_seconds_sum{{{labels}}} {snap['sum']!r}")
+            lines.append(f"{prefix}_call_seconds_count{{{labels}}} {snap['count']}")
+            lines.append(f"{prefix}_call_errors_total{{{labels}}} {snap['errors']}")
+        return "\n".join(lines) + "\n"
+
+
+def _prometheus_escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _metric_name(func):
+    return f"{func.__module__}.{func.__qualname__}"
+
+
+metrics = MetricsRegistry()
 
 
 # ---------------------------------------------------------
 # Logging & Performance
 # ---------------------------------------------------------
 
-def log_calls(func):
-    """Log function calls with arguments, return values, and execution time."""
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        start = time.time()
-        result = func(*args, **kwargs)
-        elapsed = time.time() - start
-        logging.info(
-            f"{func.__name__}({args}, {kwargs}) -> {result} [{elapsed:.3f}s]")
-        return result
-    return wrapper
+# Bounded reprs for log lines: large arguments cost a few hundred
+# characters, not a full repr of the object.
+_log_repr = reprlib.Repr()
+_log_repr.maxstring = _log_repr.maxother = 80
+_log_repr.maxlist = _log_repr.maxtuple = _log_repr.maxdict = 8
+_log_repr.maxset = _log_repr.maxfrozenset = 8
+_log_repr.maxlevel = 3
+_LOG_SCALARS = frozenset({int, float, bool, type(None)})
+
+
+def _short_repr(value):
+    """repr() for scalars and short tuples/dicts of them, reprlib otherwise."""
+    kind = type(value)
+    if kind in _LOG_SCALARS:
+        return repr(value)
+    if kind is tuple and len(value) <= 8 and _LOG_SCALARS.issuperset(map(type, value)):
+        return repr(value)
+    if kind is dict and not value:
+        return "{}"
+    return _log_repr.repr(value)
+
+
+def _call_line(func, args, kwargs, result, elapsed):
+    return (f"{func.__name__}({_short_repr(args)}, {_short_repr(kwargs)}) -> "
+            f"{_short_repr(result)} [{elapsed / 1e9:.3f}s]")
+
+
+class LogPipeline:
+    """
+    Non-blocking log sink with a background writer.
+
+    Callers append lines to a deque (no lock taken) and return at once; a
+    daemon thread drains it every ``flush_interval`` seconds, or as soon as
+    ``batch_size`` lines are waiting, and writes each batch with a single
+    call. Once ``max_queue`` lines are waiting, new lines are dropped and
+    counted rather than blocking the caller. A batch the sink fails to
+    write (an OSError from a full disk or a broken socket) is dropped and
+    counted in ``errors``, and the writer carries on with the next one.
+    Queued lines are flushed at interpreter exit.
+
+    Args:
+        sink (str or file or socket): Path to append to, an object with
+            ``write`` (text), or a connected socket (``sendall``, UTF-8).
+        level (int): Lines below this logging level are skipped before
+            any formatting.
+        batch_size (int): Lines per write, and queue length that wakes the
+            writer early.
+        flush_interval (float): Seconds between drains when traffic is light.
+        max_queue (int): Lines held before new ones are dropped.
+    """
+
+    def __init__(self, sink, level=logging.INFO, batch_size=512,
+                 flush_interval=0.05, max_queue=100_000):
+        self.level = level
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.written = self.dropped = self.batches = self.errors = 0
+        self._owned = isinstance(sink, (str, os.PathLike))
+        self._sink = open(sink, "a", encoding="utf-8") if self._owned else sink
+        self._queue = deque()
+        self._wake = threading.Event()
+        self._write_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="log-pipeline", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log(self, line, level=logging.INFO):
+        """Queue a formatted line; check ``level`` first to skip formatting."""
+        if level < self.level:
+            return
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            return
+        self._queue.append((time.time(), level, line))
+        if len(self._queue) >= self.batch_size and not self._wake.is_set():
+            self._wake.set()
+
+    def handler(self):
+        """A logging.Handler that formats records and queues them here."""
+        return _PipelineHandler(self)
+
+    def flush(self):
+        """Write everything queued so far, in the calling thread."""
+        with self._write_lock:
+            queue_ = self._queue
+            while queue_:
+                batch = []
+                try:
+                    for _ in range(self.batch_size):
+                        created, level, line = queue_.popleft()
+                        stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(created))
+                        batch.append(f"{stamp}.{int(created % 1 * 1000):03d} "
+                                     f"{logging.getLevelName(level)} {line}\n")
+                except IndexError:
+                    pass
+                data = "".join(batch)
+                try:
+                    if hasattr(self._sink, "sendall"):
+                        self._sink.sendall(data.encode("utf-8"))
+                    else:
+                        self._sink.write(data)
+                        self._sink.flush()
+                except Exception:
+                    self.errors += 1
+                    self.dropped += len(batch)
+                    continue
+                self.written += len(batch)
+                self.batches += 1
+
+    def close(self):
+        if self._closed:
+            return
+        atexit.unregister(self.close)
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        if self._owned:
+            self._sink.close()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+        self.flush()
+
+
+class _PipelineHandler(logging.Handler):
+    def __init__(self, pipeline):
+        super().__init__(pipeline.level)
+        self.pipeline = pipeline
+
+    def emit(self, record):
+        try:
+            self.pipeline.log(self.format(record), record.levelno)
+        except Exception:
+            self.handleError(record)
+
+
+def log_calls(func=None, *, pipeline=None):
+    """
+    Log function calls with arguments, return values, and execution time.
+
+    Usable bare or as ``@log_calls(pipeline=...)``. Nothing is formatted
+    unless INFO is enabled; arguments and results are shortened with
+    reprlib. With a LogPipeline, lines go to its background writer instead
+    of through logging in the caller's thread.
+    """
+    def decorator(func):
+        metric = metrics.metric(_metric_name(func), "log_calls")
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                metric.record(time.perf_counter_ns() - start, True)
+                raise
+            elapsed = time.perf_counter_ns() - start
+            metric.record(elapsed)
+            if pipeline is not None:
+                if pipeline.level <= logging.INFO:
+                    pipeline.log(_call_line(func, args, kwargs, result, elapsed))
+            elif logging.root.isEnabledFor(logging.INFO):
+                logging.info(_call_line(func, args, kwargs, result, elapsed))
+            return result
+        return wrapper
+
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+def timed(func):
+    """Measure execution time of a function into the metrics registry."""
+    metric = metrics.metric(_metric_name(func), "timed")
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException:
+            metric.record(time.perf_counter_ns() - start, True)
+            raise
+        elapsed = time.perf_counter_ns() - start
+        metric.record(elapsed)
+        if logging.root.isEnabledFor(logging.INFO):
+            logging.info(f"{func.__name__} took {elapsed / 1e9:.4f} seconds")
+        return result
+    return wrapper
+
+
+# Held while any sampled call is being profiled. One profiler at a time
+# process-wide: a nested sample would replace the active profiler, and on
+# Python 3.12+ cProfile uses the interpreter-wide sys.monitoring slot, so a
+# second thread's enable() would raise.
+_profiling = threading.Lock()
+
+
+def _frame_label(func):
+    """'file.py:name:line' for a pstats function key (built-ins keep their name)."""
+    filename, lineno, name = func
+    label = name if filename == "~" else f"{os.path.basename(filename)}:{name}:{lineno}"
+    return label.replace(";", ",")
+
+
+class SampledProfile:
+    """
+    cProfile results of the sampled calls of one function, merged in memory.
+
+    ``stats()`` returns the merged pstats.Stats, ``dump_stats(path)`` writes
+    a pstats file and ``collapsed()`` returns collapsed stacks
+    ("a;b;c <microseconds>" per line) for flame graph tools. cProfile keeps
+    caller/callee pairs, not whole stacks, so a function reached from
+    several callers has its subtree split between them in proportion to
+    the time each caller spent in it.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.sampled = 0
+        self._stats = None
+        self._lock = threading.Lock()
+
+    def add(self, profiler):
+        with self._lock:
+            self.sampled += 1
+            if self._stats is None:
+                self._stats = pstats.Stats(profiler)
+            else:
+                self._stats.add(profiler)
+
+    def stats(self):
+        return self._stats
+
+    def reset(self):
+        with self._lock:
+            self.sampled = 0
+            self._stats = None
+
+    def dump_stats(self, path):
+        with self._lock:
+            if self._stats is not None:
+                self._stats.dump_stats(path)
+
+    def collapsed(self):
+        with self._lock:
+            if self._stats is None:
+                return ""
+            table = dict(self._stats.stats)
+        children = {}
+        for func, (_, _, _, _, callers) in table.items():
+            for caller, edge in callers.items():
+                children.setdefault(caller, []).append((func, edge[2], edge[3]))
+        lines = {}
+
+        def walk(func, path, tottime, cumtime, on_path):
+            if tottime > 0:
+                lines[path] = lines.get(path, 0) + tottime
+            total = table[func][3]
+            scale = cumtime / total if total else 0.0
+            for callee, edge_tt, edge_ct in children.get(func, ()):
+                if callee not in on_path:
+                    walk(callee, f"{path};{_frame_label(callee)}", edge_tt * scale,
+                         edge_ct * scale, on_path | {callee})
+
+        for func, (_, _, tottime, cumtime, callers) in table.items():
+            if not callers and "_lsprof.Profiler" not in func[2]:
+                walk(func, _frame_label(func), tottime, cumtime, {func})
+        return "".join(f"{path} {round(seconds * 1e6)}\n"
+                       for path, seconds in sorted(lines.items())
+                       if round(seconds * 1e6) > 0)
+
+    def write_collapsed(self, path):
+        with open(path, "w") as f:
+            f.write(self.collapsed())
+
+
+def profiled(sample_rate=0.01):
+    """
+    Profile a random ``sample_rate`` fraction of calls with cProfile.
+
+    Unsampled calls cost one random() draw. Results are merged per function
+    into ``wrapper.profile`` (a SampledProfile). Only one call is profiled
+    at a time in the whole process; a call sampled while another one (on
+    any thread), or an outside profiler, is active runs unprofiled. For
+    coroutine functions the profiler stays on across awaits, so a sample
+    also includes whatever other tasks ran on the loop meanwhile.
+    """
+    def decorator(func):
+        profile = SampledProfile(_metric_name(func))
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if random.random() >= sample_rate or not _profiling.acquire(False):
+                    return await func(*args, **kwargs)
+                profiler = cProfile.Profile()
+                try:
+                    profiler.enable()
+                except ValueError:  # another profiler holds the slot
+                    _profiling.release()
+                    return await func(*args, **kwargs)
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    profiler.disable()
+                    _profiling.release()
+                    profile.add(profiler)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if random.random() >= sample_rate or not _profiling.acquire(False):
+                    return func(*args, **kwargs)
+                profiler = cProfile.Profile()
+                try:
+                    profiler.enable()
+                except ValueError:  # another profiler holds the slot
+                    _profiling.release()
+                    return func(*args, **kwargs)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    profiler.disable()
+                    _profiling.release()
+                    profile.add(profiler)
+        wrapper.profile = profile
+        return wrapper
+    return decorator
+
+
+# ---------------------------------------------------------
+# Cache Keys
+# ---------------------------------------------------------
+
+_MISSING = object()
+
+# Immutable, hashable types that are used in keys as they are.
+_KEY_SCALARS = frozenset({int, float, complex, str, bytes, bool, type(None)})
+
+_key_types = {}
+
+
+def register_key_type(type_, func):
+    """
+    Register how arguments of type_ become cache-key parts.
+
+    func(value) must return something hashable (and picklable, for
+    tiered_cache) that is equal for arguments that should share a result.
+    """
+    _key_types[type_] = func
+
+
+def _digest(value):
+    """Fixed-size digest of a buffer, read through a memoryview (no copy)."""
+    view = memoryview(value)
+    if not view.c_contiguous:
+        view = memoryview(view.tobytes())
+    if xxhash is not None:
+        return xxhash.xxh3_128_digest(view)
+    return hashlib.blake2b(view, digest_size=16).digest()
+
+
+def _stable_digest(value):
+    """_digest that does not depend on whether xxhash is installed."""
+    view = memoryview(value)
+    if not view.c_contiguous:
+        view = memoryview(view.tobytes())
+    return hashlib.blake2b(view, digest_size=16).digest()
+
+
+class _KeyTag:
+    """
+    Heads a container frozen by freeze_key.
+
+    Private, so no argument a caller passes can freeze to the same key:
+    ``[1, 2]`` and ``(list, (1, 2))`` would collide if the tag were the
+    builtin type. Pickles by name, so it unpickles to the same instance.
+    """
+
+    __slots__ = ("_name",)
+
+    def __init__(self, name):
+        self._name = name
+
+    def __repr__(self):
+        return f"decorators.{self._name}"
+
+    def __reduce__(self):
+        return self._name
+
+
+_LIST_KEY = _KeyTag("_LIST_KEY")
+_DICT_KEY = _KeyTag("_DICT_KEY")
+_SET_KEY = _KeyTag("_SET_KEY")
+_FROZENSET_KEY = _KeyTag("_FROZENSET_KEY")
+_BUFFER_KEY = _KeyTag("_BUFFER_KEY")
+
+
+def _sorted_parts(parts):
+    try:
+        return tuple(sorted(parts))
+    except TypeError:  # mixed, unorderable element types
+        return tuple(sorted(parts, key=repr))
+
+
+def freeze_key(value, digest=_digest):
+    """
+    Canonical hashable form of an argument.
+
+    Scalars pass through; lists, tuples, dicts and sets are converted
+    recursively (dicts and sets in sorted order, so the form does not depend
+    on insertion order); buffers such as bytearray, memoryview and NumPy
+    arrays are reduced to their shape, format and ``digest`` of their bytes.
+    Converted containers are headed by a private _KeyTag.
+    """
+    t = type(value)
+    if t in _KEY_SCALARS:
+        return value
+    custom = _key_types.get(t)
+    if custom is not None:
+        return custom(value)
+    # issuperset(map(type, ...)) keeps the common all-scalar scan in C.
+    if t is tuple:
+        if _KEY_SCALARS.issuperset(map(type, value)):
+            return value
+        return tuple(freeze_key(v, digest) for v in value)
+    if t is list:
+        if _KEY_SCALARS.issuperset(map(type, value)):
+            return (_LIST_KEY, tuple(value))
+        return (_LIST_KEY, tuple(freeze_key(v, digest) for v in value))
+    if t is dict:
+        if (_KEY_SCALARS.issuperset(map(type, value))
+                and _KEY_SCALARS.issuperset(map(type, value.values()))):
+            return (_DICT_KEY, _sorted_parts(value.items()))
+        return (_DICT_KEY, _sorted_parts((freeze_key(k, digest), freeze_key(v, digest))
+                                    for k, v in value.items()))
+    if t is set or t is frozenset:
+        tag = _SET_KEY if t is set else _FROZENSET_KEY
+        if _KEY_SCALARS.issuperset(map(type, value)):
+            return (tag, _sorted_parts(value))
+        return (tag, _sorted_parts(freeze_key(v, digest) for v in value))
+    if hasattr(value, "__array_interface__"):
+        return (_BUFFER_KEY, t, value.dtype.str, value.shape, digest(value))
+    if t is bytearray or t is memoryview:
+        view = memoryview(value)
+        return (_BUFFER_KEY, t, view.format, view.shape, digest(view))
+    for base in t.__mro__[1:]:
+        if base in _key_types:
+            return _key_types[base](value)
+    try:
+        hash(value)
+    except TypeError:
+        raise TypeError(
+            f"Cannot build a cache key from {t.__name__!r}; "
+            f"register one with register_key_type()") from None
+    return value
+
+
+class KeyBuilder:
+    """
+    Builds canonical cache keys for calls to one function.
+
+    Calls are normalized against the signature first, so ``f(1, 2)``,
+    ``f(1, b=2)`` and ``f(1)`` (with ``b=2`` as the default) share a key.
+    Plain positional-or-keyword signatures take a fast path that skips
+    inspect.Signature.bind; calls with only scalar arguments skip freezing.
+
+    Args:
+        func (callable): Function whose calls are keyed.
+        key (callable, optional): Custom key function called with the call's
+            arguments; replaces normalization and freezing entirely.
+        stable (bool): Digest buffers the same way in every process, for
+            keys that are shared or persisted (see _stable_hash).
+    """
+
+    def __init__(self, func, key=None, stable=False):
+        self.custom = key
+        self._digest = _stable_digest if stable else _digest
+        try:
+            self._signature = inspect.signature(func)
+        except (TypeError, ValueError):  # some builtins have no signature
+            self._signature = None
+        params = list(self._signature.parameters.values()) if self._signature else []
+        self._simple = self._signature is not None and all(
+            p.kind is p.POSITIONAL_OR_KEYWORD for p in params)
+        self._names = {p.name: i for i, p in enumerate(params)}
+        self._defaults = tuple(
+            _MISSING if p.default is p.empty else p.default for p in params)
+
+    def __call__(self, args, kwargs):
+        if self.custom is not None:
+            return self.custom(*args, **kwargs)
+        if self._simple and len(args) <= len(self._defaults):
+            values = self._positional(args, kwargs)
+        else:
+            values = self._bound(args, kwargs)
+        if _KEY_SCALARS.issuperset(map(type, values)):
+            return values
+        return freeze_key(values, self._digest)
+
+    def _positional(self, args, kwargs):
+        if not kwargs:
+            return args + self._defaults[len(args):]
+        values = list(args) + list(self._defaults[len(args):])
+        for name, value in kwargs.items():
+            i = self._names.get(name)
+            if i is None or i < len(args):
+                return self._bound(args, kwargs)  # the call itself will fail
+            values[i] = value
+        return tuple(values)
+
+    def _bound(self, args, kwargs):
+        try:
+            bound = self._signature.bind(*args, **kwargs)
+        except (AttributeError, TypeError):  # no signature, or a bad call
+            return (args, tuple(sorted(kwargs.items())))
+        bound.apply_defaults()
+        return (bound.args, tuple(sorted(bound.kwargs.items())))
+
+
+# ---------------------------------------------------------
+# Cache Engines
+# ---------------------------------------------------------
+
+CacheInfo = namedtuple(
+    "CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize", "currbytes"])
+
+
+class _CacheEngine:
+    """
+    Bookkeeping shared by the bounded caches: stats, byte budget and locking.
+
+    Subclasses provide the eviction policy through ``_lookup``, ``_insert``,
+    ``_evict``, ``_remove`` and ``_clear``; every one of them must be O(1).
+
+    Args:
+        maxsize (int, optional): Maximum number of entries (None = unbounded).
+        maxbytes (int, optional): Maximum total size of stored values in bytes.
+        sizeof (callable): Size estimate for a value (default: sys.getsizeof).
+    """
+
+    def __init__(self, maxsize=128, maxbytes=None, sizeof=sys.getsizeof):
+        if maxsize is not None and maxsize <= 0:
+            raise ValueError("maxsize must be a positive integer or None")
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.hits = self.misses = self.evictions = 0
+        self.currbytes = 0
+        self._sizes = {}
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store a value; returns False if it can never fit the byte budget."""
+        size = 0
+        if self.maxbytes is not None:
+            size = self.sizeof(value)
+            if size > self.maxbytes:
+                return False
+        with self._lock:
+            if key not in self and self.maxsize is not None:
+                while len(self) >= self.maxsize:
+                    self._evict_one()
+            self._insert(key, value)
+            if self.maxbytes is not None:
+                self.currbytes += size - self._sizes.get(key, 0)
+                self._sizes[key] = size
+                while self.currbytes > self.maxbytes:
+                    self._evict_one()
+        return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = self._remove(key)
+            if value is _MISSING:
+                return default
+            self.currbytes -= self._sizes.pop(key, 0)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+            self._sizes.clear()
+            self.hits = self.misses = self.evictions = 0
+            self.currbytes = 0
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions,
+                         self.maxsize, len(self), self.currbytes)
+
+    def _evict_one(self):
+        key = self._evict()
+        self.evictions += 1
+        self.currbytes -= self._sizes.pop(key, 0)
+
+
+class LRUCache(_CacheEngine):
+    """Least-recently-used eviction on top of an OrderedDict."""
+
+    def __init__(self, maxsize=128, maxbytes=None, sizeof=sys.getsizeof):
+        super().__init__(maxsize, maxbytes, sizeof)
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def _lookup(self, key):
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return _MISSING
+        return self._data[key]
+
+    def _insert(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+
+    def _evict(self):
+        return self._data.popitem(last=False)[0]
+
+    def _remove(self, key):
+        return self._data.pop(key, _MISSING)
+
+    def _clear(self):
+        self._data.clear()
+
+
+class LFUCache(_CacheEngine):
+    """
+    Least-frequently-used eviction with O(1) frequency buckets.
+
+    Keys sharing the lowest frequency are evicted in LRU order.
+    """
+
+    def __init__(self, maxsize=128, maxbytes=None, sizeof=sys.getsizeof):
+        super().__init__(maxsize, maxbytes, sizeof)
+        self._data = {}       # key -> [value, freq]
+        self._buckets = {}    # freq -> OrderedDict of keys
+        self._min_freq = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def _unlink(self, key, freq):
+        """Drop key from its bucket; returns True if the bucket emptied."""
+        bucket = self._buckets[freq]
+        del bucket[key]
+        if bucket:
+            return False
+        del self._buckets[freq]
+        return True
+
+    def _touch(self, key, entry):
+        freq = entry[1]
+        if self._unlink(key, freq) and self._min_freq == freq:
+            self._min_freq = freq + 1
+        entry[1] = freq + 1
+        self._buckets.setdefault(freq + 1, OrderedDict())[key] = None
+
+    def _lookup(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return _MISSING
+        self._touch(key, entry)
+        return entry[0]
+
+    def _insert(self, key, value):
+        entry = self._data.get(key)
+        if entry is not None:
+            entry[0] = value
+            self._touch(key, entry)
+            return
+        self._data[key] = [value, 1]
+        self._buckets.setdefault(1, OrderedDict())[key] = None
+        self._min_freq = 1
+
+    def _evict(self):
+        if self._min_freq not in self._buckets:
+            # Size-driven evictions are followed by a freq-1 insert; only the
+            # byte budget can evict twice in a row and needs the rescan.
+            self._min_freq = min(self._buckets)
+        key = next(iter(self._buckets[self._min_freq]))
+        del self._data[key]
+        self._unlink(key, self._min_freq)
+        return key
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return _MISSING
+        self._unlink(key, entry[1])
+        return entry[0]
+
+    def _clear(self):
+        self._data.clear()
+        self._buckets.clear()
+        self._min_freq = 0
+
+
+class _FrequencySketch:
+    """Count-min sketch of 4-bit counters that halves itself periodically."""
+
+    _SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F,
+              0x165667B19E3779F9, 0x27D4EB2F165667C5)
+
+    def __init__(self, capacity):
+        width = 16
+        while width < capacity:
+            width <<= 1
+        self._mask = width - 1
+        self._rows = [[0] * width for _ in self._SEEDS]
+        self._additions = 0
+        self._sample_size = 10 * width
+
+    def _indexes(self, key):
+        h = hash(key)
+        mask = self._mask
+        return [(((h * seed) & 0xFFFFFFFFFFFFFFFF) >> 32) & mask
+                for seed in self._SEEDS]
+
+    def increment(self, key):
+        for row, i in zip(self._rows, self._indexes(key)):
+            if row[i] < 15:
+                row[i] += 1
+        self._additions += 1
+        if self._additions >= self._sample_size:
+            # Aging keeps the sketch responsive to shifts in popularity;
+            # the O(width) pass runs once per 10 * width additions.
+            for row in self._rows:
+                for i, count in enumerate(row):
+                    row[i] = count >> 1
+            self._additions //= 2
+
+    def estimate(self, key):
+        return min(row[i] for row, i in zip(self._rows, self._indexes(key)))
+
+    def clear(self):
+        for row in self._rows:
+            row[:] = [0] * len(row)
+        self._additions = 0
+
+
+class TinyLFUCache(_CacheEngine):
+    """
+    W-TinyLFU: a small LRU admission window in front of a segmented LRU.
+
+    A key evicted from the window only enters the main region if the
+    frequency sketch says it is used more often than the main region's
+    eviction victim, so one-hit wonders cannot flush popular keys.
+    """
+
+    def __init__(self, maxsize=128, maxbytes=None, sizeof=sys.getsizeof):
+        if maxsize is None:
+            raise ValueError("TinyLFU requires a bounded maxsize")
+        super().__init__(maxsize, maxbytes, sizeof)
+        self._window_max = max(1, maxsize // 100)
+        self._main_max = maxsize - self._window_max
+        self._protected_max = int(self._main_max * 0.8)
+        self._window = OrderedDict()
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        self._sketch = _FrequencySketch(maxsize)
+
+    def __len__(self):
+        return len(self._window) + len(self._probation) + len(self._protected)
+
+    def __contains__(self, key):
+        return (key in self._window or key in self._probation
+                or key in self._protected)
+
+    def _main_len(self):
+        return len(self._probation) + len(self._protected)
+
+    def _lookup(self, key):
+        self._sketch.increment(key)
+        for segment in (self._window, self._protected):
+            if key in segment:
+                segment.move_to_end(key)
+                return segment[key]
+        if key in self._probation:
+            value = self._probation.pop(key)
+            self._protected[key] = value
+            if len(self._protected) > self._protected_max:
+                demoted, demoted_value = self._protected.popitem(last=False)
+                self._probation[demoted] = demoted_value
+            return value
+        return _MISSING
+
+    def _insert(self, key, value):
+        for segment in (self._window, self._probation, self._protected):
+            if key in segment:
+                segment[key] = value
+                segment.move_to_end(key)
+                return
+        if len(self._window) >= self._window_max:
+            # Only reached while the main region still has room.
+            candidate, candidate_value = self._window.popitem(last=False)
+            self._probation[candidate] = candidate_value
+        self._window[key] = value
+
+    def _evict(self):
+        if len(self._window) >= self._window_max and self._main_len() >= self._main_max:
+            candidate = next(iter(self._window))
+            if not self._probation or (
+                    self._sketch.estimate(candidate) <= self._sketch.estimate(
+                        next(iter(self._probation)))):
+                del self._window[candidate]
+                return candidate
+            victim = self._probation.popitem(last=False)[0]
+            self._probation[candidate] = self._window.pop(candidate)
+            return victim
+        for segment in (self._probation, self._window, self._protected):
+            if segment:
+                return segment.popitem(last=False)[0]
+        raise KeyError("evict from an empty cache")
+
+    def _remove(self, key):
+        for segment in (self._window, self._probation, self._protected):
+            if key in segment:
+                return segment.pop(key)
+        return _MISSING
+
+    def _clear(self):
+        self._window.clear()
+        self._probation.clear()
+        self._protected.clear()
+        self._sketch.clear()
+
+
+_CACHE_POLICIES = {
+    "lru": LRUCache,
+    "lfu": LFUCache,
+    "tinylfu": TinyLFUCache,
+    "w-tinylfu": TinyLFUCache,
+}
+
+
+def make_cache(policy="lru", maxsize=128, maxbytes=None, sizeof=sys.getsizeof):
+    """Build a cache engine by policy name: 'lru', 'lfu' or 'tinylfu'."""
+    try:
+        engine = _CACHE_POLICIES[policy.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown cache policy: {policy!r}") from None
+    return engine(maxsize=maxsize, maxbytes=maxbytes, sizeof=sizeof)
+
+
+TTLCacheInfo = namedtuple(
+    "TTLCacheInfo",
+    ["hits", "misses", "evictions", "expirations", "maxsize", "currsize"])
+
+
+class TTLCache:
+    """
+    Time-to-live cache with proactive expiry on a hashed timer wheel.
+
+    Reads never take the lock: a hit is one dict lookup plus a deadline
+    check, both atomic under the GIL. Writes take the lock and advance the
+    wheel, dropping every entry whose slot has passed, so dead entries are
+    removed in amortized O(1) even if their key is never read again. Hit and
+    miss counters are updated without the lock and are approximate under
+    heavy contention.
+
+    Args:
+        ttl (float): Default time-to-live in seconds.
+        maxsize (int, optional): Maximum number of entries; the oldest
+            insertion is evicted first (None = unbounded).
+        resolution (float, optional): Wheel slot width in seconds
+            (default: ttl / 64).
+        timer (callable): Clock returning seconds (default: time.monotonic).
+    """
+
+    def __init__(self, ttl, maxsize=None, resolution=None, timer=time.monotonic):
+        if maxsize is not None and maxsize <= 0:
+            raise ValueError("maxsize must be a positive integer or None")
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.timer = timer
+        self._resolution = resolution or max(ttl / 64, 0.001)
+        self._data = {}     # key -> (value, expires_at), in insertion order
+        self._wheel = {}    # slot -> keys expiring before the slot starts
+        self._slot = int(timer() // self._resolution)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and entry[1] > self.timer()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        now = self.timer()
+        if entry is not None and entry[1] > now:
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        # Opportunistic sweep; readers never wait on a writer.
+        if self._lock.acquire(blocking=False):
+            try:
+                self._expire(now)
+            finally:
+                self._lock.release()
+        return default
+
+    def put(self, key, value, ttl=None):
+        """Store a value, optionally overriding the default TTL for this entry."""
+        with self._lock:
+            now = self.timer()
+            self._expire(now)
+            expires = now + (self.ttl if ttl is None else ttl)
+            if self._data.pop(key, None) is None and self.maxsize is not None:
+                while len(self._data) >= self.maxsize:
+                    del self._data[next(iter(self._data))]
+                    self.evictions += 1
+            self._data[key] = (value, expires)
+            self._wheel.setdefault(int(expires // self._resolution) + 1, []).append(key)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def expire(self):
+        """Drop every expired entry now instead of waiting for the next write."""
+        with self._lock:
+            self._expire(self.timer())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._wheel.clear()
+            self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def info(self):
+        return TTLCacheInfo(self.hits, self.misses, self.evictions,
+                            self.expirations, self.maxsize, len(self._data))
+
+    def _expire(self, now):
+        current = int(now // self._resolution)
+        if current <= self._slot:
+            return
+        if current - self._slot > len(self._wheel):
+            # Long idle gap: visit occupied slots instead of every tick.
+            slots = [slot for slot in self._wheel if slot <= current]
+        else:
+            slots = range(self._slot + 1, current + 1)
+        for slot in slots:
+            for key in self._wheel.pop(slot, ()):
+                entry = self._data.get(key)
+                # Stale wheel references (overwritten or evicted keys) are skipped.
+                if entry is not None and entry[1] <= now:
+                    del self._data[key]
+                    self.expirations += 1
+        self._slot = current
+
+
+_F64 = struct.Struct("<d")
+
+
+def _encode_key(obj, out):
+    """
+    Append a canonical, type-tagged encoding of a frozen key to ``out``.
+
+    Equal keys encode equally: numbers by value (``1``, ``1.0`` and ``True``
+    are one key, as in a dict), strings by their UTF-8 bytes, and tuples
+    element by element. Anything else falls back to an optimized pickle,
+    which drops pickle's identity-dependent memo references.
+    """
+    t = type(obj)
+    if t is str:
+        data = obj.encode("utf-8", "surrogatepass")
+        out += b"s%d:" % len(data)
+        out += data
+    elif t is tuple:
+        out += b"(%d:" % len(obj)
+        for item in obj:
+            _encode_key(item, out)
+    elif t is int or t is bool:
+        out += b"i%d;" % obj
+    elif t is float:
+        if obj.is_integer():
+            out += b"i%d;" % obj
+        else:
+            out += b"f" + _F64.pack(obj)
+    elif t is bytes:
+        out += b"b%d:" % len(obj)
+        out += obj
+    elif obj is None:
+        out += b"N"
+    elif t is complex and obj.imag == 0:
+        _encode_key(obj.real, out)
+    elif t is _KeyTag:
+        out += b"k%d:" % len(obj._name)
+        out += obj._name.encode()
+    elif isinstance(obj, type):
+        data = f"{obj.__module__}.{obj.__qualname__}".encode()
+        out += b"t%d:" % len(data)
+        out += data
+    else:
+        data = pickletools.optimize(pickle.dumps(obj, protocol=4))
+        out += b"p%d:" % len(data)
+        out += data
+
+
+def _stable_hash(obj):
+    """Content hash of a frozen key that is stable across processes."""
+    out = bytearray()
+    _encode_key(obj, out)
+    return hashlib.blake2b(out, digest_size=16).digest()
+
+
+class DiskCache:
+    """
+    Pickled results in a SQLite file, shared by every process on the host.
+
+    WAL mode lets processes read while another writes; writers wait up to
+    ``timeout`` seconds for the file lock. Values larger than
+    ``compress_threshold`` bytes are zlib-compressed. Each thread (and each
+    process after a fork) opens its own connection.
+
+    Args:
+        path (str): Database file.
+        ttl (float, optional): Seconds an entry stays valid (wall clock).
+        max_entries (int, optional): Oldest entries beyond this are trimmed
+            every ``trim_every`` writes.
+        compress_threshold (int): Pickled size above which values are compressed.
+        timeout (float): Seconds to wait for another process's write lock.
+    """
+
+    def __init__(self, path, ttl=None, max_entries=None, compress_threshold=4096,
+                 timeout=30, trim_every=1000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.compress_threshold = compress_threshold
+        self.timeout = timeout
+        self.trim_every = trim_every
+        self.hits = self.misses = 0
+        self._local = threading.local()
+        self._writes = 0
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache ("
+                         "key BLOB PRIMARY KEY, value BLOB, compressed INTEGER, "
+                         "stored REAL, expires REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_stored ON cache (stored)")
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def get(self, key, default=None):
+        """Look up a bytes key (see _stable_hash)."""
+        row = self._connection().execute(
+            "SELECT value, compressed FROM cache WHERE key = ? "
+            "AND (expires IS NULL OR expires > ?)", (key, time.time())).fetchone()
+        if row is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        data = zlib.decompress(row[0]) if row[1] else row[0]
+        return pickle.loads(data)
+
+    def put(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        compressed = len(data) > self.compress_threshold
+        if compressed:
+            data = zlib.compress(data)
+        now = time.time()
+        expires = None if self.ttl is None else now + self.ttl
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                         (key, data, compressed, now, expires))
+            self._writes += 1
+            if self._writes % self.trim_every == 0:
+                self._trim(conn, now)
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM cache")
+
+    def _trim(self, conn, now):
+        conn.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+        if self.max_entries is not None:
+            conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache "
+                         "ORDER BY stored DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=self.timeout)
+            self._local.pid = os.getpid()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+
+_SHM_MAGIC = b"DSHMC001"
+_SHM_HEADER = struct.Struct("<8sIIII")  # magic, buckets, ways, slot_size, stripes
+_SHM_HEADER_SIZE = 64
+# seq (odd while a writer is inside), key digest, expires, stored, length
+_SHM_SLOT = struct.Struct("<Q16sddI4x")
+_SHM_SEQ = struct.Struct("<Q")
+_SHM_EMPTY = bytes(16)
+# Reads of a slot whose sequence stays odd this many times give up and
+# count as a miss: the writer may have died inside the slot.
+_SHM_READ_RETRIES = 1000
+
+
+class SharedMemoryCache:
+    """
+    Pickled results in a multiprocessing.shared_memory segment.
+
+    Every process that opens the same ``name`` maps the same table, so
+    worker processes see each other's results without a server process.
+    The table has ``buckets`` buckets of ``ways`` slots, and each slot
+    owns a fixed ``slot_size`` byte slab for its value. A key is probed
+    only within its own bucket. Values that do not fit a slab are not
+    cached. A full bucket evicts its oldest entry.
+
+    Reads take no lock. Each slot carries a sequence number that writers
+    make odd while they work, and a reader retries if the number was odd
+    or changed under it (a seqlock). A slot that stays odd, as when its
+    writer was killed mid-write, reads as a miss until the next write
+    repairs it. Writers lock the bucket's stripe,
+    with a thread lock inside the process and an fcntl byte-range lock on
+    a lock file across processes (POSIX only). The segment is removed when
+    the process that created it exits normally, or on ``unlink()``.
+
+    Args:
+        name (str): Segment name shared by the processes.
+        buckets (int): Number of buckets.
+        ways (int): Slots per bucket.
+        slot_size (int): Largest pickled value that is cached, in bytes.
+        ttl (float, optional): Seconds an entry stays valid (wall clock).
+        stripes (int): Number of writer locks.
+    """
+
+    def __init__(self, name, buckets=4096, ways=8, slot_size=1024, ttl=None,
+                 stripes=64):
+        if fcntl is None:
+            raise RuntimeError("SharedMemoryCache needs fcntl (POSIX only)")
+        self.name = name
+        self.buckets = buckets
+        self.ways = ways
+        self.slot_size = slot_size
+        self.ttl = ttl
+        self.stripes = stripes
+        self.hits = self.misses = self.evictions = self.oversize = 0
+        self._stride = (_SHM_SLOT.size + slot_size + 7) & ~7
+        size = _SHM_HEADER_SIZE + buckets * ways * self._stride
+        try:
+            self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            self._shm = self._attach(name)
+        else:
+            # Geometry first, magic last: an opener that sees the magic
+            # also sees the geometry it vouches for.
+            _SHM_HEADER.pack_into(self._shm.buf, 0, bytes(8), buckets, ways,
+                                  slot_size, stripes)
+            self._shm.buf[:8] = _SHM_MAGIC
+            atexit.register(self.unlink)
+            # The resource tracker would unlink the segment when any process
+            # that opened it exits; the creator removes it instead (see unlink).
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+        self._buf = self._shm.buf
+        magic, *geometry = _SHM_HEADER.unpack_from(self._buf, 0)
+        if geometry != [buckets, ways, slot_size, stripes]:
+            self._buf = None
+            self._shm.close()
+            raise ValueError(f"shared cache {name!r} exists with geometry {geometry}")
+        self._lockfd = os.open(os.path.join(tempfile.gettempdir(), f"{name}.lock"),
+                               os.O_RDWR | os.O_CREAT, 0o600)
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    @staticmethod
+    def _attach(name, timeout=1.0):
+        """Open a segment another process created, once its header is written."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                shm = shared_memory.SharedMemory(name)
+            except ValueError:  # created but not yet sized
+                shm = None
+            else:
+                resource_tracker.unregister(shm._name, "shared_memory")
+                if (shm.size >= _SHM_HEADER_SIZE
+                        and bytes(shm.buf[:8]) == _SHM_MAGIC):
+                    return shm
+                shm.close()
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"shared cache {name!r} was never initialized")
+            time.sleep(0.001)
+
+    def _slot(self, bucket, way):
+        return _SHM_HEADER_SIZE + (bucket * self.ways + way) * self._stride
+
+    def get(self, key, default=None):
+        """Look up a 16-byte digest key (see _stable_hash)."""
+        buf = self._buf
+        bucket = int.from_bytes(key[:8], "little") % self.buckets
+        for way in range(self.ways):
+            offset = self._slot(bucket, way)
+            for _ in range(_SHM_READ_RETRIES):
+                seq, slot_key, expires, _, length = _SHM_SLOT.unpack_from(buf, offset)
+                if seq & 1:
+                    time.sleep(0)  # a writer is inside; let it finish
+                    continue
+                if slot_key != key:
+                    break
+                start = offset + _SHM_SLOT.size
+                data = bytes(buf[start:start + length])
+                if _SHM_SEQ.unpack_from(buf, offset)[0] == seq:
+                    break
+            else:
+                continue  # never saw a stable slot; skip it
+            if slot_key == _SHM_EMPTY:
+                break  # nothing is ever stored past an empty slot
+            if slot_key == key:
+                if expires and expires <= time.time():
+                    break
+                self.hits += 1
+                return pickle.loads(data)
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.slot_size:
+            self.oversize += 1
+            return
+        bucket = int.from_bytes(key[:8], "little") % self.buckets
+        now = time.time()
+        stripe = bucket % self.stripes
+        with self._locks[stripe]:
+            fcntl.lockf(self._lockfd, fcntl.LOCK_EX, 1, stripe)
+            try:
+                offset = self._pick_slot(bucket, key)
+                buf = self._buf
+                seq = self._begin_write(offset)
+                start = offset + _SHM_SLOT.size
+                buf[start:start + len(data)] = data
+                _SHM_SLOT.pack_into(buf, offset, seq, key,
+                                    now + self.ttl if self.ttl is not None else 0.0,
+                                    now, len(data))
+                _SHM_SEQ.pack_into(buf, offset, seq + 1)
+            finally:
+                fcntl.lockf(self._lockfd, fcntl.LOCK_UN, 1, stripe)
+
+    def _begin_write(self, offset):
+        """
+        Mark the slot busy and return its (odd) sequence; the writer stores
+        ``seq + 1`` when done. Parity is forced rather than incremented, so
+        a slot left odd by a writer that died mid-write is repaired by the
+        next write instead of staying busy for good.
+        """
+        seq = (_SHM_SEQ.unpack_from(self._buf, offset)[0] + 1) | 1
+        _SHM_SEQ.pack_into(self._buf, offset, seq)
+        return seq
+
+    def _pick_slot(self, bucket, key):
+        """The key's slot, else the first empty one, else the oldest (evicted)."""
+        oldest = oldest_stored = None
+        for way in range(self.ways):
+            offset = self._slot(bucket, way)
+            _, slot_key, _, stored, _ = _SHM_SLOT.unpack_from(self._buf, offset)
+            if slot_key == key or slot_key == _SHM_EMPTY:
+                return offset
+            if oldest is None or stored < oldest_stored:
+                oldest, oldest_stored = offset, stored
+        self.evictions += 1
+        return oldest
+
+    def clear(self):
+        for lock in self._locks:
+            lock.acquire()
+        fcntl.lockf(self._lockfd, fcntl.LOCK_EX)  # the whole file: every stripe
+        try:
+            for bucket in range(self.buckets):
+                for way in range(self.ways):
+                    offset = self._slot(bucket, way)
+                    seq = self._begin_write(offset)
+                    _SHM_SLOT.pack_into(self._buf, offset, seq, _SHM_EMPTY, 0.0, 0.0, 0)
+                    _SHM_SEQ.pack_into(self._buf, offset, seq + 1)
+        finally:
+            fcntl.lockf(self._lockfd, fcntl.LOCK_UN)
+            for lock in self._locks:
+                lock.release()
+
+    def info(self):
+        """Hit/miss/eviction counters are this process's; sizes are the table's."""
+        currsize = currbytes = 0
+        for bucket in range(self.buckets):
+            for way in range(self.ways):
+                _, slot_key, _, _, length = _SHM_SLOT.unpack_from(
+                    self._buf, self._slot(bucket, way))
+                if slot_key != _SHM_EMPTY:
+                    currsize += 1
+                    currbytes += length
+        return CacheInfo(self.hits, self.misses, self.evictions,
+                         self.buckets * self.ways, currsize, currbytes)
+
+    def close(self):
+        """Unmap the segment in this process."""
+        atexit.unregister(self.unlink)
+        self._buf = None
+        self._shm.close()
+        os.close(self._lockfd)
+
+    def unlink(self):
+        """Remove the segment; processes that still map it keep their view."""
+        atexit.unregister(self.unlink)
+        try:
+            # SharedMemory.unlink() would also unregister from the tracker.
+            shared_memory._posixshmem.shm_unlink(self._shm._name)
+            os.unlink(os.path.join(tempfile.gettempdir(), f"{self.name}.lock"))
+        except FileNotFoundError:
+            pass
+
+
+# ---------------------------------------------------------
+# Reliability & Caching
+# ---------------------------------------------------------
+
+class DeadlineExceededError(TimeoutError):
+    """Raised when a call starts after its propagated deadline has passed."""
+
+
+# Absolute time.monotonic() deadline of the current request, if any. Being
+# a context variable, it follows tasks and copy_context() into worker threads.
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def remaining_time():
+    """Seconds left before the current deadline, or None if there is none."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """
+    Run a block with at most ``seconds`` of budget.
+
+    Nested blocks and deadline-aware decorators (with_timeout, retry,
+    async_retry) use the smaller of their own limit and the time left, so a
+    caller's budget is never extended further down the stack.
+    """
+    current = _deadline.get()
+    new = time.monotonic() + seconds
+    token = _deadline.set(new if current is None else min(current, new))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def _check_deadline():
+    """Fail fast when the current deadline has already passed."""
+    deadline = _deadline.get()
+    if deadline is not None and time.monotonic() >= deadline:
+        raise DeadlineExceededError("deadline exceeded before the call started")
+
+
+class RetryError(RuntimeError):
+    """Raised when retries are exhausted; the last failure is its __cause__."""
+
+
+class RetryBudget:
+    """
+    Token bucket that caps retries to a fraction of normal traffic.
+
+    Every first attempt deposits ``ratio`` tokens and every retry withdraws
+    one, so during an outage retries add at most ``ratio`` extra load instead
+    of multiplying it. ``min_per_sec`` tokens trickle in regardless, so
+    low-traffic callers can still retry.
+
+    Args:
+        ratio (float): Retries allowed per first attempt.
+        min_per_sec (float): Retries per second always allowed.
+        capacity (float): Maximum number of banked tokens.
+        timer (callable): Clock returning seconds (default: time.monotonic).
+    """
+
+    def __init__(self, ratio=0.1, min_per_sec=1.0, capacity=10.0,
+                 timer=time.monotonic):
+        self.ratio = ratio
+        self.min_per_sec = min_per_sec
+        self.capacity = capacity
+        self.timer = timer
+        self.tokens = capacity
+        self.rejected = 0
+        self._last = timer()
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """Take a token for one retry; returns False if the budget is spent."""
+        with self._lock:
+            now = self.timer()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self._last) * self.min_per_sec)
+            self._last = now
+            if self.tokens < 1:
+                self.rejected += 1
+                return False
+            self.tokens -= 1
+            return True
+
+
+# Shared by every policy created with budget=default_retry_budget.
+default_retry_budget = RetryBudget()
+
+
+class RetryPolicy:
+    """
+    Retry schedule shared by retry, retry_backoff and async_retry.
+
+    Args:
+        times (int): Total attempts, including the first.
+        base_delay (float): Delay before the first retry in seconds.
+        multiplier (float): Delay growth per retry (1 = fixed delay).
+        max_delay (float, optional): Cap on a single delay.
+        jitter (str, optional): None, 'full', 'equal' or 'decorrelated'.
+        deadline (float, optional): Total seconds for all attempts; no retry
+            is started if its delay would cross it, or cross the deadline
+            propagated by ``deadline()`` / ``with_timeout``.
+        retry_on (tuple): Exception types that are retried; others propagate.
+        budget (RetryBudget, optional): Budget every retry must draw from.
+        reraise (bool): Re-raise the last failure instead of RetryError.
+        log_retries (bool): Log a warning before each retry.
+        timer (callable): Clock returning seconds (default: time.monotonic).
+    """
+
+    JITTERS = (None, "full", "equal", "decorrelated")
+
+    def __init__(self, times=3, base_delay=1, multiplier=2, max_delay=None,
+                 jitter=None, deadline=None, retry_on=(Exception,), budget=None,
+                 reraise=False, log_retries=False, timer=time.monotonic):
+        if times < 1:
+            raise ValueError("times must be at least 1")
+        if jitter not in self.JITTERS:
+            raise ValueError(f"Unknown jitter: {jitter!r}")
+        self.times = times
+        self.base_delay = base_delay
+        self.multiplier = multiplier
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.deadline = deadline
+        self.retry_on = retry_on
+        self.budget = budget
+        self.reraise = reraise
+        self.log_retries = log_retries
+        self.timer = timer
+
+    def backoff(self, attempt, previous):
+        """Delay before retry number attempt + 1, given the previous delay."""
+        cap = self.max_delay if self.max_delay is not None else float("inf")
+        if self.jitter == "decorrelated":
+            return min(cap, random.uniform(self.base_delay, previous * 3))
+        delay = min(cap, self.base_delay * self.multiplier ** attempt)
+        if self.jitter == "full":
+            return random.uniform(0, delay)
+        if self.jitter == "equal":
+            return delay / 2 + random.uniform(0, delay / 2)
+        return delay
+
+    def call(self, func, *args, **kwargs):
+        _check_deadline()
+        started, previous = self.timer(), self.base_delay
+        if self.budget is not None:
+            self.budget.deposit()
+        for attempt in range(self.times):
+            try:
+                return func(*args, **kwargs)
+            except self.retry_on as e:
+                delay = self._next_delay(attempt, previous, started, e)
+                if delay is None:
+                    if self.reraise:
+                        raise
+                    raise RetryError("Max retries exceeded") from e
+                time.sleep(delay)
+                previous = delay
+
+    async def call_async(self, func, *args, **kwargs):
+        _check_deadline()
+        started, previous = self.timer(), self.base_delay
+        if self.budget is not None:
+            self.budget.deposit()
+        for attempt in range(self.times):
+            try:
+                return await func(*args, **kwargs)
+            except self.retry_on as e:
+                delay = self._next_delay(attempt, previous, started, e)
+                if delay is None:
+                    if self.reraise:
+                        raise
+                    raise RetryError("Max retries exceeded") from e
+                await asyncio.sleep(delay)
+                previous = delay
+
+    def wrap(self, func):
+        """Decorate a sync or async function with this policy."""
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                return await self.call_async(func, *args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                return self.call(func, *args, **kwargs)
+        wrapper.retry_policy = self
+        return wrapper
+
+    def _next_delay(self, attempt, previous, started, exc):
+        """Delay before the next attempt, or None to give up."""
+        if attempt + 1 >= self.times:
+            return None
+        delay = self.backoff(attempt, previous)
+        if self.deadline is not None and self.timer() - started + delay >= self.deadline:
+            return None
+        remaining = remaining_time()
+        if remaining is not None and delay >= remaining:
+            return None
+        if self.budget is not None and not self.budget.withdraw():
+            return None
+        if self.log_retries:
+            logging.warning(
+                f"Retry {attempt+1}/{self.times} in {delay}s due to {exc}")
+        return delay
+
+
+def retry(times=3, delay=1, **options):
+    """Retry function on failure with fixed delay (options: see RetryPolicy)."""
+    policy = RetryPolicy(times, delay, multiplier=1, reraise=True, **options)
+    return policy.wrap
+
+
+def retry_backoff(times=3, base_delay=1, **options):
+    """Retry with exponential backoff (options: see RetryPolicy)."""
+    options.setdefault("log_retries", True)
+    policy = RetryPolicy(times, base_delay, **options)
+    return policy.wrap
+
+
+def cache(func=None, *, maxsize=128, maxbytes=None, policy="lru",
+          sizeof=sys.getsizeof, key=None):
+    """
+    Bounded in-memory cache decorator.
+
+    Usable bare (``@cache``) or configured (``@cache(maxsize=1024, policy="lfu")``).
+    The wrapper exposes ``cache_info()`` and ``cache_clear()``. Coroutine
+    functions are handed to ``async_cache`` so awaited results are cached.
+
+    Args:
+        maxsize (int, optional): Maximum number of entries (None = unbounded).
+        maxbytes (int, optional): Byte budget for cached results.
+        policy (str): Eviction policy: 'lru', 'lfu' or 'tinylfu'.
+        sizeof (callable): Size estimate for a result (default: sys.getsizeof).
+        key (callable, optional): Custom cache-key function (see KeyBuilder).
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            return async_cache(maxsize=maxsize, maxbytes=maxbytes, policy=policy,
+                               sizeof=sizeof, key=key)(func)
+        engine = make_cache(policy, maxsize, maxbytes, sizeof)
+        make_key = KeyBuilder(func, key)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            k = make_key(args, kwargs)
+            result = engine.get(k, _MISSING)
+            if result is _MISSING:
+                result = func(*args, **kwargs)
+                engine.put(k, result)
+            return result
+        wrapper.cache_info = engine.info
+        wrapper.cache_clear = engine.clear
+        return wrapper
+
+    if func is not None:
+        return decorator(func)
+    # Lets compose() build the same cache without the wrapper.
+    decorator.cache_options = dict(maxsize=maxsize, maxbytes=maxbytes, policy=policy,
+                                   sizeof=sizeof, key=key)
+    return decorator
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(name):
+    """Shared, lazily created worker pool (with_timeout calls, cache refreshes)."""
+    pool = _pools.get(name)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(name)
+            if pool is None:
+                pool = _pools[name] = concurrent.futures.ThreadPoolExecutor(
+                    thread_name_prefix=name)
+    return pool
+
+
+RefreshInfo = namedtuple("RefreshInfo", ["stale_hits", "refreshes", "failures"])
+
+
+def memoize_with_ttl(ttl: int, maxsize=None, ttl_for=None, timer=time.monotonic,
+                     key=None, max_stale=None):
+    """
+    Cache results with TTL (time-to-live).
+
+    Expired entries are removed proactively by a timer wheel (see TTLCache),
+    and the cache is safe to share between threads.
+
+    With ``max_stale`` set, an expired result is still served for up to
+    ``max_stale`` more seconds (stale-while-revalidate) while one refresh
+    per key runs on a shared worker pool. A failed refresh keeps the stale
+    value until that hard limit; ``refresh_info()`` counts stale hits,
+    refreshes and failures.
+
+    Args:
+        ttl (float): Default time-to-live in seconds.
+        maxsize (int, optional): Maximum number of cached results.
+        ttl_for (callable, optional): Returns a per-entry TTL for a result.
+        timer (callable): Clock returning seconds (default: time.monotonic).
+        key (callable, optional): Custom cache-key function (see KeyBuilder).
+        max_stale (float, optional): Seconds an expired result may be served
+            while it is refreshed in the background.
+    """
+    def decorator(func):
+        store = TTLCache(ttl, maxsize=maxsize, timer=timer)
+        make_key = KeyBuilder(func, key)
+
+        if max_stale is None:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                k = make_key(args, kwargs)
+                result = store.get(k, _MISSING)
+                if result is _MISSING:
+                    result = func(*args, **kwargs)
+                    store.put(k, result,
+                              ttl=None if ttl_for is None else ttl_for(result))
+                return result
+            wrapper.cache_info = store.info
+            wrapper.cache_clear = store.clear
+            return wrapper
+
+        refreshing = set()
+        lock = threading.Lock()
+        stats = [0, 0, 0]  # stale hits, refreshes, failures
+
+        def put(k, result):
+            # Entries live until the hard limit and carry their fresh-until time.
+            fresh = ttl if ttl_for is None else ttl_for(result)
+            store.put(k, (timer() + fresh, result), ttl=fresh + max_stale)
+
+        def refresh(k, args, kwargs):
+            try:
+                put(k, func(*args, **kwargs))
+            except Exception:
+                stats[2] += 1
+            finally:
+                with lock:
+                    refreshing.discard(k)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            k = make_key(args, kwargs)
+            entry = store.get(k, _MISSING)
+            if entry is _MISSING:
+                result = func(*args, **kwargs)
+                put(k, result)
+                return result
+            fresh_until, result = entry
+            if fresh_until <= timer():
+                stats[0] += 1
+                with lock:
+                    start = k not in refreshing
+                    if start:
+                        refreshing.add(k)
+                        stats[1] += 1
+                if start:
+                    _get_pool("cache_refresh").submit(refresh, k, args, kwargs)
+            return result
+
+        wrapper.cache_info = store.info
+        wrapper.cache_clear = store.clear
+        wrapper.refresh_info = lambda: RefreshInfo(*stats)
+        return wrapper
+    return decorator
+
+
+def tiered_cache(path, *, maxsize=128, ttl=None, policy="lru",
+                 compress_threshold=4096, max_entries=None, key=None):
+    """
+    Two-tier cache: a bounded in-memory tier in front of a DiskCache.
+
+    Restarted or newly forked workers start warm from the shared disk tier.
+    Disk keys are content hashes of the function's qualified name and its
+    arguments, so arguments must be picklable.
+
+    Args:
+        path (str or DiskCache): Database file, or a DiskCache to share.
+        maxsize (int): Entries kept in the memory tier.
+        ttl (float, optional): Time-to-live in both tiers.
+        policy (str): Memory-tier eviction policy (ignored when ttl is set).
+        compress_threshold (int): Pickled size above which values are compressed.
+        max_entries (int, optional): Bound on the disk tier.
+        key (callable, optional): Custom cache-key function (see KeyBuilder).
+    """
+    disk = path if isinstance(path, DiskCache) else DiskCache(
+        path, ttl=ttl, max_entries=max_entries,
+        compress_threshold=compress_threshold)
+
+    def decorator(func):
+        memory = (TTLCache(ttl, maxsize=maxsize) if ttl is not None
+                  else make_cache(policy, maxsize))
+        namespace = _metric_name(func)
+        make_key = KeyBuilder(func, key, stable=True)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            k = make_key(args, kwargs)
+            result = memory.get(k, _MISSING)
+            if result is _MISSING:
+                digest = _stable_hash((namespace, k))
+                result = disk.get(digest, _MISSING)
+                if result is _MISSING:
+                    result = func(*args, **kwargs)
+                    disk.put(digest, result)
+                memory.put(k, result)
+            return result
+        wrapper.cache_info = memory.info
+        wrapper.cache_clear = memory.clear
+        wrapper.disk = disk
+        return wrapper
+    return decorator
+
+
+def shared_cache(name, *, buckets=4096, ways=8, slot_size=1024, ttl=None, key=None):
+    """
+    Cache results in shared memory, visible to every process on the host.
+
+    Worker processes that decorate the same function with the same
+    ``name`` (for example at import time in a ProcessPoolExecutor worker)
+    read and fill one table instead of each building a private copy.
+    Arguments and results must be picklable; results larger than
+    ``slot_size`` bytes are recomputed every time. See SharedMemoryCache.
+
+    Args:
+        name (str or SharedMemoryCache): Segment name, or a cache to share.
+        buckets, ways, slot_size: Table geometry (see SharedMemoryCache).
+        ttl (float, optional): Seconds an entry stays valid.
+        key (callable, optional): Custom cache-key function (see KeyBuilder).
+    """
+    shared = name if isinstance(name, SharedMemoryCache) else SharedMemoryCache(
+        name, buckets=buckets, ways=ways, slot_size=slot_size, ttl=ttl)
+
+    def decorator(func):
+        namespace = _metric_name(func)
+        make_key = KeyBuilder(func, key, stable=True)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            digest = _stable_hash((namespace, make_key(args, kwargs)))
+            result = shared.get(digest, _MISSING)
+            if result is _MISSING:
+                result = func(*args, **kwargs)
+                shared.put(digest, result)
+            return result
+        wrapper.cache_info = shared.info
+        wrapper.cache_clear = shared.clear
+        wrapper.shared = shared
+        return wrapper
+    return decorator
+
+
+FlightInfo = namedtuple(
+    "FlightInfo", ["calls", "executions", "coalesced", "in_flight"])
+
+
+class _Flight:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _FlightGroup:
+    """Runs one call per key at a time; concurrent callers share its outcome."""
+
+    def __init__(self):
+        self.executions = self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._flights)
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.executions += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn(*args, **kwargs)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+
+
+def single_flight(func=None, *, key=None):
+    """
+    Share one in-flight execution between concurrent identical calls.
+
+    The first caller for a key runs the function; callers arriving while it
+    is running wait for its result (a threading.Event for sync functions, a
+    shared asyncio.Future for coroutines) and see the same exception if it
+    fails. Nothing is kept once the call finishes, so it composes with the
+    caching decorators to close their cold-key gap::
+
+        @cache
+        @single_flight
+        def load(key): ...
+
+    The wrapper exposes ``flight_info()`` with call and coalescing counters.
+    ``key`` is an optional custom key function (see KeyBuilder).
+    """
+    if func is None:
+        return functools.partial(single_flight, key=key)
+    group = _FlightGroup()
+    tasks = {}
+    make_key = KeyBuilder(func, key)
+
+    def flight_info():
+        return FlightInfo(group.executions + group.coalesced, group.executions,
+                          group.coalesced, len(group) + len(tasks))
+
+    def landed(k, task):
+        if tasks.get(k) is task:
+            del tasks[k]
+        if not task.cancelled():
+            task.exception()  # mark retrieved when nobody is waiting
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            k = make_key(args, kwargs)
+            task = tasks.get(k)
+            if task is None:
+                # The flight owns the call, so cancelling any caller, the
+                # first one included, leaves it running for the others.
+                task = tasks[k] = asyncio.ensure_future(func(*args, **kwargs))
+                task.add_done_callback(functools.partial(landed, k))
+                group.executions += 1
+            else:
+                group.coalesced += 1
+            return await asyncio.shield(task)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return group.do(make_key(args, kwargs), func, *args, **kwargs)
+    wrapper.flight_info = flight_info
+    return wrapper
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised when a call is rejected by an open circuit breaker."""
+
+
+BreakerStats = namedtuple(
+    "BreakerStats",
+    ["state", "calls", "failures", "slow_calls", "rejections", "state_changes"])
+
+
+class CircuitBreaker:
+    """
+    Closed / open / half-open circuit breaker.
+
+    The breaker trips on ``fail_max`` consecutive failures, or once
+    ``minimum_calls`` have been seen in the sliding window, on a failure rate
+    or slow-call rate at or above the configured thresholds. The window is a
+    ring of time buckets. After ``reset_timeout`` seconds open, up to
+    ``half_open_calls`` probe calls are let through: all of them succeeding
+    closes the breaker, any failure re-opens it.
+
+    ``state`` and the counters are plain attributes, so reading them (and
+    admitting calls while closed) takes no lock; only recording outcomes
+    and state transitions do. ``allow()`` returns a token naming the state
+    the call was admitted in; an outcome recorded with a token from an
+    earlier state (a call that was still running when the breaker tripped
+    or closed) is counted but does not move the breaker.
+
+    Args:
+        name (str, optional): Name used in errors and the registry.
+        fail_max (int, optional): Consecutive failures that trip the breaker.
+        reset_timeout (float): Seconds to stay open before probing.
+        failure_rate (float, optional): Failure ratio (0-1) that trips it.
+        slow_call_rate (float, optional): Slow-call ratio (0-1) that trips it.
+        slow_call_duration (float, optional): Seconds after which a call is slow.
+        minimum_calls (int): Calls needed in the window before rates apply.
+        window (float): Sliding window length in seconds.
+        buckets (int): Number of time buckets in the window.
+        half_open_calls (int): Probe calls allowed while half-open.
+        on_state_change (callable, optional): Called as f(breaker, old, new).
+        timer (callable): Clock returning seconds (default: time.monotonic).
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name=None, fail_max=3, reset_timeout=10, failure_rate=None,
+                 slow_call_rate=None, slow_call_duration=None, minimum_calls=10,
+                 window=60, buckets=10, half_open_calls=1, on_state_change=None,
+                 timer=time.monotonic):
+        self.name = name
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.slow_call_duration = slow_call_duration
+        self.minimum_calls = minimum_calls
+        self.half_open_calls = half_open_calls
+        self.on_state_change = on_state_change
+        self.timer = timer
+        self.state = self.CLOSED
+        self.calls = self.failures = self.slow_calls = 0
+        self.rejections = self.state_changes = 0
+        self._bucket_width = window / buckets
+        self._ring = [[-1, 0, 0, 0] for _ in range(buckets)]  # epoch, calls, failures, slow
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._probes = self._probe_successes = 0
+        self._generation = 1  # bumped on every transition
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return BreakerStats(self.state, self.calls, self.failures,
+                            self.slow_calls, self.rejections, self.state_changes)
+
+    def allow(self):
+        """
+        Return a (truthy) token if a call may proceed, else False; claims a
+        probe slot when half-open. Pass the token to record() or release().
+        """
+        if self.state is self.CLOSED:
+            return self._generation
+        with self._lock:
+            if self.state is self.OPEN:
+                if self.timer() - self._opened_at < self.reset_timeout:
+                    self.rejections += 1
+                    return False
+                self._transition(self.HALF_OPEN)
+            if self.state is self.HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    self.rejections += 1
+                    return False
+                self._probes += 1
+            return self._generation
+
+    def record(self, duration, failed, token=None):
+        """Record the outcome of a call admitted by allow() with ``token``."""
+        slow = (self.slow_call_duration is not None
+                and duration >= self.slow_call_duration)
+        with self._lock:
+            self.calls += 1
+            self.failures += failed
+            self.slow_calls += slow
+            if token is not None and token != self._generation:
+                return  # admitted before the last transition
+            now = self.timer()
+            bucket = self._bucket(now)
+            bucket[1] += 1
+            bucket[2] += failed
+            bucket[3] += slow
+            self._consecutive = self._consecutive + 1 if failed else 0
+            if self.state is self.HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+                if failed:
+                    self._open(now)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        self._transition(self.CLOSED)
+            elif self.state is self.CLOSED and self._should_trip(now):
+                self._open(now)
+
+    def release(self, token=None):
+        """Give back a probe slot for a call that ended without an outcome."""
+        with self._lock:
+            if (self.state is self.HALF_OPEN and self._probes
+                    and token in (None, self._generation)):
+                self._probes -= 1
+
+    def call(self, func, *args, **kwargs):
+        token = self.allow()
+        if not token:
+            raise CircuitOpenError(f"Circuit {self.name or func.__name__!r} is open")
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record(time.perf_counter() - start, True, token)
+            raise
+        except BaseException:
+            self.release(token)
+            raise
+        self.record(time.perf_counter() - start, False, token)
+        return result
+
+    async def call_async(self, func, *args, **kwargs):
+        token = self.allow()
+        if not token:
+            raise CircuitOpenError(f"Circuit {self.name or func.__name__!r} is open")
+        start = time.perf_counter()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception:
+            self.record(time.perf_counter() - start, True, token)
+            raise
+        except BaseException:
+            self.release(token)
+            raise
+        self.record(time.perf_counter() - start, False, token)
+        return result
+
+    def _bucket(self, now):
+        epoch = int(now // self._bucket_width)
+        bucket = self._ring[epoch % len(self._ring)]
+        if bucket[0] != epoch:
+            bucket[:] = [epoch, 0, 0, 0]
+        return bucket
+
+    def _should_trip(self, now):
+        if self.fail_max is not None and self._consecutive >= self.fail_max:
+            return True
+        if self.failure_rate is None and self.slow_call_rate is None:
+            return False
+        oldest = int(now // self._bucket_width) - len(self._ring)
+        calls = failures = slow = 0
+        for epoch, c, f, s in self._ring:
+            if epoch > oldest:
+                calls += c
+                failures += f
+                slow += s
+        if calls < self.minimum_calls:
+            return False
+        return ((self.failure_rate is not None and failures / calls >= self.failure_rate)
+                or (self.slow_call_rate is not None and slow / calls >= self.slow_call_rate))
+
+    def _open(self, now):
+        self._opened_at = now
+        self._transition(self.OPEN)
+
+    def _transition(self, state):
+        old, self.state = self.state, state
+        self.state_changes += 1
+        self._generation += 1
+        self._probes = self._probe_successes = 0
+        if state is self.CLOSED:
+            self._consecutive = 0
+            for bucket in self._ring:
+                bucket[:] = [-1, 0, 0, 0]
+        if self.on_state_change is not None:
+            self.on_state_change(self, old, state)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name, **options):
+    """Return the registered breaker for name, creating it with options if needed."""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = _breakers[name] = CircuitBreaker(name=name, **options)
+    return breaker
+
+
+def circuit_breaker(fail_max=3, reset_timeout=10, name=None, key=None, **options):
+    """
+    Stop calling a failing function until cooldown period passes.
+
+    Works on sync and async functions. By default each decorated function
+    gets its own breaker (``wrapper.breaker``); ``name`` shares a registered
+    breaker between functions, and ``key`` picks a registered breaker per
+    call, e.g. one per downstream host. Extra options go to CircuitBreaker.
+    """
+    def decorator(func):
+        settings = dict(options, fail_max=fail_max, reset_timeout=reset_timeout)
+        if key is not None:
+            prefix = name or func.__qualname__
+
+            def breaker_for(args, kwargs):
+                return get_breaker((prefix, key(*args, **kwargs)), **settings)
+        else:
+            breaker = (get_breaker(name, **settings) if name is not None
+                       else CircuitBreaker(name=func.__qualname__, **settings))
+
+            def breaker_for(args, kwargs):
+                return breaker
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                return await breaker_for(args, kwargs).call_async(func, *args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                return breaker_for(args, kwargs).call(func, *args, **kwargs)
+        if key is None:
+            wrapper.breaker = breaker
+        return wrapper
+    return decorator
+
+
+# ---------------------------------------------------------
+# Access & Security
+# ---------------------------------------------------------
+
+class AuditLog:
+    """
+    Append-only, segmented JSONL audit log with group commit.
+
+    Each line is ``<crc32 hex> <json>``; the scanner skips (and counts)
+    lines whose checksum does not match, such as a torn last write. A new
+    segment file is started once the current one reaches ``segment_bytes``,
+    and reopening a directory continues its newest segment, unless that
+    segment ends in a partial line, which is left in place for the scanner
+    to skip while appends go to a fresh segment.
+
+    Durability settings for ``append``:
+
+    - ``"none"``: written to the OS on every append, never fsynced.
+    - ``"group"``: append returns once its record is fsynced, but one
+      fsync covers every record that arrived while the previous fsync was
+      running, plus any arriving within an extra ``commit_window`` wait.
+    - ``"always"``: one fsync per record.
+
+    Args:
+        directory (str): Directory holding the segments.
+        durability (str): 'none', 'group' or 'always'.
+        commit_window (float): Extra seconds a group commit waits for more
+            records before its fsync.
+        segment_bytes (int): Segment size that triggers rotation.
+    """
+
+    DURABILITY = ("none", "group", "always")
+
+    def __init__(self, directory, durability="group", commit_window=0.0,
+                 segment_bytes=64 * 1024 * 1024):
+        if durability not in self.DURABILITY:
+            raise ValueError(f"Unknown durability: {durability!r}")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.durability = durability
+        self.commit_window = commit_window
+        self.segment_bytes = segment_bytes
+        self.appended = self.fsyncs = self.corrupt = 0
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(threading.Lock())
+        self._durable = 0  # records up to this sequence number are fsynced
+        self._syncing = False
+        segments = self.segments()
+        self._segment = int(segments[-1][-12:-6]) if segments else 1
+        if segments and not self._ends_with_newline(segments[-1]):
+            # A crash mid-write; the next record would be glued onto it.
+            self._segment += 1
+        self._file = open(self._segment_path(self._segment), "ab")
+
+    @staticmethod
+    def _ends_with_newline(path):
+        with open(path, "rb") as f:
+            if f.seek(0, os.SEEK_END) == 0:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, f"audit-{number:06d}.jsonl")
+
+    def segments(self):
+        """Segment paths, oldest first."""
+        return sorted(os.path.join(self.directory, name)
+                      for name in os.listdir(self.directory)
+                      if name.startswith("audit-") and name.endswith(".jsonl"))
+
+    def append(self, user, action, **fields):
+        """Append one record; returns once it is as durable as configured."""
+        record = {"ts": time.time(), "user": user, "action": action, **fields}
+        payload = json.dumps(record, separators=(",", ":"), default=str).encode()
+        line = b"%08x %s\n" % (zlib.crc32(payload), payload)
+        with self._lock:
+            self._file.write(line)
+            self.appended += 1
+            seq = self.appended
+            if self.durability == "none":
+                self._file.flush()
+            elif self.durability == "always":
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self.fsyncs += 1
+            if self._file.tell() >= self.segment_bytes:
+                self._rotate()
+        if self.durability == "group":
+            self._commit(seq)
+
+    def _rotate(self):
+        # Called with _lock held: the old segment is made durable first.
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.fsyncs += 1
+        self._file.close()
+        with self._synced:
+            self._durable = max(self._durable, self.appended)
+            self._synced.notify_all()
+        self._segment += 1
+        self._file = open(self._segment_path(self._segment), "ab")
+
+    def _commit(self, seq):
+        """Wait until seq is fsynced, leading the next group commit if none is running."""
+        with self._synced:
+            while self._durable < seq:
+                if not self._syncing:
+                    self._syncing = True
+                    break
+                self._synced.wait()
+            else:
+                return
+        synced = None
+        try:
+            if self.commit_window:
+                time.sleep(self.commit_window)  # let more records join this fsync
+            with self._lock:
+                self._file.flush()
+                target = self.appended
+                fd = os.dup(self._file.fileno())  # survives a concurrent rotation
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            synced = target
+        finally:
+            with self._synced:
+                if synced is not None:
+                    self._durable = max(self._durable, synced)
+                    self.fsyncs += 1
+                self._syncing = False
+                self._synced.notify_all()
+
+    def scan(self, user=_MISSING, action=None, since=None, until=None):
+        """
+        Yield records, oldest first, filtered by user, action and time.
+
+        Lines are matched on the raw bytes before being checksummed and
+        parsed, so selective queries only decode the records they return.
+        """
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+        needles = []
+        if user is not _MISSING:
+            needles.append(b'"user":' + json.dumps(user, default=str).encode())
+        if action is not None:
+            needles.append(b'"action":' + json.dumps(action).encode())
+        for path in self.segments():
+            with open(path, "rb") as f:
+                for line in f:
+                    if not all(needle in line for needle in needles):
+                        continue
+                    crc, _, payload = line.rstrip(b"\n").partition(b" ")
+                    try:
+                        valid = int(crc, 16) == zlib.crc32(payload)
+                        record = json.loads(payload) if valid else None
+                    except ValueError:
+                        record = None
+                    if record is None:
+                        self.corrupt += 1
+                        continue
+                    # The byte match is a prefilter ("user":1 also matches 12).
+                    if user is not _MISSING and record["user"] != user:
+                        continue
+                    if action is not None and record["action"] != action:
+                        continue
+                    if since is not None and record["ts"] < since:
+                        continue
+                    if until is not None and record["ts"] >= until:
+                        continue
+                    yield record
+
+    def close(self):
+        with self._lock:
+            self._file.flush()
+            if self.durability != "none":
+                os.fsync(self._file.fileno())
+            self._file.close()
+
+
+class RoleSet(tuple):
+    """
+    Role names stamped by ``RoleRegistry.grant`` with their expanded mask.
+
+    Stored as ``user["roles"]`` once per login or session, it lets
+    require_role read the mask instead of looking the roles up. It is a
+    tuple, so granting or revoking means assigning a new one. A stamp from
+    another registry, or from before a define(), is ignored.
+    """
+
+
+class RoleRegistry:
+    """
+    Interns role names to bit positions and expands role inheritance.
+
+    ``define("admin", inherits=["editor"])`` gives admins every role that
+    editors have, transitively. A user's roles are folded into one integer
+    mask, cached in the registry by the roles themselves (not on the user
+    dict, which callers own), so a role granted or revoked in place takes
+    effect on the next check. ``grant(roles)`` returns the mask already
+    stamped on a RoleSet, which skips even that lookup. Redefining a role,
+    or interning a new one, drops every cached mask and stamp. Roles no
+    check has named are not interned and count for nothing.
+    """
+
+    # Distinct role combinations are few in practice; past this many the
+    # cache is dropped rather than grown without bound.
+    max_cached = 4096
+
+    def __init__(self):
+        self._bits = {}
+        self._inherits = {}
+        self._implied = {}  # role -> own bit | bits of every inherited role
+        self._masks = {}  # tuple of role names -> mask with inheritance
+        self._stamp = object()  # replaced whenever cached masks go stale
+        self.version = 0
+        self._lock = threading.Lock()
+
+    def bit(self, role):
+        bit = self._bits.get(role)
+        if bit is None:
+            with self._lock:
+                bit = self._bits.get(role)
+                if bit is None:
+                    bit = self._bits[role] = 1 << len(self._bits)
+                    # Masks cached before the role existed have 0 for it.
+                    implied = dict(self._implied)
+                    implied[role] = bit
+                    self._publish(implied)
+        return bit
+
+    def _publish(self, implied):
+        # Callers hold the lock. The stamp goes last, so a reader that sees
+        # the new stamp also sees the new tables.
+        self._implied = implied
+        self._masks = {}
+        self.version += 1
+        self._stamp = object()
+
+    def mask(self, roles):
+        """Mask of the given role names, without inheritance."""
+        mask = 0
+        for role in roles:
+            mask |= self.bit(role)
+        return mask
+
+    def define(self, role, inherits=()):
+        """Declare that ``role`` includes the roles in ``inherits``."""
+        for name in (role, *inherits):
+            self.bit(name)
+        with self._lock:
+            self._inherits[role] = tuple(inherits)
+            implied = {}
+            for name in self._bits:
+                mask, stack, seen = 0, [name], set()
+                while stack:
+                    current = stack.pop()
+                    if current not in seen:
+                        seen.add(current)
+                        mask |= self._bits[current]
+                        stack.extend(self._inherits.get(current, ()))
+                implied[name] = mask
+            self._publish(implied)
+
+    def _expand(self, roles):
+        mask, implied = 0, self._implied
+        for role in roles:
+            mask |= implied.get(role, 0)
+        return mask
+
+    def user_mask(self, user):
+        key = tuple(user.get("roles", ()))
+        masks = self._masks
+        mask = masks.get(key)
+        if mask is None:
+            # Built from the tables of one version: _publish() swaps in a
+            # new dict, so a mask computed against stale tables is never
+            # served.
+            mask = self._expand(key)
+            if len(masks) >= self.max_cached:
+                masks.clear()
+            masks[key] = mask
+        return mask
+
+    def grant(self, roles):
+        """Return ``roles`` as a RoleSet stamped with their mask."""
+        granted = RoleSet(roles)
+        granted.stamp = self._stamp  # read first: a racing change leaves it stale
+        granted.mask = self._expand(granted)
+        return granted
+
+
+# Shared by require_role unless another registry is passed.
+roles = RoleRegistry()
+
+
+def require_role(role=None, *, any_of=None, all_of=None, registry=None):
+    """
+    Ensure user has required role before executing function.
+
+    ``require_role("admin")`` needs one role; ``any_of=[...]`` needs at
+    least one of several and ``all_of=[...]`` needs every one. Roles are
+    interned into bits when the decorator is applied, so a check is one
+    AND against the mask stamped on ``user["roles"]`` by
+    ``registry.grant``, or else the registry's cached mask for the user's
+    roles (see RoleRegistry). Roles inherited through ``registry.define``
+    count.
+    """
+    registry = registry if registry is not None else roles
+    if sum(option is not None for option in (role, any_of, all_of)) != 1:
+        raise TypeError("require_role takes exactly one of role, any_of or all_of")
+    every = all_of is not None
+    need = registry.mask(all_of if every else any_of if any_of is not None else (role,))
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(user, *args, **kwargs):
+            granted = user.get("roles", ())
+            if granted.__class__ is RoleSet and granted.stamp is registry._stamp:
+                have = granted.mask
+            else:
+                have = registry._masks.get(tuple(granted))
+                if have is None:
+                    have = registry.user_mask(user)
+            if (have & need != need) if every else not (have & need):
+                raise PermissionError("Access denied")
+            return func(user, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def audit(action: str, pipeline=None, sink=None):
+    """
+    Log security-sensitive actions for auditing.
+
+    The line is only formatted when INFO is enabled; with a LogPipeline it
+    is queued for the background writer instead of logged in the caller.
+    With an AuditLog ``sink``, a durable record (user id, action, function)
+    is appended instead.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(user, *args, **kwargs):
+            result = func(user, *args, **kwargs)
+            if sink is not None:
+                sink.append(user.get("id"), action, function=func.__name__)
+            elif pipeline is not None:
+                if pipeline.level <= logging.INFO:
+                    pipeline.log(f"User={user.get('id')} performed {action} on {func.__name__}")
+            elif logging.root.isEnabledFor(logging.INFO):
+                logging.info(
+                    f"User={user.get('id')} performed {action} on {func.__name__}")
+            return result
+        return wrapper
+    return decorator
+
+
+class MemoryIdempotencyStore:
+    """
+    In-process idempotency store bounded by TTL and size.
+
+    Backed by TTLCache, so lookups are O(1) dict hits at any size and
+    expired keys are dropped without being read again.
+    """
+
+    def __init__(self, ttl=24 * 3600, maxsize=1_000_000, timer=time.monotonic):
+        self._cache = TTLCache(ttl, maxsize=maxsize, timer=timer)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key, default=None):
+        return self._cache.get(key, default)
+
+    def put(self, key, value):
+        self._cache.put(key, value)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class SQLiteIdempotencyStore:
+    """
+    Idempotency store in a local SQLite file, so results survive restarts.
+
+    Rows are keyed by the content hash of the frozen key (see _stable_hash),
+    so equal keys share a row whatever their pickle looks like, and results
+    are pickled. Lookups hit the primary-key index (a B-tree a few pages
+    deep even at millions of keys). Each thread (and each process after a
+    fork) opens its own connection, and expired rows are purged every
+    ``purge_every`` writes.
+
+    Args:
+        path (str): Database file (":memory:" is per-connection, for tests).
+        ttl (float): Seconds a result is remembered.
+        purge_every (int): Writes between purges of expired rows.
+        timer (callable): Wall clock, as entries outlive the process
+            (default: time.time).
+    """
+
+    def __init__(self, path, ttl=24 * 3600, purge_every=1000, timer=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self.timer = timer
+        self._local = threading.local()
+        self._writes = 0
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS idempotency ("
+                         "key BLOB PRIMARY KEY, value BLOB, expires REAL) WITHOUT ROWID")
+
+    def get(self, key, default=None):
+        row = self._connection().execute(
+            "SELECT value FROM idempotency WHERE key = ? AND expires > ?",
+            (self._row_key(key), self.timer())).fetchone()
+        return default if row is None else pickle.loads(row[0])
+
+    def put(self, key, value):
+        now = self.timer()
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO idempotency VALUES (?, ?, ?)",
+                         (self._row_key(key), pickle.dumps(value), now + self.ttl))
+            self._writes += 1
+            if self._writes % self.purge_every == 0:
+                conn.execute("DELETE FROM idempotency WHERE expires <= ?", (now,))
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM idempotency")
+
+    @staticmethod
+    def _row_key(key):
+        return _stable_hash(freeze_key(key, _stable_digest))
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = sqlite3.connect(self.path)
+            self._local.pid = os.getpid()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+
+def idempotent(func=None, *, store=None):
+    """
+    Prevent duplicate processing by enforcing idempotency keys.
+
+    The first argument is the idempotency key. Results are remembered in
+    ``store`` (default: a MemoryIdempotencyStore); a duplicate that arrives
+    while the first call is still running waits for its result instead of
+    running again. The wrapper exposes the store as ``wrapper.store``, and
+    ``flight_info()`` counts the calls that missed it (see single_flight).
+    """
+    def decorator(func):
+        backend = store if store is not None else MemoryIdempotencyStore()
+        group = _FlightGroup()
+
+        def run_once(key, args, kwargs):
+            # Re-checked under the flight: an earlier leader may have just
+            # stored the result between our lookup and taking the lead.
+            result = backend.get(key, _MISSING)
+            if result is _MISSING:
+                result = func(key, *args, **kwargs)
+                backend.put(key, result)
+            return result
+
+        @functools.wraps(func)
+        def wrapper(key, *args, **kwargs):
+            result = backend.get(key, _MISSING)
+            if result is not _MISSING:
+                return result
+            return group.do(key, run_once, key, args, kwargs)
+        wrapper.store = backend
+        wrapper.flight_info = lambda: FlightInfo(
+            group.executions + group.coalesced, group.executions,
+            group.coalesced, len(group))
+        return wrapper
+
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+# ---------------------------------------------------------
+# Async Utilities
+# ---------------------------------------------------------
+
+def async_retry(times=3, base_delay=1, **options):
+    """Retry async functions with exponential backoff (options: see RetryPolicy)."""
+    options.setdefault("log_retries", True)
+    policy = RetryPolicy(times, base_delay, **options)
+
+    def decorator(func):
+        if not asyncio.iscoroutinefunction(func):
+            raise TypeError("async_retry can only be applied to async functions")
+        return policy.wrap(func)
+    return decorator
+
+
+def async_cache(func=None, *, maxsize=128, ttl=None, policy="lru",
+                cache_errors=False, error_ttl=1.0, maxbytes=None,
+                sizeof=sys.getsizeof, timer=time.monotonic, key=None,
+                max_stale=None):
+    """
+    Cache awaited results of a coroutine function.
+
+    Concurrent awaiters of a key that is still being computed share one
+    task, so the coroutine runs once per miss. A cancelled awaiter does not
+    cancel the shared task.
+
+    With ``max_stale`` set, an expired result is still returned for up to
+    ``max_stale`` more seconds while one refresh task per key runs in the
+    background (stale-while-revalidate). A failed refresh is counted in
+    ``refresh_info()`` and leaves the stale result in place.
+
+    Args:
+        maxsize (int, optional): Maximum number of entries (None = unbounded).
+        ttl (float, optional): Time-to-live of a cached result in seconds.
+        policy (str): Eviction policy: 'lru', 'lfu' or 'tinylfu'.
+        cache_errors (bool): Also cache exceptions (negative caching).
+        error_ttl (float): Time-to-live of a cached exception in seconds.
+        maxbytes (int, optional): Byte budget for cached results.
+        sizeof (callable): Size estimate for a result (default: sys.getsizeof).
+        timer (callable): Clock returning seconds (default: time.monotonic).
+        key (callable, optional): Custom cache-key function (see KeyBuilder).
+        max_stale (float, optional): Seconds an expired result may be served
+            while it is refreshed in the background.
+    """
+    def decorator(func):
+        if not asyncio.iscoroutinefunction(func):
+            raise TypeError(
+                "async_cache can only be applied to async functions")
+        engine = make_cache(policy, maxsize, maxbytes,
+                            lambda entry: sizeof(entry[1]))
+        make_key = KeyBuilder(func, key)
+        pending = {}
+        stats = [0, 0]  # hits, misses (expired entries count as misses)
+        refresh_stats = [0, 0, 0]  # stale hits, refreshes, failures
+
+        async def fill(k, args, kwargs, refresh=False):
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                if cache_errors and not refresh:
+                    engine.put(k, (timer() + error_ttl, None, e))
+                raise
+            else:
+                engine.put(k, (None if ttl is None else timer() + ttl, result, None))
+                return result
+            finally:
+                pending.pop(k, None)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            k = make_key(args, kwargs)
+            entry = engine.get(k)
+            if entry is not None:
+                expires, result, error = entry
+                if expires is None or expires > timer():
+                    stats[0] += 1
+                    if error is not None:
+                        # Drop the previous hits' frames, or the shared
+                        # traceback grows by one chain per raise.
+                        raise error.with_traceback(None)
+                    return result
+                if (max_stale is not None and error is None
+                        and expires + max_stale > timer()):
+                    stats[0] += 1
+                    refresh_stats[0] += 1
+                    if k not in pending:
+                        refresh_stats[1] += 1
+                        task = pending[k] = asyncio.ensure_future(
+                            fill(k, args, kwargs, refresh=True))
+                        task.add_done_callback(refreshed)
+                    return result
+                engine.pop(k)
+            stats[1] += 1
+            task = pending.get(k)
+            if task is None:
+                task = pending[k] = asyncio.ensure_future(fill(k, args, kwargs))
+            return await asyncio.shield(task)
+
+        def refreshed(task):
+            # Retrieves the exception so a failed refresh is not reported as
+            # never retrieved; callers past the hard limit that joined the
+            # task still see it.
+            if not task.cancelled() and task.exception() is not None:
+                refresh_stats[2] += 1
+
+        def cache_info():
+            return engine.info()._replace(hits=stats[0], misses=stats[1])
+
+        def cache_clear():
+            engine.clear()
+            stats[0] = stats[1] = 0
+
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        wrapper.refresh_info = lambda: RefreshInfo(*refresh_stats)
+        return wrapper
+
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+def _call_budget(seconds):
+    """The smaller of seconds and the time left on the current deadline."""
+    remaining = remaining_time()
+    if remaining is None:
+        return seconds
+    if remaining <= 0:
+        raise DeadlineExceededError("deadline exceeded before the call started")
+    return min(seconds, remaining)
+
+
+# Marks with_timeout's worker threads, so nested timed calls made by a
+# worker run inline instead of queueing behind the worker that waits on them.
+_timeout_worker = threading.local()
+
+
+def _run_timed(context, func, args, kwargs):
+    _timeout_worker.active = True
+    return context.run(func, *args, **kwargs)
+
+
+def with_timeout(seconds):
+    """
+    Enforce a timeout on function calls, bounded by the caller's deadline.
+
+    The call gets the smaller of ``seconds`` and the time left on the
+    deadline propagated from outer ``deadline()`` blocks and timeouts, and
+    that becomes the deadline seen by everything it calls. A call whose
+    deadline has already passed raises DeadlineExceededError without
+    running. Sync functions run on a shared worker pool; on timeout the
+    caller gets TimeoutError, but the worker thread runs the call to
+    completion since threads cannot be interrupted. A sync call made from
+    inside another one runs inline on that worker (the outer timeout still
+    bounds the caller) and raises TimeoutError if it returns past its own
+    budget.
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                budget = _call_budget(seconds)
+                token = _deadline.set(time.monotonic() + budget)
+                try:
+                    return await asyncio.wait_for(func(*args, **kwargs), timeout=budget)
+                finally:
+                    _deadline.reset(token)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                budget = _call_budget(seconds)
+                expires = time.monotonic() + budget
+                if getattr(_timeout_worker, "active", False):
+                    token = _deadline.set(expires)
+                    try:
+                        result = func(*args, **kwargs)
+                    finally:
+                        _deadline.reset(token)
+                    if time.monotonic() > expires:
+                        raise TimeoutError(
+                            f"{func.__name__} timed out after {budget:.3f}s")
+                    return result
+                context = contextvars.copy_context()
+                context.run(_deadline.set, expires)
+                future = _get_pool("with_timeout").submit(
+                    _run_timed, context, func, args, kwargs)
+                try:
+                    return future.result(timeout=budget)
+                except concurrent.futures.TimeoutError:
+                    if future.done():  # raised by func itself
+                        raise
+                    future.cancel()  # drops it if still queued for a worker
+                    raise TimeoutError(
+                        f"{func.__name__} timed out after {budget:.3f}s") from None
+        return wrapper
+    return decorator
+
+
+class RateLimiter:
+    """
+    GCRA rate limiter (a token bucket tracked as one timestamp per key).
+
+    Each call reserves the next free slot under a lock and then sleeps until
+    that slot, so concurrent callers are admitted one interval apart in
+    arrival (FIFO) order instead of all reading the same timestamp and firing
+    together. A reserved slot is consumed even if the waiter is cancelled.
+    Idle keys are pruned in amortized O(1), so per-key buckets stay bounded
+    by the number of recently active keys.
+
+    Args:
+        rate (float): Sustained calls per second.
+        burst (int): Calls allowed back-to-back after an idle period.
+        timer (callable): Clock returning seconds (default: time.monotonic).
+    """
+
+    def __init__(self, rate, burst=1, timer=time.monotonic):
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate must be positive and burst at least 1")
+        self.rate = rate
+        self.burst = burst
+        self.timer = timer
+        self.interval = 1.0 / rate
+        self._tolerance = (burst - 1) * self.interval
+        self._tats = {}  # key -> theoretical arrival time of the next call
+        self._lock = threading.Lock()
+        self._ops = 0
 
+    def reserve(self, key=None):
+        """Claim the next slot for key; returns seconds to wait before using it."""
+        with self._lock:
+            now = self.timer()
+            tat = max(self._tats.get(key, now), now)
+            self._tats[key] = tat + self.interval
+            self._ops += 1
+            if self._ops >= 1024 and self._ops >= len(self._tats):
+                self._prune(now)
+            return max(0.0, tat - self._tolerance - now)
 
-def timed(func):
-    """Measure execution time of a function."""
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        start = time.perf_counter()
-        result = func(*args, **kwargs)
-        end = time.perf_counter()
-        logging.info(f"{func.__name__} took {end - start:.4f} seconds")
-        return result
-    return wrapper
+    def try_acquire(self, key=None):
+        """Take a slot only if it is available right now."""
+        with self._lock:
+            now = self.timer()
+            tat = max(self._tats.get(key, now), now)
+            if tat - self._tolerance > now:
+                return False
+            self._tats[key] = tat + self.interval
+            return True
 
+    def acquire(self, key=None):
+        delay = self.reserve(key)
+        if delay:
+            time.sleep(delay)
 
-# ---------------------------------------------------------
-# Reliability & Caching
-# ---------------------------------------------------------
+    async def acquire_async(self, key=None):
+        delay = self.reserve(key)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def _prune(self, now):
+        # A key whose next slot is already in the past is indistinguishable
+        # from a key that was never seen.
+        self._tats = {k: tat for k, tat in self._tats.items() if tat > now}
+        self._ops = 0
+
+
+def rate_limit(calls_per_sec, burst=1, key=None):
+    """
+    Throttle sync or async function calls to N per second.
+
+    All functions decorated by one ``rate_limit(...)`` call share a limiter.
+
+    Args:
+        calls_per_sec (float): Sustained calls per second.
+        burst (int): Calls allowed back-to-back after an idle period.
+        key (callable, optional): Maps the call's arguments to a bucket key,
+            e.g. ``key=lambda tenant, *a, **kw: tenant`` for per-tenant limits.
+    """
+    limiter = RateLimiter(calls_per_sec, burst)
 
-def retry(times=3, delay=1):
-    """Retry function on failure with fixed delay."""
     def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            last_exc = None
-            for attempt in range(times):
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    last_exc = e
-                    time.sleep(delay)
-            raise last_exc
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                await limiter.acquire_async(
+                    None if key is None else key(*args, **kwargs))
+                return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                limiter.acquire(None if key is None else key(*args, **kwargs))
+                return func(*args, **kwargs)
+        wrapper.limiter = limiter
         return wrapper
     return decorator
 
 
-def retry_backoff(times=3, base_delay=1):
-    """Retry with exponential backoff."""
+def async_rate_limit(calls_per_sec: int, burst=1, key=None):
+    """Throttle async function calls to N per second (see rate_limit)."""
+    limit = rate_limit(calls_per_sec, burst, key)
+
     def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            for attempt in range(times):
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    delay = base_delay * (2 ** attempt)
-                    logging.warning(
-                        f"Retry {attempt+1}/{times} in {delay}s due to {e}")
-                    time.sleep(delay)
-            raise RuntimeError("Max retries exceeded")
-        return wrapper
+        if not asyncio.iscoroutinefunction(func):
+            raise TypeError(
+                "async_rate_limit can only be applied to async functions")
+        return limit(func)
     return decorator
 
 
-def cache(func):
-    """Simple in-memory cache decorator."""
-    _cache = {}
+# ---------------------------------------------------------
+# Concurrency Control
+# ---------------------------------------------------------
 
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        key = (args, tuple(sorted(kwargs.items())))
-        if key not in _cache:
-            _cache[key] = func(*args, **kwargs)
-        return _cache[key]
-    return wrapper
+BatchInfo = namedtuple("BatchInfo", ["batches", "items", "largest", "mean_size"])
 
 
-def memoize_with_ttl(ttl: int):
-    """Cache results with TTL (time-to-live)."""
-    def decorator(func):
-        cache = {}
+class _Batcher:
+    """Shared bookkeeping for the thread and asyncio batch collectors."""
 
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            key = (args, frozenset(kwargs.items()))
-            now = time.time()
-            if key not in cache or now - cache[key][1] > ttl:
-                cache[key] = (func(*args, **kwargs), now)
-            return cache[key][0]
-        return wrapper
-    return decorator
+    def __init__(self, func, max_size, max_wait):
+        self.func = func
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.batches = self.items = self.largest = 0
+        name = _metric_name(func)
+        self.bulk_metric = metrics.metric(name, "batched")
+        self.delay_metric = metrics.metric(name, "batched_queue")
 
+    def info(self):
+        return BatchInfo(self.batches, self.items, self.largest,
+                         self.items / self.batches if self.batches else 0.0)
 
-def circuit_breaker(fail_max=3, reset_timeout=10):
-    """Stop calling a failing function until cooldown period passes."""
-    def decorator(func):
-        failures = [0]
-        last_failure = [0]
+    def _start(self, batch):
+        now = time.perf_counter_ns()
+        for _, _, enqueued in batch:
+            self.delay_metric.record(now - enqueued)
+        self.batches += 1
+        self.items += len(batch)
+        self.largest = max(self.largest, len(batch))
+        return [item for item, _, _ in batch]
 
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            if failures[0] >= fail_max and (time.time() - last_failure[0]) < reset_timeout:
-                raise RuntimeError("Circuit is open")
+    def _resolve(self, batch, results, error, started):
+        """Map the bulk outcome back to each caller's future."""
+        self.bulk_metric.record(time.perf_counter_ns() - started, error is not None)
+        if error is None:
             try:
-                result = func(*args, **kwargs)
-                failures[0] = 0
-                return result
+                if isinstance(results, dict):
+                    results = [results[item] for item, _, _ in batch]
+                elif len(results) != len(batch):
+                    raise ValueError(f"{self.func.__name__} returned {len(results)} "
+                                     f"results for {len(batch)} items")
+            except (KeyError, TypeError, ValueError) as e:
+                error = e
+        for i, (_, future, _) in enumerate(batch):
+            if future.done():  # the caller gave up waiting
+                continue
+            if error is not None:
+                future.set_exception(error)
+            elif isinstance(results[i], BaseException):
+                future.set_exception(results[i])
+            else:
+                future.set_result(results[i])
+
+    def _fail(self, batch, error):
+        """Fail every caller in batch still waiting, e.g. after a crash."""
+        for _, future, _ in batch:
+            if future.done():
+                continue
+            if isinstance(error, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(error)
+
+
+class _ThreadBatcher(_Batcher):
+    """Collects calls from any thread on a daemon collector thread."""
+
+    def __init__(self, func, max_size, max_wait):
+        super().__init__(func, max_size, max_wait)
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, item):
+        future = concurrent.futures.Future()
+        self._queue.put((item, future, time.perf_counter_ns()))
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            with self._lock:
+                if self._thread is thread:  # restarts a collector that died
+                    self._thread = threading.Thread(
+                        target=self._collect, name=f"batched-{self.func.__name__}",
+                        daemon=True)
+                    self._thread.start()
+        return future.result()
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        batch.append(self._queue.get(timeout=remaining))
+                    else:
+                        batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                items = self._start(batch)
+                started = time.perf_counter_ns()
+                try:
+                    results, error = self.func(items), None
+                except BaseException as e:
+                    results, error = None, e
+                self._resolve(batch, results, error, started)
+            except BaseException as e:  # the collector must outlive any batch
+                self._fail(batch, e)
+
+
+class _AsyncBatcher(_Batcher):
+    """
+    Collects calls on a collector task per running event loop. The task
+    exits (and drops its loop's entry) once its queue is empty, so a
+    finished loop is not kept alive by the batcher.
+    """
+
+    def __init__(self, func, max_size, max_wait):
+        super().__init__(func, max_size, max_wait)
+        self._queues = {}  # loop -> queue, while a collector is running
+        self._tasks = set()  # the loop only holds weak references to tasks
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        pending = self._queues.get(loop)
+        if pending is None:
+            pending = self._queues[loop] = asyncio.Queue()
+            task = loop.create_task(self._collect(loop, pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        future = loop.create_future()
+        pending.put_nowait((item, future, time.perf_counter_ns()))
+        return await future
+
+    async def _collect(self, loop, pending):
+        try:
+            while not pending.empty():
+                await self._collect_batch(loop, pending)
+        finally:
+            # No await since the empty check, so no submit can have queued
+            # onto this queue expecting it to be drained.
+            del self._queues[loop]
+            while not pending.empty():  # only after a crash or cancellation
+                self._fail([pending.get_nowait()], RuntimeError("batch collector stopped"))
+
+    async def _collect_batch(self, loop, pending):
+        batch = [pending.get_nowait()]
+        try:
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_size:
+                if not pending.empty():
+                    batch.append(pending.get_nowait())
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(pending.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            items = self._start(batch)
+            started = time.perf_counter_ns()
+            try:
+                results, error = await self.func(items), None
             except Exception as e:
-                failures[0] += 1
-                last_failure[0] = time.time()
-                raise e
-        return wrapper
-    return decorator
+                results, error = None, e
+            self._resolve(batch, results, error, started)
+        except BaseException as e:
+            self._fail(batch, e)
+            if not isinstance(e, Exception):
+                raise
 
 
-# ---------------------------------------------------------
-# Access & Security
-# ---------------------------------------------------------
+def batched(max_size=100, max_wait=0.005):
+    """
+    Coalesce single-item calls into calls of a bulk function.
 
-def require_role(role):
-    """Ensure user has required role before executing function."""
+    The decorated function takes a list of items and returns a list of
+    results in the same order (or a dict keyed by item). Callers keep
+    calling ``f(item)``; calls arriving within ``max_wait`` seconds, up to
+    ``max_size`` of them, are sent as one bulk call. A result that is an
+    exception instance is raised to that item's caller only; if the bulk
+    call itself raises, every caller in the batch gets the error.
+
+    Sync functions are collected on a daemon thread, coroutine functions on
+    a task per event loop; one bulk call runs at a time per collector.
+    Batch counters are exposed as ``batch_info()``, and queueing delay and
+    bulk-call latency are recorded in the metrics registry.
+    """
     def decorator(func):
-        @functools.wraps(func)
-        def wrapper(user, *args, **kwargs):
-            if role not in user.get("roles", []):
-                raise PermissionError("Access denied")
-            return func(user, *args, **kwargs)
+        if asyncio.iscoroutinefunction(func):
+            batcher = _AsyncBatcher(func, max_size, max_wait)
+
+            @functools.wraps(func)
+            async def wrapper(item):
+                return await batcher.submit(item)
+        else:
+            batcher = _ThreadBatcher(func, max_size, max_wait)
+
+            @functools.wraps(func)
+            def wrapper(item):
+                return batcher.submit(item)
+        wrapper.bulk = func
+        wrapper.batch_info = batcher.info
         return wrapper
     return decorator
 
 
-def audit(action: str):
-    """Log security-sensitive actions for auditing."""
+class BulkheadFullError(RuntimeError):
+    """Raised when a bulkhead has no free slot and no room (or time) to queue."""
+
+
+BulkheadStats = namedtuple(
+    "BulkheadStats",
+    ["in_flight", "queued", "max_concurrent", "max_queue",
+     "accepted", "rejected", "timed_out"])
+
+
+class _BulkheadWaiter:
+    __slots__ = ("granted", "signal")
+
+    def __init__(self, signal):
+        self.granted = False
+        self.signal = signal  # threading.Event or asyncio.Future
+
+    def wake(self):
+        signal = self.signal
+        if type(signal) is threading.Event:
+            signal.set()
+        else:
+            signal.get_loop().call_soon_threadsafe(_set_pending, signal)
+
+
+def _set_pending(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class Bulkhead:
+    """
+    Cap the number of concurrent calls, with a bounded FIFO wait queue.
+
+    A call takes one of ``max_concurrent`` slots, or waits in a queue of at
+    most ``max_queue`` callers for up to ``queue_timeout`` seconds (None
+    waits forever). With the slots and the queue both full, the call is
+    rejected at once with BulkheadFullError. Threads and coroutines share
+    the same slots; a released slot is handed straight to the oldest waiter.
+    """
+
+    def __init__(self, max_concurrent, max_queue=0, queue_timeout=None):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1")
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.accepted = self.rejected = self.timed_out = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return BulkheadStats(self.in_flight, len(self._waiters), self.max_concurrent,
+                             self.max_queue, self.accepted, self.rejected, self.timed_out)
+
+    def _enter(self, new_signal):
+        """Take a slot (returns None) or join the queue (returns the waiter)."""
+        with self._lock:
+            if self.in_flight < self.max_concurrent and not self._waiters:
+                self.in_flight += 1
+                self.accepted += 1
+                return None
+            if len(self._waiters) >= self.max_queue:
+                self.rejected += 1
+                raise BulkheadFullError(
+                    f"bulkhead full ({self.in_flight} in flight, "
+                    f"{len(self._waiters)} queued)")
+            waiter = _BulkheadWaiter(new_signal())
+            self._waiters.append(waiter)
+            return waiter
+
+    def _abandon(self, waiter):
+        """Leave the queue; True if a slot was handed over in the meantime."""
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            return False
+
+    def _timed_out(self):
+        with self._lock:
+            self.timed_out += 1
+        return BulkheadFullError(
+            f"no bulkhead slot within {self.queue_timeout}s")
+
+    def release(self):
+        with self._lock:
+            if self._waiters and self.in_flight <= self.max_concurrent:
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                self.accepted += 1
+                waiter.wake()  # the slot passes over; in_flight is unchanged
+            else:
+                self.in_flight -= 1
+
+    def _admit_waiters(self):
+        # Called with _lock held after max_concurrent grows.
+        while self._waiters and self.in_flight < self.max_concurrent:
+            waiter = self._waiters.popleft()
+            waiter.granted = True
+            self.in_flight += 1
+            self.accepted += 1
+            waiter.wake()
+
+    def acquire(self):
+        waiter = self._enter(threading.Event)
+        if waiter is not None and not waiter.signal.wait(self.queue_timeout):
+            if not self._abandon(waiter):
+                raise self._timed_out()
+
+    async def acquire_async(self):
+        waiter = self._enter(asyncio.get_running_loop().create_future)
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(waiter.signal, self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not self._abandon(waiter):
+                raise self._timed_out() from None
+        except asyncio.CancelledError:
+            if self._abandon(waiter):
+                self.release()
+            raise
+
+    def call(self, func, *args, **kwargs):
+        self.acquire()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.release()
+
+    async def call_async(self, func, *args, **kwargs):
+        await self.acquire_async()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            self.release()
+
+
+_bulkheads = {}
+_bulkheads_lock = threading.Lock()
+
+
+def get_bulkhead(name, **options):
+    """Return the registered bulkhead for name, creating it with options if needed."""
+    bulkhead = _bulkheads.get(name)
+    if bulkhead is None:
+        with _bulkheads_lock:
+            bulkhead = _bulkheads.get(name)
+            if bulkhead is None:
+                bulkhead = _bulkheads[name] = Bulkhead(**options)
+    return bulkhead
+
+
+def bulkhead(max_concurrent, max_queue=0, queue_timeout=None, name=None):
+    """
+    Limit how many calls of a function run at once.
+
+    Works on sync and async functions; see Bulkhead for the queueing rules.
+    ``name`` shares one registered bulkhead between functions that call the
+    same dependency. The bulkhead is exposed as ``wrapper.bulkhead``.
+    """
     def decorator(func):
-        @functools.wraps(func)
-        def wrapper(user, *args, **kwargs):
-            result = func(user, *args, **kwargs)
-            logging.info(
-                f"User={user.get('id')} performed {action} on {func.__name__}")
-            return result
+        settings = dict(max_concurrent=max_concurrent, max_queue=max_queue,
+                        queue_timeout=queue_timeout)
+        limiter = get_bulkhead(name, **settings) if name is not None else Bulkhead(**settings)
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                return await limiter.call_async(func, *args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                return limiter.call(func, *args, **kwargs)
+        wrapper.bulkhead = limiter
         return wrapper
     return decorator
 
 
-def idempotent(func):
-    """Prevent duplicate processing by enforcing idempotency keys."""
-    seen = {}
+class AdaptiveLimiter(Bulkhead):
+    """
+    Bulkhead whose concurrency limit follows the backend's latency.
 
-    @functools.wraps(func)
-    def wrapper(key, *args, **kwargs):
-        if key in seen:
-            return seen[key]
-        result = func(key, *args, **kwargs)
-        seen[key] = result
-        return result
-    return wrapper
+    As in TCP Vegas, the no-load latency is the lowest smoothed latency
+    seen over the last two windows of ``window`` calls (smoothing keeps
+    ordinary jitter out of the baseline). The number of calls queued at
+    the backend is then estimated as ``limit * (1 - baseline / smoothed)``.
+    ``alpha`` and ``beta`` are scaled by log10(limit) (once past 10), so
+    latency jitter does not pin large limits. Below ``alpha`` queued calls,
+    with the limit in use, the limit grows by about one per ``limit`` calls
+    (additive increase). Above ``beta``, or on a failure, it is multiplied
+    by ``backoff``, at most once per smoothed latency so one burst is not
+    punished repeatedly. A backend that slows down for good first looks
+    congested and the limit drops; the baseline catches up within two
+    windows. Calls over the limit queue or are rejected as in Bulkhead.
+
+    Args:
+        initial_limit (int): Starting concurrency limit.
+        min_limit (int): Lowest limit.
+        max_limit (int): Highest limit.
+        max_queue (int): Callers allowed to wait for a slot.
+        queue_timeout (float, optional): Longest wait for a slot.
+        alpha (float): Estimated backend queue below which the limit grows.
+        beta (float): Estimated backend queue above which the limit shrinks.
+        backoff (float): Factor applied to the limit on congestion or errors.
+        window (int): Calls per baseline window.
+        timer (callable): Clock returning seconds (default: time.monotonic).
+    """
 
+    def __init__(self, initial_limit=10, min_limit=1, max_limit=1000, max_queue=0,
+                 queue_timeout=None, alpha=3, beta=6, backoff=0.9, window=1000,
+                 timer=time.monotonic):
+        super().__init__(initial_limit, max_queue, queue_timeout)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.alpha = alpha
+        self.beta = beta
+        self.backoff = backoff
+        self.window = window
+        self.timer = timer
+        self.limit = float(initial_limit)
+        self.smoothed = None
+        self.decreases = 0
+        self._window_min = self._previous_min = float("inf")
+        self._samples = 0
+        self._last_decrease = float("-inf")
 
-# ---------------------------------------------------------
-# Async Utilities
-# ---------------------------------------------------------
+    @property
+    def baseline(self):
+        return min(self._window_min, self._previous_min)
+
+    def record(self, latency, failed=False):
+        """Feed one call's latency (seconds) and outcome into the limit."""
+        with self._lock:
+            smoothed = self.smoothed = (latency if self.smoothed is None
+                                        else self.smoothed + 0.1 * (latency - self.smoothed))
+            self._samples += 1
+            if self._samples % self.window == 0:
+                self._previous_min, self._window_min = self._window_min, smoothed
+            elif smoothed < self._window_min:
+                self._window_min = smoothed
+            queued = self.limit * (1 - self.baseline / smoothed) if smoothed > 0 else 0.0
+            scale = max(1.0, math.log10(self.limit))
+            if failed or queued > self.beta * scale:
+                now = self.timer()
+                if now - self._last_decrease >= smoothed:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self._last_decrease = now
+                    self.decreases += 1
+            elif queued < self.alpha * scale and self.in_flight * 2 >= self.limit:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            grew = int(self.limit) > self.max_concurrent
+            self.max_concurrent = int(self.limit)
+            if grew:
+                self._admit_waiters()
+
+    def call(self, func, *args, **kwargs):
+        self.acquire()
+        try:
+            start = self.timer()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                self.record(self.timer() - start, True)
+                raise
+            self.record(self.timer() - start)
+            return result
+        finally:
+            self.release()
+
+    async def call_async(self, func, *args, **kwargs):
+        await self.acquire_async()
+        try:
+            start = self.timer()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception:
+                self.record(self.timer() - start, True)
+                raise
+            self.record(self.timer() - start)
+            return result
+        finally:
+            self.release()
+
+
+def adaptive_limit(initial_limit=10, **options):
+    """
+    Limit a coroutine function's concurrency to what the backend sustains.
 
-def async_retry(times=3, base_delay=1):
-    """Retry async functions with exponential backoff."""
+    See AdaptiveLimiter for the options; the limiter is exposed as
+    ``wrapper.limiter``. Calls beyond the limit and the queue raise
+    BulkheadFullError.
+    """
     def decorator(func):
+        if not asyncio.iscoroutinefunction(func):
+            raise TypeError("adaptive_limit can only be applied to async functions")
+        limiter = AdaptiveLimiter(initial_limit, **options)
+
         @functools.wraps(func)
         async def wrapper(*args, **kwargs):
-            for attempt in range(times):
-                try:
-                    return await func(*args, **kwargs)
-                except Exception as e:
-                    delay = base_delay * (2 ** attempt)
-                    logging.warning(
-                        f"Retry {attempt+1}/{times} in {delay}s due to {e}")
-                    await asyncio.sleep(delay)
-            raise RuntimeError("Max retries exceeded")
+            return await limiter.call_async(func, *args, **kwargs)
+        wrapper.limiter = limiter
         return wrapper
     return decorator
 
 
-def with_timeout(seconds):
-    """Enforce timeout on async function calls."""
+HedgeInfo = namedtuple(
+    "HedgeInfo", ["calls", "hedges", "hedge_wins", "denied", "delay"])
+
+# With a derived delay, the percentile is recomputed after this many new
+# samples; sorting the window on every call would cost more than the call.
+_HEDGE_REFRESH = 50
+
+
+class _HedgeDelay:
+    """Rolling percentile of recent attempt latencies (None until warm)."""
+
+    __slots__ = ("value", "percentile", "samples", "_fresh")
+
+    def __init__(self, percentile, window):
+        self.value = None
+        self.percentile = percentile
+        self.samples = deque(maxlen=window)
+        self._fresh = 0
+
+    def observe(self, latency):
+        self.samples.append(latency)
+        self._fresh += 1
+        if self._fresh >= _HEDGE_REFRESH:
+            self._fresh = 0
+            ordered = sorted(self.samples)
+            index = int(len(ordered) * self.percentile / 100)
+            self.value = ordered[min(index, len(ordered) - 1)]
+
+
+def hedged(delay=None, max_hedges=1, percentile=95, window=1000,
+           budget=_MISSING):
+    """
+    Cut tail latency of an idempotent coroutine by racing backup attempts.
+
+    If an attempt has not finished ``delay`` seconds after the last one
+    started, another identical call is started; the first to succeed wins and
+    the rest are cancelled. A failed attempt does not trigger a hedge (combine
+    with retry for that): the call fails with the last error once every
+    attempt in flight has failed.
+
+    Args:
+        delay (float, optional): Seconds before hedging. By default the
+            ``percentile`` of the last ``window`` attempt latencies is used,
+            so roughly 1 call in 20 hedges; no call hedges until
+            50 latencies have been seen. Every attempt counts, including
+            cancelled losers (at the time they were cancelled).
+        max_hedges (int): Backup attempts per call.
+        percentile (float): Percentile used when ``delay`` is None.
+        window (int): Recent latencies the percentile is taken over.
+        budget (RetryBudget, optional): Caps hedges to a fraction of calls so
+            a slow backend is not hit with double the load. Defaults to a
+            per-function ``RetryBudget(ratio=0.1)``; None disables the cap.
+
+    ``wrapper.hedge_info()`` returns HedgeInfo(calls, hedges, hedge_wins,
+    denied, delay).
+    """
     def decorator(func):
+        if not asyncio.iscoroutinefunction(func):
+            raise TypeError("hedged can only be applied to async functions")
+        limit = RetryBudget(ratio=0.1) if budget is _MISSING else budget
+        derived = None if delay is not None else _HedgeDelay(percentile, window)
+        stats = [0, 0, 0, 0]  # calls, hedges, hedge_wins, denied
+
         @functools.wraps(func)
         async def wrapper(*args, **kwargs):
-            return await asyncio.wait_for(func(*args, **kwargs), timeout=seconds)
+            stats[0] += 1
+            if limit is not None:
+                limit.deposit()
+            loop = asyncio.get_running_loop()
+            first = loop.create_task(func(*args, **kwargs))
+            started = {first: loop.time()}
+            hedges = 0
+            try:
+                while True:
+                    wait = delay if derived is None else derived.value
+                    done, _ = await asyncio.wait(
+                        started, return_when=asyncio.FIRST_COMPLETED,
+                        timeout=wait if hedges < max_hedges else None)
+                    if not done:
+                        if limit is not None and not limit.withdraw():
+                            stats[3] += 1
+                            hedges = max_hedges
+                            continue
+                        hedges += 1
+                        stats[1] += 1
+                        started[loop.create_task(func(*args, **kwargs))] = loop.time()
+                        continue
+                    winner = None
+                    for task in done:
+                        began = started.pop(task)
+                        if derived is not None:
+                            derived.observe(loop.time() - began)
+                        error = task.exception()
+                        if error is None and (winner is None or task is first):
+                            winner = task  # a tie goes to the original
+                    if winner is not None:
+                        if winner is not first:
+                            stats[2] += 1
+                        return winner.result()
+                    if not started:
+                        raise error
+            finally:
+                now = loop.time()
+                for task, began in started.items():
+                    if task.done():
+                        # Retrieve it so a loser's error is not logged.
+                        task.cancelled() or task.exception()
+                    else:
+                        task.cancel()
+                    if derived is not None:
+                        # A lower bound on the loser's latency; leaving the
+                        # slow attempts out would drag the percentile down.
+                        derived.observe(now - began)
+
+        wrapper.hedge_info = lambda: HedgeInfo(
+            *stats, delay if derived is None else derived.value)
         return wrapper
     return decorator
 
 
-def async_rate_limit(calls_per_sec: int):
-    """Throttle async function calls to N per second."""
-    min_interval = 1.0 / calls_per_sec
-    last_call = [0.0]
+# ---------------------------------------------------------
+# Composition
+# ---------------------------------------------------------
+
+def _limited_call(limiter, func, *args, **kwargs):
+    limiter.acquire()
+    return func(*args, **kwargs)
+
+
+async def _limited_call_async(limiter, func, *args, **kwargs):
+    await limiter.acquire_async()
+    return await func(*args, **kwargs)
+
+
+def _is_cache_step(step):
+    return step is cache or hasattr(step, "cache_options") or isinstance(
+        step, (_CacheEngine, TTLCache))
 
+
+def _retry_policy(step):
+    """The RetryPolicy behind a step (a policy or ``retry(...)``), if any."""
+    if isinstance(step, RetryPolicy):
+        return step
+    policy = getattr(step, "__self__", None)
+    return policy if isinstance(policy, RetryPolicy) else None
+
+
+def _observers(func, kinds):
+    """
+    ``(observe, failed)`` callbacks that record one timed call of func the way
+    the ``timed`` and ``log_calls`` decorators named in kinds (outermost
+    first) would, from a single clock reading.
+    """
+    name = _metric_name(func)
+    recorders = tuple(metrics.metric(name, kind) for kind in kinds)
+    loggers = tuple(reversed(kinds))  # innermost logs first
+
+    def observe(args, kwargs, result, elapsed):
+        for metric in recorders:
+            metric.record(elapsed)
+        if logging.root.isEnabledFor(logging.INFO):
+            for kind in loggers:
+                if kind == "log_calls":
+                    logging.info(_call_line(func, args, kwargs, result, elapsed))
+                else:
+                    logging.info(f"{func.__name__} took {elapsed / 1e9:.4f} seconds")
+
+    def failed(start):
+        elapsed = time.perf_counter_ns() - start
+        for metric in recorders:
+            metric.record(elapsed, True)
+
+    return observe, failed
+
+
+def _observed_call(func, call, kinds, is_async):
+    """Wrap call in the timed/log_calls kinds, recording as func."""
+    observe, failed = _observers(func, kinds)
+    if is_async:
+        async def observed(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                result = await call(*args, **kwargs)
+            except BaseException:
+                failed(start)
+                raise
+            observe(args, kwargs, result, time.perf_counter_ns() - start)
+            return result
+    else:
+        def observed(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                result = call(*args, **kwargs)
+            except BaseException:
+                failed(start)
+                raise
+            observe(args, kwargs, result, time.perf_counter_ns() - start)
+            return result
+    return observed
+
+
+def compose(*steps):
+    """
+    Apply several behaviors as one flat wrapper, listed outermost first.
+
+    ``compose(timed, log_calls, retry(3, 0.1), cache)`` behaves like the
+    same decorators stacked in that order, with fewer frames per call:
+
+    - The steps run in the listed order. The one exception is the cache
+      (``cache``, ``cache(...)`` or an in-memory engine such as LRUCache or
+      TTLCache), whose lookup runs first, so a hit returns without timing
+      or logging. Other stores with get/put, such as DiskCache, need
+      bytes keys and raise TypeError. Only ``timed``, ``log_calls`` and retries may be listed
+      before it (a hit cannot fail, so retrying it changes nothing); after
+      a breaker, bulkhead, rate limit or any other decorator it raises
+      ValueError, as hits would otherwise skip that step. Misses are stored
+      once the rest of the chain returns.
+    - Adjacent ``timed`` and ``log_calls`` steps share one clock reading
+      and record into the same metrics as the decorators; inside a retry
+      they record every attempt, as the stacked decorators would.
+    - RetryPolicy (or ``retry(...)`` / ``retry_backoff(...)``),
+      CircuitBreaker, Bulkhead and RateLimiter run their ``call`` methods
+      directly.
+    - Any other decorator is applied as usual at its position.
+
+    Works on sync and coroutine functions. For coroutines the cache stores
+    awaited results but does not share in-flight calls (use async_cache).
+    """
     def decorator(func):
-        @functools.wraps(func)
-        async def wrapper(*args, **kwargs):
-            elapsed = time.time() - last_call[0]
-            if elapsed < min_interval:
-                await asyncio.sleep(min_interval - elapsed)
-            last_call[0] = time.time()
-            return await func(*args, **kwargs)
+        is_async = asyncio.iscoroutinefunction(func)
+        engine = make_key = None
+        chain = steps
+        for i, step in enumerate(steps):
+            if not _is_cache_step(step):
+                if hasattr(step, "get") and hasattr(step, "put"):
+                    raise TypeError(f"compose() cannot cache in a "
+                                    f"{type(step).__name__}; use an in-memory engine")
+                continue
+            if engine is not None:
+                raise ValueError("compose() takes at most one cache")
+            for before in steps[:i]:
+                if not (before is timed or before is log_calls
+                        or _retry_policy(before) is not None):
+                    raise ValueError("compose() only allows timed, log_calls "
+                                     "and retries before the cache")
+            options = getattr(step, "cache_options", {})
+            if step is cache or options:
+                engine = make_cache(options.get("policy", "lru"),
+                                    options.get("maxsize", 128),
+                                    options.get("maxbytes"),
+                                    options.get("sizeof", sys.getsizeof))
+            else:
+                engine = step
+            make_key = KeyBuilder(func, options.get("key"))
+            chain = steps[:i] + steps[i + 1:]
+        kinds = []  # leading observers, outermost first, around the cache miss
+        for step in chain:
+            if step is not timed and step is not log_calls:
+                break
+            kinds.append(step.__name__)
+        call = func
+        inner = []  # observers waiting to wrap the steps below them
+        for step in reversed(chain[len(kinds):]):
+            if step is timed or step is log_calls:
+                inner.insert(0, step.__name__)
+                continue
+            if inner:
+                call, inner = _observed_call(func, call, inner, is_async), []
+            policy = _retry_policy(step)
+            if policy is not None:
+                step = policy
+            if isinstance(step, (RetryPolicy, CircuitBreaker, Bulkhead)):
+                call = functools.partial(step.call_async if is_async else step.call, call)
+            elif isinstance(step, RateLimiter):
+                call = functools.partial(
+                    _limited_call_async if is_async else _limited_call, step, call)
+            else:
+                call = step(call)
+        if inner:
+            call = _observed_call(func, call, inner, is_async)
+        observe, failed = _observers(func, kinds)
+
+        if is_async:
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if engine is not None:
+                    k = make_key(args, kwargs)
+                    result = engine.get(k, _MISSING)
+                    if result is not _MISSING:
+                        return result
+                if kinds:
+                    start = time.perf_counter_ns()
+                    try:
+                        result = await call(*args, **kwargs)
+                    except BaseException:
+                        failed(start)
+                        raise
+                    observe(args, kwargs, result, time.perf_counter_ns() - start)
+                else:
+                    result = await call(*args, **kwargs)
+                if engine is not None:
+                    engine.put(k, result)
+                return result
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if engine is not None:
+                    k = make_key(args, kwargs)
+                    result = engine.get(k, _MISSING)
+                    if result is not _MISSING:
+                        return result
+                if kinds:
+                    start = time.perf_counter_ns()
+                    try:
+                        result = call(*args, **kwargs)
+                    except BaseException:
+                        failed(start)
+                        raise
+                    observe(args, kwargs, result, time.perf_counter_ns() - start)
+                else:
+                    result = call(*args, **kwargs)
+                if engine is not None:
+                    engine.put(k, result)
+                return result
+        if engine is not None and hasattr(engine, "info"):
+            wrapper.cache_info = engine.info
+            wrapper.cache_clear = engine.clear
+        wrapper.steps = steps
         return wrapper
     return decorator
 
@@ -225,19 +4046,61 @@ def async_rate_limit(calls_per_sec: int):
 # ---------------------------------------------------------
 
 def singleton(cls):
-    """Thread-safe singleton decorator for classes."""
-    instances = {}
+    """
+    Thread-safe singleton decorator for classes.
+
+    Creation is double-checked under a lock; once the instance exists every
+    call is a lock-free list read.
+    """
+    instance = []
     lock = threading.Lock()
 
     @functools.wraps(cls)
     def get_instance(*args, **kwargs):
+        try:
+            return instance[0]
+        except IndexError:
+            pass
         with lock:
-            if cls not in instances:
-                instances[cls] = cls(*args, **kwargs)
-        return instances[cls]
+            if not instance:
+                instance.append(cls(*args, **kwargs))
+        return instance[0]
     return get_instance
 
 
+def multiton(cls=None, *, key=None, weak=False):
+    """
+    Thread-safe decorator keeping one instance per argument key.
+
+    Args:
+        key (callable, optional): Maps constructor arguments to the instance
+            key (default: all arguments).
+        weak (bool): Hold instances through weak references so ones nobody
+            uses any more can be garbage collected.
+    """
+    def decorator(cls):
+        instances = weakref.WeakValueDictionary() if weak else {}
+        lock = threading.Lock()
+        make_key = KeyBuilder(cls, key)
+
+        @functools.wraps(cls)
+        def get_instance(*args, **kwargs):
+            k = make_key(args, kwargs)
+            inst = instances.get(k)
+            if inst is None:
+                with lock:
+                    inst = instances.get(k)
+                    if inst is None:
+                        inst = instances[k] = cls(*args, **kwargs)
+            return inst
+        get_instance.instances = instances
+        return get_instance
+
+    if cls is not None:
+        return decorator(cls)
+    return decorator
+
+
 def timeit(expected_delay=None, logger=None, level=logging.INFO):
     """
     Decorator to measure execution time of sync or async functions.
@@ -251,33 +4114,42 @@ def timeit(expected_delay=None, logger=None, level=logging.INFO):
         logger = logging.getLogger(__name__)
 
     def decorator(func):
+        metric = metrics.metric(_metric_name(func), "timeit")
+
+        def report(t1, failed):
+            elapsed = time.perf_counter_ns() - t1
+            metric.record(elapsed, failed)
+            if not logger.isEnabledFor(level):
+                return
+            if expected_delay is not None:
+                logger.log(
+                    level, f"[{func.__name__}] took {elapsed / 1e9:.4f}s (expected ~{expected_delay}s)")
+            else:
+                logger.log(level, f"[{func.__name__}] took {elapsed / 1e9:.4f}s")
+
         if asyncio.iscoroutinefunction(func):
             # Async version
             @functools.wraps(func)
             async def wrapper(*args, **kwargs):
-                t1 = time.perf_counter()
-                result = await func(*args, **kwargs)
-                t2 = time.perf_counter()
-                elapsed = t2 - t1
-                if expected_delay is not None:
-                    logger.log(
-                        level, f"[{func.__name__}] took {elapsed:.4f}s (expected ~{expected_delay}s)")
-                else:
-                    logger.log(level, f"[{func.__name__}] took {elapsed:.4f}s")
+                t1 = time.perf_counter_ns()
+                try:
+                    result = await func(*args, **kwargs)
+                except BaseException:
+                    report(t1, True)
+                    raise
+                report(t1, False)
                 return result
         else:
             # Sync version
             @functools.wraps(func)
             def wrapper(*args, **kwargs):
-                t1 = time.perf_counter()
-                result = func(*args, **kwargs)
-                t2 = time.perf_counter()
-                elapsed = t2 - t1
-                if expected_delay is not None:
-                    logger.log(
-                        level, f"[{func.__name__}] took {elapsed:.4f}s (expected ~{expected_delay}s)")
-                else:
-                    logger.log(level, f"[{func.__name__}] took {elapsed:.4f}s")
+                t1 = time.perf_counter_ns()
+                try:
+                    result = func(*args, **kwargs)
+                except BaseException:
+                    report(t1, True)
+                    raise
+                report(t1, False)
                 return result
         return wrapper
     return decorator
@@ -300,15 +4172,21 @@ def async_timed(expected_delay=2, logger=None, level=logging.INFO):
             raise TypeError(
                 "async_timed can only be applied to async functions")
 
+        metric = metrics.metric(_metric_name(func), "async_timed")
+
         @functools.wraps(func)
         async def wrapper(*args, **kwargs):
-            t1 = time.perf_counter()
+            t1 = time.perf_counter_ns()
+            failed = True
             try:
-                return await func(*args, **kwargs)
+                result = await func(*args, **kwargs)
+                failed = False
+                return result
             finally:
-                t2 = time.perf_counter()
-                elapsed = t2 - t1
-                logger.log(
-                    level, f"[{func.__name__}] took {elapsed:.2f}s (expected ~{expected_delay}s)")
+                elapsed = time.perf_counter_ns() - t1
+                metric.record(elapsed, failed)
+                if logger.isEnabledFor(level):
+                    logger.log(
+                        level, f"[{func.__name__}] took {elapsed / 1e9:.2f}s (expected ~{expected_delay}s)")
         return wrapper
     return decorator
@@ -1,11 +1,38 @@
 # test_decorators.py
 import pytest
 import asyncio
+import concurrent.futures
+import gc
+import logging
+import os
+import pickle
+import pstats
+import socket
+import threading
 import time
 
+import bench_decorators
 import decorators
 
 
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.001)
+
+
 # ---------------------------------------------------------
 # Logging & Performance
 # ---------------------------------------------------------
@@ -22,6 +49,188 @@ def test_timed_and_log_calls(capsys):
     assert "add" in captured.out or "add" in captured.err
 
 
+def test_metrics_registry_quantiles_and_reset():
+    metric = decorators.MetricsRegistry().metric("f", "timed")
+    for ns in range(1, 10_001):
+        metric.record(ns * 1000)  # 1us .. 10ms
+    metric.record(5000, failed=True)
+    snap = metric.snapshot()
+    assert snap["count"] == 10_001 and snap["errors"] == 1
+    assert snap["max"] == pytest.approx(0.01)
+    assert snap["p50"] == pytest.approx(0.005, rel=0.07)
+    assert snap["p99"] == pytest.approx(0.0099, rel=0.07)
+    metric.snapshot(reset=True)
+    assert metric.snapshot()["count"] == 0
+
+
+def test_metrics_fold_exited_threads_into_one_shard():
+    metric = decorators.MetricsRegistry().metric("f", "timed")
+    metric.record(1000)
+    for i in range(50):
+        thread = threading.Thread(target=metric.record, args=(2000,),
+                                  kwargs={"failed": i % 2 == 0})
+        thread.start()
+        thread.join()
+    wait_until(lambda: len(metric._shards) == 1)  # only this thread's
+    snap = metric.snapshot()
+    assert (snap["count"], snap["errors"]) == (51, 25)
+    assert snap["max"] == pytest.approx(2e-6)
+    metric.snapshot(reset=True)
+    assert metric.snapshot()["count"] == 0
+
+
+def test_timed_records_into_registry():
+    @decorators.timed
+    def boom(fail):
+        if fail:
+            raise ValueError("fail")
+
+    name = decorators._metric_name(boom)
+    boom(False)
+    with pytest.raises(ValueError):
+        boom(True)
+    snap = [s for s in decorators.metrics.snapshot()
+            if s["function"] == name and s["decorator"] == "timed"][0]
+    assert (snap["count"], snap["errors"]) == (2, 1)
+    text = decorators.metrics.to_prometheus()
+    assert f'decorated_call_seconds_count{{function="{name}",decorator="timed"}} 2' in text
+    assert '"function"' in decorators.metrics.to_json()
+
+
+def test_profiled_merges_samples_into_collapsed_stacks(tmp_path):
+    def leaf(n):
+        return sum(range(n))
+
+    @decorators.profiled(sample_rate=1.0)
+    def work(n):
+        return leaf(n) + leaf(n)
+
+    for _ in range(3):
+        work(50_000)
+    assert work.profile.sampled == 3
+    stacks = work.profile.collapsed().splitlines()
+    assert any(":work:" in line and ":leaf:" in line and "builtins.sum" in line
+               for line in stacks)
+    assert all(int(line.rsplit(" ", 1)[1]) > 0 for line in stacks)
+    path = tmp_path / "work.pstats"
+    work.profile.dump_stats(path)
+    assert pstats.Stats(str(path)).total_calls >= 3 * 5
+
+
+def test_profiled_skips_unsampled_and_nested_calls():
+    @decorators.profiled(sample_rate=0.0)
+    def never():
+        return 1
+
+    @decorators.profiled(sample_rate=1.0)
+    def inner():
+        return 2
+
+    @decorators.profiled(sample_rate=1.0)
+    def outer():
+        return inner()
+
+    assert never() == 1 and never.profile.stats() is None
+    assert outer() == 2
+    assert (outer.profile.sampled, inner.profile.sampled) == (1, 0)
+
+    entered, release = threading.Event(), threading.Event()
+
+    @decorators.profiled(sample_rate=1.0)
+    def hold():
+        entered.set()
+        release.wait()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    entered.wait()
+    assert inner() == 2  # another thread holds the process-wide profiler
+    release.set()
+    holder.join()
+    assert (hold.profile.sampled, inner.profile.sampled) == (1, 0)
+
+
+def test_log_pipeline_truncates_and_skips_formatting_below_level(tmp_path):
+    formatted = []
+
+    class Payload:
+        def __repr__(self):
+            formatted.append(1)
+            return "Payload()"
+
+    path = tmp_path / "calls.log"
+    pipeline = decorators.LogPipeline(str(path), flush_interval=10)
+
+    @decorators.log_calls(pipeline=pipeline)
+    def total(values, tag=None):
+        return sum(values)
+
+    assert total(list(range(100_000)), tag=Payload()) == 4999950000
+    quiet = decorators.LogPipeline(str(tmp_path / "quiet.log"), level=logging.WARNING)
+    decorators.log_calls(pipeline=quiet)(total.__wrapped__)([1], tag=Payload())
+    assert len(formatted) == 1  # the WARNING pipeline never built a line
+    pipeline.close()
+    quiet.close()
+    lines = path.read_text().splitlines()
+    assert len(lines) == 1 and " INFO total(([0, 1, 2" in lines[0]
+    assert len(lines[0]) < 300 and "Payload()" in lines[0]
+    assert (tmp_path / "quiet.log").read_text() == ""
+
+
+def test_log_pipeline_socket_sink_batches_and_drops():
+    reader, writer = socket.socketpair()
+    pipeline = decorators.LogPipeline(writer, batch_size=100, flush_interval=10,
+                                      max_queue=150)
+    logger = logging.getLogger("test_log_pipeline")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(pipeline.handler())
+    try:
+        for i in range(200):
+            logger.info("event %d", i)
+        wait_until(lambda: pipeline.written + len(pipeline._queue) + pipeline.dropped == 200)
+        pipeline.close()
+        data = b""
+        reader.settimeout(1)
+        while data.count(b"\n") < pipeline.written:
+            data += reader.recv(65536)
+        lines = data.decode().splitlines()
+        assert lines[0].endswith("INFO event 0")
+        assert pipeline.batches < len(lines)  # many lines per write
+        assert pipeline.written + pipeline.dropped == 200
+    finally:
+        logger.handlers.clear()
+        reader.close()
+        writer.close()
+
+
+def test_log_pipeline_survives_sink_errors():
+    class FlakySink:
+        def __init__(self):
+            self.lines = []
+
+        def write(self, data):
+            if not self.lines:
+                self.lines.append(None)
+                raise OSError("disk full")
+            self.lines.extend(data.splitlines())
+
+        def flush(self):
+            pass
+
+    sink = FlakySink()
+    pipeline = decorators.LogPipeline(sink, batch_size=2, flush_interval=10)
+    for i in range(4):
+        pipeline.log(f"event {i}")
+    pipeline.flush()
+    assert pipeline._thread.is_alive()
+    pipeline.log("after")
+    pipeline.close()
+    assert pipeline.errors == 1 and pipeline.dropped == 2
+    assert [line.rsplit(" ", 2)[-2:] for line in sink.lines[1:]] == \
+        [["event", "2"], ["event", "3"], ["INFO", "after"]]
+
+
 # ---------------------------------------------------------
 # Reliability & Caching
 # ---------------------------------------------------------
@@ -62,10 +271,161 @@ def test_cache_decorator():
     assert calls["count"] == 1
 
 
+def test_retry_only_retries_listed_exceptions():
+    calls = {"count": 0}
+
+    @decorators.retry(times=5, delay=0, retry_on=(ConnectionError,))
+    def fetch():
+        calls["count"] += 1
+        raise KeyError("not retryable")
+
+    with pytest.raises(KeyError):
+        fetch()
+    assert calls["count"] == 1
+
+
+def test_retry_policy_jitter_bounds():
+    full = decorators.RetryPolicy(base_delay=1, jitter="full")
+    equal = decorators.RetryPolicy(base_delay=1, jitter="equal")
+    decorrelated = decorators.RetryPolicy(base_delay=1, max_delay=5,
+                                          jitter="decorrelated")
+    for _ in range(100):
+        assert 0 <= full.backoff(2, 1) <= 4
+        assert 2 <= equal.backoff(2, 1) <= 4
+        assert 1 <= decorrelated.backoff(0, 4) <= 5
+
+
+def test_retry_deadline_and_budget():
+    clock = FakeClock()
+    calls = {"count": 0}
+
+    def fail():
+        calls["count"] += 1
+        clock.advance(1)
+        raise ValueError("fail")
+
+    policy = decorators.RetryPolicy(times=10, base_delay=0, deadline=3, timer=clock)
+    with pytest.raises(decorators.RetryError):
+        policy.call(fail)
+    assert calls["count"] == 3
+
+    calls["count"] = 0
+    budget = decorators.RetryBudget(ratio=0.5, min_per_sec=0, capacity=1, timer=clock)
+    policy = decorators.RetryPolicy(times=10, base_delay=0, budget=budget)
+    with pytest.raises(decorators.RetryError):
+        policy.call(fail)
+    assert calls["count"] == 2  # one banked token => a single retry
+    assert budget.rejected == 1
+
+
+def test_cache_keys_normalize_signature_and_unhashables():
+    calls = []
+
+    @decorators.cache
+    def total(items, scale=1, *, options=None):
+        calls.append(1)
+        return sum(items) * scale
+
+    assert total([1, 2], 2) == total([1, 2], scale=2) == total(items=[1, 2], scale=2) == 6
+    assert total([1, 2]) == total([1, 2], 1) == 3
+    assert total([1, 2], options={"b": 1, "a": {2, 3}}) == 3
+    assert total([1, 2], options={"a": {3, 2}, "b": 1}) == 3
+    assert len(calls) == 3
+
+
+def test_freeze_key_containers_do_not_collide_with_tuples():
+    for value, lookalike in (([1, 2], (list, (1, 2))),
+                             ({"a": 1}, (dict, (("a", 1),))),
+                             ({1}, (set, (1,))),
+                             (bytearray(b"ab"), (bytearray, "B", (2,), b"ab"))):
+        frozen = decorators.freeze_key(value)
+        assert frozen != decorators.freeze_key(lookalike)
+        assert decorators._stable_hash(frozen) != \
+            decorators._stable_hash(decorators.freeze_key(lookalike))
+        assert pickle.loads(pickle.dumps(frozen)) == frozen
+    assert decorators.freeze_key([1]) != decorators.freeze_key((1,))
+
+
+def test_key_builder_buffers_and_custom_types():
+    build = decorators.KeyBuilder(lambda data: None)
+    assert build((bytearray(b"abc"),), {}) == build((bytearray(b"abc"),), {})
+    assert build((bytearray(b"abc"),), {}) != build((bytearray(b"abd"),), {})
+    assert build((memoryview(b"abcd")[::2],), {}) == build((memoryview(b"ac"),), {})
+
+    class Point:
+        __hash__ = None
+
+        def __init__(self, x, y):
+            self.x, self.y = x, y
+
+    with pytest.raises(TypeError):
+        build((Point(1, 2),), {})
+    decorators.register_key_type(Point, lambda p: (Point, p.x, p.y))
+    assert build((Point(1, 2),), {}) == build((Point(1, 2),), {})
+
+    by_id = decorators.KeyBuilder(lambda user, request: None,
+                                  key=lambda user, request: user["id"])
+    assert by_id(({"id": 7}, object()), {}) == 7
+
+
+def test_cache_lru_eviction_and_info():
+    calls = []
+
+    @decorators.cache(maxsize=2)
+    def slow(x):
+        calls.append(x)
+        return x * 2
+
+    slow(1)
+    slow(2)
+    slow(1)        # 1 becomes most recently used
+    slow(3)        # evicts 2
+    slow(1)
+    slow(2)        # recomputed
+    assert calls == [1, 2, 3, 2]
+    info = slow.cache_info()
+    assert (info.hits, info.misses, info.evictions, info.currsize) == (2, 4, 2, 2)
+    slow.cache_clear()
+    assert slow.cache_info().currsize == 0
+
+
+def test_cache_lfu_keeps_frequent_keys():
+    engine = decorators.LFUCache(maxsize=2)
+    engine.put("hot", 1)
+    engine.get("hot")
+    engine.get("hot")
+    engine.put("a", 2)
+    engine.put("b", 3)  # evicts "a", the least frequently used
+    assert "hot" in engine and "b" in engine and "a" not in engine
+
+
+def test_cache_tinylfu_rejects_one_hit_wonders():
+    engine = decorators.TinyLFUCache(maxsize=100)
+    for _ in range(5):
+        for k in range(50):
+            if engine.get(k) is None:
+                engine.put(k, k)
+    for k in range(1000, 2000):  # a scan of keys seen once
+        if engine.get(k) is None:
+            engine.put(k, k)
+    assert len(engine) == 100
+    assert sum(k in engine for k in range(50)) >= 45
+
+
+def test_cache_byte_budget():
+    engine = decorators.LRUCache(maxsize=None, maxbytes=100, sizeof=len)
+    engine.put("a", "x" * 60)
+    engine.put("b", "y" * 30)
+    engine.put("c", "z" * 30)  # over budget, evicts "a"
+    assert "a" not in engine and engine.info().currbytes == 60
+    assert engine.put("d", "w" * 101) is False
+
+
 def test_memoize_with_ttl():
+    clock = FakeClock()
     calls = {"count": 0}
 
-    @decorators.memoize_with_ttl(ttl=1)
+    @decorators.memoize_with_ttl(ttl=1, timer=clock)
     def slow(x):
         calls["count"] += 1
         return x
@@ -73,11 +433,287 @@ def test_memoize_with_ttl():
     assert slow(5) == 5
     assert slow(5) == 5  # cached
     assert calls["count"] == 1
-    time.sleep(1.1)
+    clock.advance(1.1)
     assert slow(5) == 5  # cache expired
     assert calls["count"] == 2
 
 
+def test_memoize_with_ttl_serves_stale_while_refreshing():
+    clock = FakeClock()
+    versions = iter([1, 2, ValueError("down"), 3])
+    gate = threading.Event()
+
+    @decorators.memoize_with_ttl(ttl=10, max_stale=5, timer=clock)
+    def load(key):
+        gate.wait(5)
+        value = next(versions)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    gate.set()
+    assert load("k") == 1
+    gate.clear()
+    clock.advance(11)
+    assert load("k") == 1 and load("k") == 1  # stale; one refresh started
+    assert load.refresh_info().refreshes == 1
+    gate.set()
+    wait_until(lambda: load("k") == 2)
+    clock.advance(11)
+    assert load("k") == 2  # this refresh fails
+    wait_until(lambda: load.refresh_info().failures == 1)
+    assert load("k") == 2  # still within max_stale
+    clock.advance(5)
+    assert load("k") == 3  # past the hard limit: recomputed inline
+    assert load.refresh_info().stale_hits >= 4
+
+
+def _fill_shared(name, keys):
+    cache = decorators.SharedMemoryCache(name, buckets=256, ways=4, slot_size=256)
+    for i in keys:
+        cache.put(decorators._stable_hash(i), i * i)
+    cache.close()
+
+
+def test_shared_memory_cache_visible_across_processes():
+    name = f"test-shm-{os.getpid()}"
+    cache = decorators.SharedMemoryCache(name, buckets=256, ways=4, slot_size=256)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(2) as pool:
+            list(pool.map(_fill_shared, [name] * 2, [range(50), range(50, 100)]))
+        assert [cache.get(decorators._stable_hash(i)) for i in range(100)] == \
+            [i * i for i in range(100)]
+        assert cache.info().currsize == 100
+        with pytest.raises(ValueError):
+            decorators.SharedMemoryCache(name, buckets=128, ways=4, slot_size=256)
+    finally:
+        cache.unlink()
+        cache.close()
+
+
+def test_shared_memory_cache_recovers_from_a_dead_writer():
+    name = f"test-shm-dead-{os.getpid()}"
+    cache = decorators.SharedMemoryCache(name, buckets=1, ways=2, slot_size=64)
+    key = decorators._stable_hash("k")
+    try:
+        cache.put(key, "v")
+        offset = cache._slot(0, 0)
+        seq = decorators._SHM_SEQ.unpack_from(cache._buf, offset)[0]
+        decorators._SHM_SEQ.pack_into(cache._buf, offset, seq + 1)  # died mid-write
+        start = time.monotonic()
+        assert cache.get(key, "miss") == "miss"
+        assert time.monotonic() - start < 1
+        cache.put(key, "w")
+        assert decorators._SHM_SEQ.unpack_from(cache._buf, offset)[0] % 2 == 0
+        assert cache.get(key) == "w"
+    finally:
+        cache.unlink()
+        cache.close()
+
+
+def test_shared_memory_cache_waits_for_creator_header():
+    from multiprocessing import resource_tracker, shared_memory
+
+    name = f"test-shm-race-{os.getpid()}"
+    stride = (decorators._SHM_SLOT.size + 64 + 7) & ~7
+    raw = shared_memory.SharedMemory(name, create=True, size=64 + 16 * 2 * stride)
+    resource_tracker.unregister(raw._name, "shared_memory")
+    # A creator that has sized the segment but not yet written its header.
+    writer = threading.Timer(0.05, decorators._SHM_HEADER.pack_into,
+                             (raw.buf, 0, decorators._SHM_MAGIC, 16, 2, 64, 64))
+    writer.start()
+    with pytest.raises(ValueError):  # checked against the header once written
+        decorators.SharedMemoryCache(name, buckets=8, ways=2, slot_size=64)
+    cache = decorators.SharedMemoryCache(name, buckets=16, ways=2, slot_size=64)
+    try:
+        cache.put(decorators._stable_hash("k"), "v")
+        assert cache.get(decorators._stable_hash("k")) == "v"
+    finally:
+        writer.join()
+        cache.unlink()
+        cache.close()
+        raw.close()
+
+
+def test_shared_cache_decorator_ttl_and_oversize():
+    calls = []
+
+    @decorators.shared_cache(f"test-shm-dec-{os.getpid()}", buckets=8, ways=2,
+                             slot_size=128, ttl=0.05)
+    def load(n):
+        calls.append(n)
+        return "x" * n
+
+    try:
+        assert load(10) == load(10) and calls == [10]
+        assert load(500) == load(500) and calls == [10, 500, 500]  # too big to cache
+        assert load.shared.oversize == 2
+        time.sleep(0.06)
+        load(10)
+        assert calls[-1] == 10 and len(calls) == 4  # expired
+    finally:
+        load.shared.unlink()
+        load.shared.close()
+
+
+def test_ttl_cache_expires_unread_keys():
+    clock = FakeClock()
+    store = decorators.TTLCache(ttl=10, timer=clock)
+    for k in range(100):
+        store.put(k, k)
+    clock.advance(11)
+    store.put("fresh", 1)  # any write advances the wheel
+    assert len(store) == 1
+    assert store.info().expirations == 100
+
+
+def test_ttl_cache_maxsize_and_per_entry_ttl():
+    clock = FakeClock()
+    store = decorators.TTLCache(ttl=10, maxsize=2, timer=clock)
+    store.put("a", 1)
+    store.put("b", 2, ttl=100)
+    store.put("c", 3)  # evicts "a", the oldest insertion
+    assert "a" not in store and store.info().evictions == 1
+    clock.advance(50)
+    assert store.get("c") is None
+    assert store.get("b") == 2
+
+
+def test_memoize_with_ttl_threads():
+    calls = {"count": 0}
+
+    @decorators.memoize_with_ttl(ttl=60, maxsize=10)
+    def slow(x):
+        calls["count"] += 1
+        return x
+
+    def worker():
+        for i in range(1000):
+            assert slow(i % 20) == i % 20
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert slow.cache_info().currsize <= 10
+
+
+def test_tiered_cache_warm_after_restart(tmp_path):
+    path = str(tmp_path / "tier2.db")
+    calls = {"count": 0}
+
+    def expensive(n, scale=1):
+        calls["count"] += 1
+        return list(range(n * scale))
+
+    first = decorators.tiered_cache(path, maxsize=2, compress_threshold=100)(expensive)
+    assert first(1000) == list(range(1000))  # large enough to be compressed
+    assert first(3, scale=2) == list(range(6))
+    assert calls["count"] == 2
+
+    restarted = decorators.tiered_cache(path, maxsize=2)(expensive)
+    assert restarted(1000) == list(range(1000))
+    assert restarted(3, scale=2) == list(range(6))
+    assert calls["count"] == 2
+    assert restarted.disk.hits == 2
+
+
+def test_tiered_cache_disk_keys_depend_only_on_content(tmp_path):
+    path = str(tmp_path / "tier2.db")
+    calls = []
+
+    def join(a, b, scale=1):
+        calls.append(a)
+        return a + b
+
+    word = "".join(["ab"] * 3)
+    decorators.tiered_cache(path)(join)(word, word)  # one object, pickled by reference
+    decorators.tiered_cache(path)(join)((1, [2.0]), (3,))
+    restarted = decorators.tiered_cache(path)(join)
+    assert restarted(word, "".join(["ab"] * 3)) == "ab" * 6
+    assert restarted((1.0, [2]), (3,), scale=1.0) == (1, [2.0], 3)
+    assert len(calls) == 2 and restarted.disk.hits == 2
+
+
+def test_single_flight_threads_share_result_and_errors():
+    release = threading.Event()
+    calls = {"count": 0}
+
+    @decorators.single_flight
+    def load(x):
+        calls["count"] += 1
+        release.wait()
+        if x == "bad":
+            raise ValueError("boom")
+        return x * 2
+
+    results, errors = [], []
+
+    def worker(x):
+        try:
+            results.append(load(x))
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(x,))
+               for x in [3] * 5 + ["bad"] * 3]
+    for t in threads:
+        t.start()
+    wait_until(lambda: load.flight_info().coalesced == 6)
+    release.set()
+    for t in threads:
+        t.join()
+    assert results == [6] * 5
+    assert len(errors) == 3
+    assert calls["count"] == 2
+    assert load.flight_info() == (8, 2, 6, 0)
+
+
+@pytest.mark.asyncio
+async def test_single_flight_async_inside_cache():
+    calls = {"count": 0}
+
+    @decorators.single_flight
+    async def load(x):
+        calls["count"] += 1
+        await asyncio.sleep(0)
+        return x + 1
+
+    assert await asyncio.gather(*(load(1) for _ in range(10))) == [2] * 10
+    assert calls["count"] == 1
+    assert load.flight_info().coalesced == 9
+
+    @decorators.cache
+    @decorators.single_flight
+    def double(x):
+        return x * 2
+
+    assert double(4) == double(4) == 8
+    assert double.cache_info().hits == 1
+
+
+@pytest.mark.asyncio
+async def test_single_flight_async_survives_a_cancelled_leader():
+    release = asyncio.Event()
+
+    @decorators.single_flight
+    async def load(x):
+        await release.wait()
+        return x + 1
+
+    leader = asyncio.ensure_future(load(1))
+    await asyncio.sleep(0)
+    follower = asyncio.ensure_future(load(1))
+    await asyncio.sleep(0)
+    leader.cancel()
+    await asyncio.sleep(0)
+    release.set()
+    assert await follower == 2
+    assert leader.cancelled()
+    assert load.flight_info() == (2, 1, 1, 0)
+
+
 def test_circuit_breaker():
     calls = {"count": 0}
 
@@ -94,6 +730,72 @@ def test_circuit_breaker():
         flaky()
 
 
+def test_circuit_breaker_half_open_probes():
+    clock = FakeClock()
+    breaker = decorators.CircuitBreaker(fail_max=1, reset_timeout=5,
+                                        half_open_calls=2, timer=clock)
+    breaker.record(0.0, failed=True)
+    assert breaker.state == "open" and not breaker.allow()
+    clock.advance(5)
+    assert breaker.allow() and breaker.allow()
+    assert not breaker.allow()  # probe slots exhausted
+    breaker.record(0.0, failed=False)
+    assert breaker.state == "half_open"
+    breaker.record(0.0, failed=False)
+    assert breaker.state == "closed"
+    assert breaker.stats().rejections == 2
+
+
+def test_circuit_breaker_ignores_outcomes_from_an_earlier_state():
+    clock = FakeClock()
+    breaker = decorators.CircuitBreaker(fail_max=1, reset_timeout=5, timer=clock)
+    slow_call = breaker.allow()  # admitted while closed, still running
+    breaker.record(0.0, True, breaker.allow())
+    assert breaker.state == "open"
+    clock.advance(5)
+    probe = breaker.allow()
+    assert probe and not breaker.allow()
+    breaker.record(0.0, False, slow_call)  # finishes late: not the probe
+    breaker.release(slow_call)
+    assert breaker.state == "half_open" and not breaker.allow()
+    breaker.record(0.0, False, probe)
+    assert breaker.state == "closed" and breaker.stats().calls == 3
+
+
+def test_circuit_breaker_failure_and_slow_rate_window():
+    clock = FakeClock()
+    breaker = decorators.CircuitBreaker(
+        fail_max=None, failure_rate=0.5, slow_call_rate=0.8,
+        slow_call_duration=1.0, minimum_calls=4, window=10, buckets=5, timer=clock)
+    for failed in (True, False, True):
+        breaker.record(0.0, failed)
+    assert breaker.state == "closed"  # below minimum_calls
+    clock.advance(20)  # old buckets age out of the window
+    for failed in (True, False, False, False):
+        breaker.record(0.0, failed)
+    assert breaker.state == "closed"
+    for _ in range(15):
+        breaker.record(2.0, failed=False)
+    assert breaker.state == "closed"  # 15 slow of 19 calls < 80%
+    breaker.record(2.0, failed=False)
+    assert breaker.state == "open"    # 16 slow of 20 calls
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_per_key_async():
+    @decorators.circuit_breaker(fail_max=1, reset_timeout=60, key=lambda host: host)
+    async def fetch(host):
+        if host == "down":
+            raise ValueError("fail")
+        return host
+
+    with pytest.raises(ValueError):
+        await fetch("down")
+    with pytest.raises(decorators.CircuitOpenError):
+        await fetch("down")
+    assert await fetch("up") == "up"
+
+
 # ---------------------------------------------------------
 # Access & Security
 # ---------------------------------------------------------
@@ -119,6 +821,88 @@ def test_require_role_failure():
         protected(user)
 
 
+def test_require_role_any_all_and_inheritance():
+    registry = decorators.RoleRegistry()
+    registry.define("admin", inherits=["editor"])
+    registry.define("editor", inherits=["viewer"])
+
+    @decorators.require_role(any_of=["billing", "editor"], registry=registry)
+    def edit(u):
+        return "edited"
+
+    @decorators.require_role(all_of=["viewer", "billing"], registry=registry)
+    def invoice(u):
+        return "billed"
+
+    admin = {"roles": ["admin"]}
+    assert edit(admin) == "edited"  # admin -> editor
+    with pytest.raises(PermissionError):
+        invoice(admin)
+    admin["roles"] = ["admin", "billing"]  # a new list rebuilds the mask
+    assert invoice(admin) == "billed"
+    with pytest.raises(PermissionError):
+        edit({"roles": ["viewer"]})
+    with pytest.raises(TypeError):
+        decorators.require_role("admin", any_of=["editor"])
+
+
+def test_require_role_mask_follows_roles_and_registry():
+    registry = decorators.RoleRegistry()
+
+    @decorators.require_role("ops", registry=registry)
+    def deploy(u):
+        return "deployed"
+
+    user = {"roles": ["dev"]}
+    with pytest.raises(PermissionError):
+        deploy(user)
+    user["roles"].append("ops")  # granted in place
+    assert deploy(user) == "deployed"
+    user["roles"].remove("ops")  # revoked in place
+    with pytest.raises(PermissionError):
+        deploy(user)
+    assert "_role_mask" not in user
+    registry.define("dev", inherits=["ops"])  # redefinition invalidates masks
+    assert deploy({"roles": ["dev"]}) == "deployed"
+
+    # The same user checked against a registry where "viewer" holds the bit
+    # another registry gave to "admin" must not inherit the first answer.
+    first, second = decorators.RoleRegistry(), decorators.RoleRegistry()
+    second.bit("viewer")
+    viewer = {"roles": ["viewer"]}
+    for registry in (first, second):
+        with pytest.raises(PermissionError):
+            decorators.require_role("admin", registry=registry)(deploy)(viewer)
+
+
+def test_require_role_reads_granted_masks_and_ignores_unknown_roles():
+    registry = decorators.RoleRegistry()
+
+    @decorators.require_role("ops", registry=registry)
+    def deploy(u):
+        return "deployed"
+
+    with pytest.raises(PermissionError):
+        deploy({"roles": [f"team-{i}" for i in range(50)]})
+    assert list(registry._bits) == ["ops"]  # the user's roles were not interned
+
+    user = {"roles": registry.grant(["dev", "ops"])}
+    assert deploy(user) == "deployed"
+    assert tuple(user["roles"]) not in registry._masks  # read off the stamp
+    registry.define("dev", inherits=["ops"])
+    stale = registry.grant(["dev"])
+    assert deploy({"roles": stale}) == "deployed"
+    registry.define("dev")  # dev no longer includes ops
+    with pytest.raises(PermissionError):
+        deploy({"roles": stale})
+
+    # Another registry's stamp is not trusted even when its bits line up.
+    other = decorators.RoleRegistry()
+    other.bit("intern")
+    with pytest.raises(PermissionError):
+        deploy({"roles": other.grant(["intern"])})
+
+
 def test_audit_logs(capsys):
     user = {"id": 123, "roles": ["admin"]}
 
@@ -131,6 +915,64 @@ def test_audit_logs(capsys):
     assert "User=123" in captured.out or "User=123" in captured.err
 
 
+def test_audit_log_group_commit_rotation_and_scan(tmp_path):
+    log = decorators.AuditLog(str(tmp_path), durability="group",
+                              commit_window=0.005, segment_bytes=2_000)
+    barrier = threading.Barrier(8)
+
+    def worker(n):
+        barrier.wait()
+        for i in range(10):
+            log.append(n, "READ" if i % 2 else "DELETE", item=i)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert log.appended == 80 and log.fsyncs < 80  # records shared fsyncs
+    assert len(log.segments()) > 1
+    assert len(list(log.scan(user=1))) == 10
+    deletes = list(log.scan(user=3, action="DELETE"))
+    assert [r["item"] for r in deletes] == [0, 2, 4, 6, 8]
+    log.close()
+
+    reopened = decorators.AuditLog(str(tmp_path), durability="none")
+    reopened.append(12, "READ")
+    assert [r["user"] for r in reopened.scan(action="READ")].count(12) == 1
+    assert len(list(reopened.scan(user=1))) == 10  # "user":1 is not "user":12
+    reopened.close()
+
+
+def test_audit_log_skips_corrupt_records_and_audit_sink(tmp_path):
+    log = decorators.AuditLog(str(tmp_path), durability="always")
+
+    @decorators.audit("EXPORT", sink=log)
+    def export(u):
+        return "ok"
+
+    for uid in (1, 2, 3):
+        assert export({"id": uid}) == "ok"
+    log.close()
+    path = log.segments()[0]
+    with open(path, "rb") as f:
+        lines = f.read().splitlines(keepends=True)
+    lines[1] = lines[1].replace(b'"user":2', b'"user":9')  # bit rot
+    with open(path, "wb") as f:
+        f.writelines(lines)
+        f.write(b"0badc0de {\"torn")  # partial last write
+    records = list(log.scan())
+    assert [(r["user"], r["action"], r["function"]) for r in records] == \
+        [(1, "EXPORT", "export"), (3, "EXPORT", "export")]
+    assert log.corrupt == 2
+
+    reopened = decorators.AuditLog(str(tmp_path), durability="always")
+    reopened.append(4, "EXPORT")  # not glued onto the torn line
+    assert [r["user"] for r in reopened.scan()] == [1, 3, 4]
+    assert len(reopened.segments()) == 2
+    reopened.close()
+
+
 def test_idempotent():
     @decorators.idempotent
     def process(key, x):
@@ -140,6 +982,74 @@ def test_idempotent():
     assert process("abc", 3) == 4  # same result as first call
 
 
+def test_idempotent_concurrent_duplicate_waits():
+    release = threading.Event()
+    calls = {"count": 0}
+
+    @decorators.idempotent
+    def charge(key, amount):
+        calls["count"] += 1
+        release.wait()
+        return amount
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(charge("k1", 10)))
+               for _ in range(4)]
+    for t in threads:
+        t.start()
+    # Release the leader only once the three duplicates are waiting on it.
+    wait_until(lambda: charge.flight_info().coalesced == 3)
+    assert len(charge.store) == 0 and calls["count"] == 1
+    release.set()
+    for t in threads:
+        t.join()
+    assert results == [10] * 4
+    assert calls["count"] == 1
+
+
+def test_idempotency_memory_store_bounds():
+    clock = FakeClock()
+    store = decorators.MemoryIdempotencyStore(ttl=60, maxsize=2, timer=clock)
+    for key in ("a", "b", "c"):
+        store.put(key, key.upper())
+    assert store.get("a") is None and store.get("c") == "C"
+    clock.advance(61)
+    assert store.get("c") is None
+
+
+def test_idempotency_sqlite_store_survives_restart(tmp_path):
+    path = str(tmp_path / "idempotency.db")
+
+    @decorators.idempotent(store=decorators.SQLiteIdempotencyStore(path))
+    def process(key, x):
+        return {"doubled": x * 2}
+
+    assert process("abc", 2) == {"doubled": 4}
+
+    calls = {"count": 0}
+
+    @decorators.idempotent(store=decorators.SQLiteIdempotencyStore(path))
+    def process_after_restart(key, x):
+        calls["count"] += 1
+        return {"doubled": x * 2}
+
+    assert process_after_restart("abc", 3) == {"doubled": 4}
+    assert calls["count"] == 0
+
+
+def test_idempotency_sqlite_store_keys_by_content_and_reconnects_after_fork(tmp_path):
+    store = decorators.SQLiteIdempotencyStore(str(tmp_path / "idempotency.db"))
+    store.put({"order": 7, "tenant": "t1"}, "done")
+    assert store.get({"tenant": "t1", "order": 7}) == "done"  # another pickle, same key
+    store.put(1, "one")
+    assert store.get(1.0) == "one"
+
+    conn = store._connection()
+    store._local.pid = -1  # as seen by a forked child
+    assert store._connection() is not conn
+    assert store.get(1) == "one"
+
+
 # ---------------------------------------------------------
 # Async Utilities
 # ---------------------------------------------------------
@@ -169,6 +1079,85 @@ async def test_async_retry_failure():
         await always_fail()
 
 
+@pytest.mark.asyncio
+async def test_async_cache_shares_pending_task_and_expires():
+    clock = FakeClock()
+    calls = {"count": 0}
+
+    @decorators.async_cache(maxsize=10, ttl=5, timer=clock)
+    async def fetch(x):
+        calls["count"] += 1
+        await asyncio.sleep(0)
+        return x * 2
+
+    assert await asyncio.gather(*(fetch(2) for _ in range(5))) == [4] * 5
+    assert await fetch(2) == 4
+    assert calls["count"] == 1
+    clock.advance(6)
+    assert await fetch(2) == 4
+    assert calls["count"] == 2
+    assert fetch.cache_info().hits == 1
+
+
+@pytest.mark.asyncio
+async def test_async_cache_negative_caching():
+    clock = FakeClock()
+    calls = {"count": 0}
+
+    @decorators.async_cache(cache_errors=True, error_ttl=1, timer=clock)
+    async def flaky():
+        calls["count"] += 1
+        raise ValueError("down")
+
+    depths = []
+    for _ in range(3):
+        with pytest.raises(ValueError) as excinfo:
+            await flaky()
+        depths.append(len(excinfo.traceback))
+    assert calls["count"] == 1
+    assert depths[1] == depths[2]
+    clock.advance(2)
+    with pytest.raises(ValueError):
+        await flaky()
+    assert calls["count"] == 2
+
+
+@pytest.mark.asyncio
+async def test_async_cache_stale_while_revalidate():
+    clock = FakeClock()
+    calls = []
+
+    @decorators.async_cache(ttl=10, max_stale=5, timer=clock)
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        if len(calls) == 3:
+            raise ValueError("down")
+        return len(calls)
+
+    assert await load() == 1
+    clock.advance(11)
+    assert await asyncio.gather(load(), load()) == [1, 1]  # stale, not blocked
+    await asyncio.sleep(0.05)
+    assert await load() == 2 and len(calls) == 2  # one refresh
+    clock.advance(11)
+    assert await load() == 2
+    await asyncio.sleep(0.05)
+    assert load.refresh_info() == (3, 2, 1)
+    assert await load() == 2  # failed refresh kept the stale value
+
+
+@pytest.mark.asyncio
+async def test_cache_on_coroutine_function():
+    @decorators.cache(maxsize=4)
+    async def fetch(x):
+        return x
+
+    assert await fetch(1) == 1
+    assert await fetch(1) == 1  # a coroutine object would fail here
+    assert fetch.cache_info().hits == 1
+
+
 @pytest.mark.asyncio
 async def test_with_timeout():
     @decorators.with_timeout(0.5)
@@ -180,6 +1169,84 @@ async def test_with_timeout():
         await slow()
 
 
+@pytest.mark.asyncio
+async def test_with_timeout_propagates_deadline():
+    seen = []
+
+    @decorators.with_timeout(5)
+    async def inner():
+        seen.append(decorators.remaining_time())
+        await asyncio.sleep(1)
+
+    @decorators.with_timeout(0.05)
+    async def outer():
+        await inner()
+
+    start = time.monotonic()
+    with pytest.raises(asyncio.TimeoutError):
+        await outer()
+    assert time.monotonic() - start < 0.5
+    assert seen[0] <= 0.05  # inner got the caller's budget, not its own 5s
+
+    with decorators.deadline(0.01):
+        await asyncio.sleep(0.02)
+        with pytest.raises(decorators.DeadlineExceededError):
+            await inner()  # fails fast without running
+    assert len(seen) == 1
+
+
+def test_with_timeout_sync_and_retry_respect_deadline():
+    @decorators.with_timeout(0.05)
+    def slow():
+        time.sleep(0.3)
+
+    @decorators.with_timeout(1)
+    def budget():
+        return decorators.remaining_time()
+
+    with pytest.raises(TimeoutError):
+        slow()
+    assert 0.5 < budget() <= 1
+    with decorators.deadline(0.1):
+        assert budget() <= 0.1  # propagated into the worker thread
+
+    calls = []
+
+    @decorators.retry(times=5, delay=1)
+    def flaky():
+        calls.append(1)
+        raise ValueError("boom")
+
+    start = time.monotonic()
+    with decorators.deadline(0.2), pytest.raises(ValueError):
+        flaky()
+    assert len(calls) == 1 and time.monotonic() - start < 0.2  # no 1s sleep
+
+
+def test_with_timeout_nested_sync_calls_do_not_starve_the_pool():
+    @decorators.with_timeout(1)
+    def inner():
+        time.sleep(0.02)
+        return decorators.remaining_time()
+
+    @decorators.with_timeout(2)
+    def outer():
+        return inner()
+
+    workers = decorators._get_pool("with_timeout")._max_workers
+    results = []
+    run = bench_decorators.run_threads(2 * workers, lambda: results.append(outer()))
+    assert len(results) == 2 * workers and all(r <= 1 for r in results)
+    assert run < 1  # every outer call holds a worker; inners run inline
+
+    @decorators.with_timeout(0.01)
+    def slow_inner():
+        time.sleep(0.05)
+
+    with pytest.raises(TimeoutError):
+        decorators.with_timeout(1)(slow_inner)()
+
+
 @pytest.mark.asyncio
 async def test_async_rate_limit():
     timestamps = []
@@ -195,6 +1262,339 @@ async def test_async_rate_limit():
     assert timestamps[1] - timestamps[0] >= 0.2  # 5 per sec => 0.2s spacing
 
 
+@pytest.mark.asyncio
+async def test_async_rate_limit_holds_under_gather():
+    timestamps = []
+
+    @decorators.async_rate_limit(50)
+    async def fast():
+        timestamps.append(time.monotonic())
+
+    start = time.monotonic()
+    await asyncio.gather(*(fast() for _ in range(5)))
+    # 50 per sec => slots at 0, 0.02 .. 0.08s; wake-up jitter can shift a
+    # single call but never lets the batch finish early.
+    assert timestamps[-1] - start >= 0.079
+
+
+def test_rate_limiter_burst_and_per_key_buckets():
+    clock = FakeClock()
+    limiter = decorators.RateLimiter(rate=1, burst=3, timer=clock)
+    assert [limiter.reserve("a") for _ in range(5)] == [0, 0, 0, 1, 2]
+    assert limiter.reserve("b") == 0  # separate bucket
+    assert not limiter.try_acquire("a")
+    clock.advance(10)
+    assert limiter.try_acquire("a")
+
+
+# ---------------------------------------------------------
+# Concurrency Control
+# ---------------------------------------------------------
+
+def test_batched_threads_share_bulk_calls():
+    calls = []
+
+    @decorators.batched(max_size=8, max_wait=0.05)
+    def lookup(ids):
+        calls.append(list(ids))
+        return [ValueError(i) if i == 3 else i * 10 for i in ids]
+
+    results, errors = {}, {}
+    barrier = threading.Barrier(8)
+
+    def worker(i):
+        barrier.wait()
+        try:
+            results[i] = lookup(i)
+        except ValueError as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == {i: i * 10 for i in range(8) if i != 3}
+    assert list(errors) == [3]  # per-item error reaches only its caller
+    info = lookup.batch_info()
+    assert info.items == 8 and info.batches == len(calls) < 8
+    assert info.largest == max(len(c) for c in calls)
+
+
+@pytest.mark.asyncio
+async def test_batched_async_and_bulk_failure():
+    @decorators.batched(max_size=3, max_wait=0.05)
+    async def fetch(keys):
+        return {k: k.upper() for k in keys}
+
+    assert await asyncio.gather(*(fetch(k) for k in "abcd")) == list("ABCD")
+    assert fetch.batch_info().batches == 2  # 3 items + 1 after max_wait
+
+    @decorators.batched(max_wait=0.01)
+    async def broken(keys):
+        raise ConnectionError("down")
+
+    outcomes = await asyncio.gather(broken(1), broken(2), return_exceptions=True)
+    assert all(isinstance(o, ConnectionError) for o in outcomes)
+
+
+def test_batched_collectors_survive_crashes_and_release_loops():
+    class Abort(BaseException):
+        pass
+
+    failures = [Abort()]
+
+    @decorators.batched(max_wait=0)
+    def lookup(ids):
+        if failures:
+            raise failures.pop()
+        return [i + 1 for i in ids]
+
+    with pytest.raises(Abort):
+        lookup(1)
+    assert lookup(2) == 3  # the collector thread kept running
+    assert lookup.batch_info.__self__._thread.is_alive()
+
+    @decorators.batched(max_wait=0.001)
+    async def double(keys):
+        return [k * 2 for k in keys]
+
+    async def run():
+        return await asyncio.gather(double(1), double(2))
+
+    assert asyncio.run(run()) == [2, 4]
+    batcher = double.batch_info.__self__
+    assert batcher._queues == {} and not batcher._tasks  # nothing holds the loop
+
+
+def test_bulkhead_rejects_when_slots_and_queue_full():
+    release = threading.Event()
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    @decorators.bulkhead(max_concurrent=2, max_queue=2)
+    def call():
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        release.wait(5)
+        with lock:
+            active[0] -= 1
+        return True
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        futures = [pool.submit(call) for _ in range(4)]
+        wait_until(lambda: call.bulkhead.stats().queued == 2)
+        with pytest.raises(decorators.BulkheadFullError):
+            call()  # 2 running + 2 queued: rejected without waiting
+        release.set()
+        assert all(f.result() for f in futures)
+    stats = call.bulkhead.stats()
+    assert peak[0] == 2 and stats.in_flight == 0
+    assert (stats.accepted, stats.rejected) == (4, 1)
+
+
+@pytest.mark.asyncio
+async def test_bulkhead_async_gather_and_queue_timeout():
+    order = []
+
+    @decorators.bulkhead(max_concurrent=1, max_queue=10)
+    async def work(i):
+        order.append(i)
+        await asyncio.sleep(0.01)
+        return i
+
+    assert await asyncio.gather(*(work(i) for i in range(5))) == list(range(5))
+    assert order == list(range(5))  # FIFO hand-over
+
+    @decorators.bulkhead(max_concurrent=1, max_queue=1, queue_timeout=0.02)
+    async def slow():
+        await asyncio.sleep(0.2)
+
+    outcomes = await asyncio.gather(slow(), slow(), slow(), return_exceptions=True)
+    assert outcomes[0] is None
+    assert all(isinstance(o, decorators.BulkheadFullError) for o in outcomes[1:])
+    stats = slow.bulkhead.stats()
+    assert (stats.rejected, stats.timed_out, stats.in_flight) == (1, 1, 0)
+
+
+def test_adaptive_limiter_grows_then_backs_off():
+    clock = FakeClock()
+    limiter = decorators.AdaptiveLimiter(initial_limit=10, window=100, timer=clock)
+    for _ in range(300):  # steady latency with the limit in use: additive increase
+        limiter.in_flight = limiter.max_concurrent
+        limiter.record(0.010)
+        clock.advance(0.01)
+    grown = limiter.limit
+    assert 11 < grown < 40
+    for _ in range(20):  # latency 5x the baseline: multiplicative decrease
+        limiter.record(0.050)
+        clock.advance(0.1)
+    assert limiter.limit < grown * 0.9 ** 3 and limiter.decreases >= 3
+    limit = limiter.limit
+    limiter.record(0.010, failed=True)
+    assert limiter.limit == pytest.approx(limit * 0.9)
+    assert limiter.max_concurrent == int(limiter.limit)
+
+
+@pytest.mark.asyncio
+async def test_adaptive_limit_rejects_over_limit():
+    @decorators.adaptive_limit(2, max_queue=1)
+    async def call():
+        await asyncio.sleep(0.01)
+        return "ok"
+
+    outcomes = await asyncio.gather(*(call() for _ in range(5)), return_exceptions=True)
+    assert outcomes[:3] == ["ok"] * 3  # two running, one queued
+    assert all(isinstance(o, decorators.BulkheadFullError) for o in outcomes[3:])
+    assert call.limiter.stats().rejected == 2
+    with pytest.raises(TypeError):
+        decorators.adaptive_limit()(lambda: None)
+
+
+@pytest.mark.asyncio
+async def test_hedged_backup_wins_and_loser_is_cancelled():
+    attempts = []
+    cancelled = []
+
+    @decorators.hedged(delay=0.01, budget=None)
+    async def fetch():
+        attempt = len(attempts)
+        attempts.append(attempt)
+        try:
+            await asyncio.sleep(1 if attempt == 0 else 0.001)
+        except asyncio.CancelledError:
+            cancelled.append(attempt)
+            raise
+        return attempt
+
+    assert await fetch() == 1
+    await asyncio.sleep(0)
+    assert cancelled == [0]
+    info = fetch.hedge_info()
+    assert (info.calls, info.hedges, info.hedge_wins) == (1, 1, 1)
+    with pytest.raises(TypeError):
+        decorators.hedged()(lambda: None)
+
+
+@pytest.mark.asyncio
+async def test_hedged_budget_and_failures():
+    budget = decorators.RetryBudget(ratio=0, min_per_sec=0, capacity=1)
+
+    @decorators.hedged(delay=0.001, budget=budget)
+    async def slow():
+        await asyncio.sleep(0.005)
+        return "ok"
+
+    assert [await slow(), await slow()] == ["ok", "ok"]
+    info = slow.hedge_info()
+    assert (info.hedges, info.hedge_wins, info.denied) == (1, 0, 1)
+
+    @decorators.hedged(delay=0.001, budget=None)
+    async def broken():
+        await asyncio.sleep(0.002)
+        raise ValueError("down")
+
+    with pytest.raises(ValueError):
+        await broken()
+    assert broken.hedge_info().hedges == 1
+
+
+@pytest.mark.asyncio
+async def test_hedged_derived_delay_keeps_cancelled_losers():
+    attempts = {}
+    slow_first = False
+
+    @decorators.hedged(window=50, budget=None)
+    async def fetch(i):
+        attempts[i] = attempts.get(i, 0) + 1
+        await asyncio.sleep(0.05 if slow_first and attempts[i] == 1 else 0.002)
+
+    await asyncio.gather(*(fetch(i) for i in range(50)))
+    warm = fetch.hedge_info().delay
+    assert warm >= 0.002
+    slow_first = True
+    await asyncio.gather(*(fetch(i) for i in range(50, 100)))
+    info = fetch.hedge_info()
+    assert info.hedge_wins == 50
+    # The losers were cancelled after at least the delay; counting only the
+    # fast winners would pull the delay under the 2ms the backend needs.
+    assert info.delay >= warm
+
+
+# ---------------------------------------------------------
+# Composition
+# ---------------------------------------------------------
+
+def test_compose_runs_steps_flat_and_cache_hit_skips_timing():
+    calls = []
+
+    def fetch(x):
+        calls.append(x)
+        if len(calls) == 1:
+            raise ValueError("transient")
+        return x * 2
+
+    fetch.__qualname__ = "test_compose.fetch"
+    composed = decorators.compose(
+        decorators.timed, decorators.log_calls,
+        decorators.retry(times=3, delay=0), decorators.cache(maxsize=8))(fetch)
+    assert composed(2) == 4 and calls == [2, 2]  # retried once
+    assert composed(2) == 4 and calls == [2, 2]  # hit
+    assert composed.cache_info().hits == 1
+    name = decorators._metric_name(composed)
+    counts = {s["decorator"]: s["count"] for s in decorators.metrics.snapshot()
+              if s["function"] == name}
+    assert counts == {"timed": 1, "log_calls": 1}  # the hit was not timed
+
+    def flaky(x):
+        calls.append(x)
+        if len(calls) % 2:
+            raise ValueError("transient")
+        return x
+
+    flaky.__qualname__ = "test_compose.flaky"
+    per_attempt = decorators.compose(decorators.retry(times=3, delay=0),
+                                     decorators.timed)(flaky)
+    assert per_attempt(1) == 1
+    snap = [s for s in decorators.metrics.snapshot()
+            if s["function"] == decorators._metric_name(per_attempt)][0]
+    assert (snap["count"], snap["errors"]) == (2, 1)  # timed inside the retry
+
+
+@pytest.mark.asyncio
+async def test_compose_async_breaker_and_plain_decorator(tmp_path):
+    breaker = decorators.CircuitBreaker(fail_max=1, reset_timeout=60)
+    tagged = []
+
+    def tag(func):
+        async def wrapper(*args):
+            tagged.append(args)
+            return await func(*args)
+        return wrapper
+
+    async def div(a, b):
+        return a / b
+
+    with pytest.raises(ValueError):  # hits would skip the breaker
+        decorators.compose(breaker, tag, decorators.LRUCache(4))(div)
+    with pytest.raises(ValueError):
+        decorators.compose(tag, decorators.cache)(div)
+    disk = decorators.DiskCache(str(tmp_path / "cache.db"))
+    with pytest.raises(TypeError):  # bytes-keyed, not an in-memory engine
+        decorators.compose(disk)(div)
+    ttl = decorators.compose(decorators.TTLCache(60))(div)
+    assert await ttl(6, 3) == await ttl(6, 3) == 2
+    guarded = decorators.compose(breaker, tag)(div)
+    assert await guarded(6, 3) == 2 and await guarded(6, 3) == 2
+    assert tagged == [(6, 3), (6, 3)]
+    with pytest.raises(ZeroDivisionError):
+        await guarded(1, 0)
+    with pytest.raises(decorators.CircuitOpenError):
+        await guarded(6, 3)  # breaker wraps the plain decorator and the function
+    assert len(tagged) == 3
+
+
 # ---------------------------------------------------------
 # Miscellaneous
 # ---------------------------------------------------------
@@ -208,3 +1608,58 @@ def test_singleton():
     c1 = Config()
     c2 = Config()
     assert c1 is c2
+
+
+def test_singleton_concurrent_creation():
+    created = []
+
+    @decorators.singleton
+    class Client:
+        def __init__(self):
+            created.append(self)
+
+    barrier = threading.Barrier(8)
+    seen = []
+
+    def worker():
+        barrier.wait()
+        seen.append(Client())
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(created) == 1
+    assert all(c is created[0] for c in seen)
+
+
+def test_multiton_per_key_and_weak():
+    @decorators.multiton(key=lambda host, timeout=1: host)
+    class Pool:
+        def __init__(self, host, timeout=1):
+            self.host = host
+
+    assert Pool("a") is Pool("a", timeout=5)
+    assert Pool("a") is not Pool("b")
+
+    @decorators.multiton(weak=True)
+    class Session:
+        def __init__(self, user):
+            self.user = user
+
+    s = Session("u1")
+    assert Session("u1") is s
+    del s
+    gc.collect()
+    assert len(Session.instances) == 0
+
+
+def test_benchmark_compare_gates_regressions():
+    baseline = {"sync/cache(hit)": {"ns_per_call": 1000},
+                "sync/timed": {"ns_per_call": 100}}
+    results = {"sync/cache(hit)": {"ns_per_call": 1400},
+               "sync/timed": {"ns_per_call": 150},   # +50%, but under min_delta_ns
+               "sync/new_case": {"ns_per_call": 5000}}
+    regressions = bench_decorators.compare(results, baseline, threshold=0.25)
+    assert regressions == [("sync/cache(hit)", 1000, 1400)]